@@ -6,14 +6,21 @@ import time
 import traceback
 import dateutil.parser
 import datetime
+import io
 import os
+import select
+import socket
 
+from contextlib import closing
+from copy import deepcopy
+from patroni.metrics import REGISTRY
 from patroni.postgresql import PostgresConnectionException, PostgresException, Postgresql
 from patroni.utils import deep_compare, parse_bool, patch_config, Retry, \
     RetryFailedError, parse_int, split_host_port, tzutc
 from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.queue import Full, Queue
 from six.moves.socketserver import ThreadingMixIn
-from threading import Thread
+from threading import Lock, Thread, current_thread
 
 logger = logging.getLogger(__name__)
 
@@ -32,17 +39,144 @@ def check_auth(func):
     return wrapper
 
 
+class DeadlineWriter(io.BufferedIOBase):
+
+    """Replacement of `wfile` which calls `before_io` before every write, the same as `DeadlineSocketIO`"""
+
+    def __init__(self, sock, before_io):
+        self._sock = sock
+        self._before_io = before_io
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._before_io()
+        self._sock.sendall(data)
+        return len(data)
+
+
+if hasattr(socket, 'SocketIO'):  # python 3
+    class DeadlineSocketIO(socket.SocketIO):
+
+        """Raw reader of the request socket which calls `before_io` before every `recv()`, so that
+        the socket timeout could be limited by the time left till the deadline of the whole request"""
+
+        def __init__(self, sock, before_io):
+            super(DeadlineSocketIO, self).__init__(sock, 'rb')
+            self._before_io = before_io
+
+        def readinto(self, b):
+            self._before_io()
+            return super(DeadlineSocketIO, self).readinto(b)
+
+
 class RestApiHandler(BaseHTTPRequestHandler):
 
+    HEALTH_CHECK_PATHS = ('/master', '/leader', '/primary', '/replica')
+
+    def setup(self):
+        self.timeout = self.server.request_timeout  # applied to the socket by StreamRequestHandler.setup()
+        # persistent connections are supported only with HTTP/1.1
+        self.protocol_version = 'HTTP/1.1' if self.server.keepalive else 'HTTP/1.0'
+        # number of requests received via this connection, it could have been parked between them
+        self.__requests = self.server.pop_served_requests(self.request)
+        self.__close_announced = False
+        self.idle = False  # the connection waits for the next request and should be parked in the server
+        self.deadline = None  # reading the request and writing the response must be finished by this time
+        self.__nonblocking = False
+        BaseHTTPRequestHandler.setup(self)
+        self.__has_deadline = bool(self.timeout and hasattr(socket, 'SocketIO'))
+        if self.__has_deadline:  # `request_timeout` limits the whole request, not only single socket operations
+            self.rfile = io.BufferedReader(DeadlineSocketIO(self.connection, self._apply_deadline))
+            self.wfile = DeadlineWriter(self.connection, self._apply_deadline)
+
+    def _apply_deadline(self):
+        """Limit the next socket operation by the time left till the deadline of the current request"""
+        if self.__nonblocking:
+            return
+        if self.deadline is None:
+            return self.connection.settimeout(self.timeout)
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout('request deadline exceeded')
+        self.connection.settimeout(remaining)
+
+    @property
+    def requests(self):
+        return self.__requests
+
+    def handle(self):
+        """With the pool of workers persistent connections don't hold a worker while waiting for the
+        next request. The connection is parked in the server, which passes it to the next free worker
+        once the next request arrives."""
+
+        if not self.server.parks_idle_connections:
+            return BaseHTTPRequestHandler.handle(self)
+
+        self.handle_one_request()
+        while not self.close_connection:
+            if self._nothing_buffered():
+                self.idle = True
+                return
+            self.handle_one_request()
+
+    def _nothing_buffered(self):
+        """:returns: `!True` if nothing of the next request has been received, so the connection could be parked"""
+        peek = getattr(self.rfile, 'peek', None)
+        if peek is None:  # python 2 file objects, keep waiting for the next request in this thread
+            return False
+        timeout = self.connection.gettimeout()
+        self.connection.settimeout(0)
+        self.__nonblocking = True
+        try:
+            return not peek(1)
+        except (socket.error, ValueError):  # nothing to read yet or the connection is broken
+            return True
+        finally:
+            self.__nonblocking = False
+            self.connection.settimeout(timeout)
+
+    def handle_one_request(self):
+        keepalive_timeout = self.__requests and self.server.keepalive_timeout
+        if keepalive_timeout:
+            self.connection.settimeout(keepalive_timeout)  # idle timeout between requests
+            if self.__has_deadline:
+                # wait for the next request, the deadline of the request is counted from its first byte
+                self.deadline = time.time() + keepalive_timeout
+                try:
+                    if not self.rfile.peek(1):
+                        self.close_connection = True
+                        return
+                except socket.timeout:
+                    self.close_connection = True
+                    return
+        if self.__has_deadline:
+            self.deadline = time.time() + self.timeout
+        self.__requests += 1
+        BaseHTTPRequestHandler.handle_one_request(self)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection' and value.lower() == 'close':
+            self.__close_announced = True
+        BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+    def end_headers(self):
+        if self.close_connection and self.protocol_version >= 'HTTP/1.1' and not self.__close_announced:
+            self.send_header('Connection', 'close')
+        BaseHTTPRequestHandler.end_headers(self)
+
     def _write_response(self, status_code, body, content_type='text/html', headers=None):
+        body = body.encode('utf-8')
         self.send_response(status_code)
         headers = headers or {}
         if content_type:
             headers['Content-Type'] = content_type
+        headers['Content-Length'] = len(body)
         for name, value in headers.items():
             self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(body.encode('utf-8'))
+        self.wfile.write(body)
 
     def _write_json_response(self, status_code, response):
         self._write_response(status_code, json.dumps(response), content_type='application/json')
@@ -56,7 +190,7 @@ class RestApiHandler(BaseHTTPRequestHandler):
         status = self.server.check_auth_header(auth_header)
         return not status or self.send_auth_request(status)
 
-    def _write_status_response(self, status_code, response):
+    def _add_patroni_status(self, response):
         patroni = self.server.patroni
         tags = patroni.ha.get_effective_tags()
         if tags:
@@ -74,21 +208,30 @@ class RestApiHandler(BaseHTTPRequestHandler):
             response['watchdog_failed'] = True
         if patroni.ha.is_paused():
             response['pause'] = True
-        self._write_json_response(status_code, response)
+        return response
+
+    def _write_status_response(self, status_code, response):
+        self._write_json_response(status_code, self._add_patroni_status(response))
 
     def do_GET(self, write_status_code_only=False):
         """Default method for processing all GET requests which can not be routed to other methods"""
 
         path = '/master' if self.path == '/' else self.path
-        response = self.get_postgresql_status()
-
         patroni = self.server.patroni
         cluster = patroni.dcs.cluster
 
+        # The body is not sent in response to OPTIONS and the health-check mode doesn't need it either,
+        # in both cases the status code is decided from the in-memory state and the role known to Patroni.
+        in_memory = write_status_code_only or self.server.fast_health_checks and path in self.HEALTH_CHECK_PATHS
+        response = self.get_role_status() if in_memory else self.get_postgresql_status()
+
         replica_status_code = 200 if not patroni.noloadbalance and response.get('role') == 'replica' else 503
         status_code = 503
 
-        if patroni.ha.is_standby_cluster() and ('standby_leader' in path or 'standby-leader' in path):
+        max_cycle_age = self.server.health_check_max_cycle_age
+        if in_memory and max_cycle_age and patroni.ha.last_cycle_age() > max_cycle_age:
+            status_code = 503  # HA loop is stuck, the in-memory state can't be trusted
+        elif patroni.ha.is_standby_cluster() and ('standby_leader' in path or 'standby-leader' in path):
             status_code = 200 if patroni.ha.is_leader() else 503
         elif 'master' in path or 'leader' in path or 'primary' in path:
             # Round-robing across all masters in pause mode if DCS is not accessible
@@ -106,7 +249,9 @@ class RestApiHandler(BaseHTTPRequestHandler):
             elif path in ('/async', '/asynchronous') and not is_synchronous:
                 status_code = replica_status_code
 
-        if write_status_code_only:  # when haproxy sends OPTIONS request it reads only status code and nothing more
+        if write_status_code_only and self.server.keepalive:  # the connection is reused, response must be complete
+            self._write_response(status_code, '', content_type=None)
+        elif write_status_code_only:  # when haproxy sends OPTIONS request it reads only status code and nothing more
             message = self.responses[status_code][0]
             self.wfile.write('{0} {1} {2}\r\n'.format(self.protocol_version, status_code, message).encode('utf-8'))
         else:
@@ -119,6 +264,60 @@ class RestApiHandler(BaseHTTPRequestHandler):
         response = self.get_postgresql_status(True)
         self._write_status_response(200, response)
 
+    def do_GET_ha_cycles(self):
+        """Return the time spent in every phase of recent HA cycles, the most recent cycle is the last"""
+        self._write_json_response(200, self.server.patroni.ha.cycle_timings.history())
+
+    def do_GET_metrics(self):
+        """Export metrics in the Prometheus text format. Gauges are built from the in-memory state only."""
+
+        patroni = self.server.patroni
+        postgresql = patroni.postgresql
+        gauges = [
+            ('patroni_postgres_running', 'PostgreSQL is running', [({}, int(postgresql.state == 'running'))]),
+            ('patroni_postgres_state', 'State of PostgreSQL as known to Patroni', [({'state': postgresql.state}, 1)]),
+            ('patroni_postgres_role', 'Role of PostgreSQL as known to Patroni', [({'role': postgresql.role}, 1)]),
+            ('patroni_primary', 'This node holds the leader lock', [({}, int(patroni.ha.is_leader()))]),
+            ('patroni_pending_restart', 'PostgreSQL restart is required to apply configuration changes',
+             [({}, int(bool(postgresql.pending_restart)))]),
+            ('patroni_is_paused', 'Cluster is in maintenance mode', [({}, int(bool(patroni.ha.is_paused())))]),
+            ('patroni_last_cycle_age_seconds', 'Time since the last HA cycle with working DCS',
+             [({}, round(patroni.ha.last_cycle_age(), 3))])
+        ]
+        pool_stats = postgresql.connection_pool.stats()
+        gauges += [('patroni_connection_pool_' + name, 'Connection pool: ' + name.replace('_', ' '),
+                    [({}, pool_stats[name])]) for name in sorted(pool_stats)]
+        self._write_response(200, REGISTRY.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def do_GET_status_stream(self):
+        """Publish the status of this node as a stream of server-sent events until the client disconnects.
+
+        Other members subscribe to it in order to always have a fresh status of this node and avoid
+        issuing http requests to every member during the leader race. Every event is built from
+        a fresh query, the shared status snapshot is not used."""
+
+        if not self.server.add_status_stream_subscriber():
+            return self.send_error(503, 'Too many status stream subscribers')
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.close_connection = True
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.server.detach_worker()
+            self.deadline = None  # the stream lives until the client disconnects
+            while True:
+                response = self._add_patroni_status(self.query_postgresql_status())
+                try:
+                    self.wfile.write('data: {0}\n\n'.format(json.dumps(response)).encode('utf-8'))
+                    self.wfile.flush()
+                except (socket.error, ValueError):  # client went away or connection was closed
+                    break
+                time.sleep(self.server.status_stream_interval)
+        finally:
+            self.server.remove_status_stream_subscriber()
+
     def do_GET_config(self):
         cluster = self.server.patroni.dcs.cluster or self.server.patroni.dcs.get_cluster()
         if cluster.config:
@@ -145,7 +344,7 @@ class RestApiHandler(BaseHTTPRequestHandler):
         request = self._read_json_content()
         if request:
             cluster = self.server.patroni.dcs.get_cluster()
-            data = cluster.config.data.copy()
+            data = deepcopy(cluster.config.data)  # parsed config could be reused by the next get_cluster()
             if patch_config(data, request):
                 value = json.dumps(data, separators=(',', ':'))
                 if not self.server.patroni.dcs.set_config_value(value, cluster.config.index):
@@ -323,9 +522,10 @@ class RestApiHandler(BaseHTTPRequestHandler):
             members = [m for m in cluster.members if m.name != cluster.leader.name and m.api_url]
             if not members:
                 return action + ' is not possible: cluster does not have members except leader'
-        for st in self.server.patroni.ha.fetch_nodes_statuses(members):
-            if st.failover_limitation() is None:
-                return None
+        with closing(self.server.patroni.ha.fetch_nodes_statuses(members)) as statuses:
+            for st in statuses:
+                if st.failover_limitation() is None:
+                    return None
         return action + ' is not possible: no good candidates have been found'
 
     @check_auth
@@ -392,6 +592,15 @@ class RestApiHandler(BaseHTTPRequestHandler):
         If the `do_<REQUEST_METHOD>_<first_part_url>` method does not exists we'll fallback to original behavior."""
 
         ret = BaseHTTPRequestHandler.parse_request(self)
+        if ret and not self.close_connection:
+            if self.__requests > 1:
+                self.connection.settimeout(self.timeout)  # the request arrived, idle timeout isn't relevant anymore
+            # Handlers don't always read the request body (i.e. on failed authentication) and leftovers would
+            # be taken for the next request, therefore connections with non-empty requests are not reused.
+            max_requests = self.server.keepalive_max_requests
+            if max_requests and self.__requests >= max_requests or self.headers.get('Transfer-Encoding') \
+                    or parse_int(self.headers.get('Content-Length')):
+                self.close_connection = True
         if ret:
             mname = self.path.lstrip('/').split('/')[0]
             mname = self.command + ('_' + mname if mname else '')
@@ -405,7 +614,29 @@ class RestApiHandler(BaseHTTPRequestHandler):
         retry = Retry(delay=1, retry_exceptions=PostgresConnectionException)
         return retry(self.server.query, sql, *params)
 
+    def get_role_status(self):
+        """:returns: minimal status built from the in-memory state of Patroni, without querying Postgres"""
+        postgresql = self.server.patroni.postgresql
+        role = postgresql.role
+        return {'state': postgresql.state, 'role': 'replica' if role == 'standby_leader' else role}
+
     def get_postgresql_status(self, retry=False):
+        """If `status_cache_ttl` is set, handler threads share one status snapshot, which is refreshed at most once
+        per `status_cache_ttl`. Requests with `retry=True` (`GET /patroni`, used by other members during leader race)
+        always query PostgreSQL."""
+
+        server = self.server
+        with server.status_lock:
+            snapshot = server.status_snapshot
+        if retry or not server.status_cache_ttl or not snapshot or snapshot[0] + server.status_cache_ttl < time.time():
+            status = self.query_postgresql_status(retry)
+            if server.status_cache_ttl and 'postmaster_start_time' in status:  # failures are not cached
+                with server.status_lock:
+                    server.status_snapshot = (time.time(), deepcopy(status))
+            return status
+        return deepcopy(snapshot[1])  # callers are adding more keys to the response
+
+    def query_postgresql_status(self, retry=False):
         try:
             cluster = self.server.patroni.dcs.cluster
 
@@ -467,25 +698,82 @@ class RestApiHandler(BaseHTTPRequestHandler):
         logger.debug("API thread: %s - - [%s] %s", self.client_address[0], self.log_date_time_string(), fmt % args)
 
 
+class IdleConnections(Thread):
+
+    """Persistent connections waiting for the next request. When the request arrives the connection
+    is passed to `dispatch`, connections which were idle longer than the timeout are passed to `close`."""
+
+    def __init__(self, dispatch, close):
+        super(IdleConnections, self).__init__()
+        self.daemon = True
+        self._dispatch = dispatch
+        self._close = close
+        self._lock = Lock()
+        self._connections = {}  # socket -> (client_address, number of served requests, deadline)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+
+    def add(self, request, client_address, served, timeout):
+        with self._lock:
+            self._connections[request] = (client_address, served, time.time() + timeout if timeout else None)
+        self._wakeup_w.send(b'x')
+
+    def _wait(self, connections):
+        deadlines = [deadline for _, _, deadline in connections.values() if deadline]
+        timeout = max(min(deadlines) - time.time(), 0) if deadlines else None
+        try:
+            return select.select([self._wakeup_r] + list(connections), [], [], timeout)[0]
+        except (select.error, socket.error, ValueError):  # some of connections is broken, let handlers find it
+            return list(connections)
+
+    def _run_once(self):
+        with self._lock:
+            connections = self._connections.copy()
+        readable = self._wait(connections)
+        if self._wakeup_r in readable:
+            self._wakeup_r.recv(4096)
+        now = time.time()
+        for request, (client_address, served, deadline) in connections.items():
+            if request in readable or deadline and deadline <= now:
+                with self._lock:
+                    del self._connections[request]
+                if request in readable:
+                    self._dispatch(request, client_address, served)
+                else:
+                    self._close(request)
+
+    def run(self):
+        while True:
+            self._run_once()
+
+
 class RestApiServer(ThreadingMixIn, HTTPServer, Thread):
 
     def __init__(self, patroni, config):
         self.patroni = patroni
         self.__listen = None
+        self.__workers = 0  # wanted number of pool workers, 0 means thread per connection
+        self.__running_workers = 0
+        self.__requests = None  # queue of accepted connections waiting for a free worker
+        self.__workers_lock = Lock()
+        self.status_lock = Lock()
+        self.status_snapshot = None  # (time, status) shared by all handler threads
+        self.__status_stream_subscribers = 0
+        self.__idle_connections = None
+        self.__served_requests = {}  # socket -> number of requests served before it was parked
         self.__initialize(config)
         self.__set_config_parameters(config)
         self.daemon = True
 
     def query(self, sql, *params):
-        cursor = None
-        try:
-            with self.patroni.postgresql.connection().cursor() as cursor:
-                cursor.execute(sql, params)
-                return [r for r in cursor]
-        except psycopg2.Error as e:
-            if cursor and cursor.connection.closed == 0:
-                raise e
-            raise PostgresConnectionException('connection problems')
+        with self.patroni.postgresql.connection_pool.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    return [r for r in cursor]
+            except psycopg2.Error as e:
+                if conn.closed == 0:
+                    raise e
+                raise PostgresConnectionException('connection problems')
 
     @staticmethod
     def _set_fd_cloexec(fd):
@@ -508,8 +796,25 @@ class RestApiServer(ThreadingMixIn, HTTPServer, Thread):
     def __get_ssl_options(config):
         return {option: config[option] for option in ['certfile', 'keyfile'] if option in config}
 
+    @staticmethod
+    def __get_backlog(config):
+        return parse_int(config.get('backlog')) or 5
+
     def __set_config_parameters(self, config):
         self.__auth_key = base64.b64encode(config['auth'].encode('utf-8')).decode('utf-8') if 'auth' in config else None
+        self.request_timeout = float(config.get('request_timeout') or 0) or None
+        self.keepalive = bool(parse_bool(config.get('keepalive')))
+        self.keepalive_timeout = float(config.get('keepalive_timeout') or 5)
+        max_requests = parse_int(config.get('keepalive_max_requests'))
+        self.keepalive_max_requests = 100 if max_requests is None else max_requests
+        self.__set_workers(parse_int(config.get('workers')) or 0)
+        self.status_stream_interval = float(config.get('status_stream_interval') or 1)
+        max_subscribers = parse_int(config.get('status_stream_max_subscribers'))
+        self.status_stream_max_subscribers = 16 if max_subscribers is None else max_subscribers
+        status_cache_ttl = config.get('status_cache_ttl')
+        self.status_cache_ttl = float(status_cache_ttl or 0)
+        self.fast_health_checks = bool(parse_bool(config.get('fast_health_checks')))
+        self.health_check_max_cycle_age = float(config.get('health_check_max_cycle_age') or 0)
         self.connection_string = '{0}://{1}/patroni'.format(self.__protocol,
                                                             config.get('connect_address') or self.__listen)
 
@@ -525,6 +830,7 @@ class RestApiServer(ThreadingMixIn, HTTPServer, Thread):
 
         self.__listen = config['listen']
         self.__ssl_options = self.__get_ssl_options(config)
+        self.request_queue_size = self.__get_backlog(config)
 
         HTTPServer.__init__(self, (host, port), RestApiHandler)
         Thread.__init__(self, target=self.serve_forever)
@@ -544,11 +850,113 @@ class RestApiServer(ThreadingMixIn, HTTPServer, Thread):
         if 'listen' not in config:  # changing config in runtime
             raise ValueError('Can not find "restapi.listen" config')
 
-        elif (self.__listen != config['listen'] or self.__ssl_options != self.__get_ssl_options(config)) \
-                and self.__initialize(config):
+        elif (self.__listen != config['listen'] or self.__ssl_options != self.__get_ssl_options(config) or
+              self.request_queue_size != self.__get_backlog(config)) and self.__initialize(config):
             self.start()
         self.__set_config_parameters(config)
 
+    def __start_worker(self):
+        """Must be called while holding `__workers_lock`"""
+        thread = Thread(target=self.__worker)
+        thread.daemon = True
+        thread.is_pool_worker = True
+        self.__running_workers += 1
+        thread.start()
+
+    def __set_workers(self, workers):
+        with self.__workers_lock:
+            if workers and not self.__requests:
+                # accepted connections which don't fit into the queue are dropped, it keeps memory bounded
+                self.__requests = Queue(max(workers, self.request_queue_size))
+            for _ in range(self.__running_workers, workers):
+                self.__start_worker()
+            extra = self.__running_workers - workers
+            self.__workers = workers
+        # Wake up idle extra workers, so they notice that they have to exit. If the queue is full
+        # there is nothing to wake up, busy workers will check it after finishing the current request.
+        for _ in range(extra):
+            try:
+                self.__requests.put_nowait((None, None))
+            except Full:
+                break
+
+    def __worker(self):
+        thread = current_thread()
+        while not getattr(thread, 'detached', False):
+            with self.__workers_lock:
+                if self.__running_workers > self.__workers:
+                    break
+            request, client_address = self.__requests.get()
+            if request is not None:
+                self.process_request_thread(request, client_address)
+        if not getattr(thread, 'detached', False):
+            with self.__workers_lock:
+                self.__running_workers -= 1
+
+    def detach_worker(self):
+        """Called by handlers of long-living requests (i.e. `/status_stream`). The calling pool worker
+        is replaced with a new one and exits once the request is finished, so such requests don't
+        reduce the number of workers available for short requests."""
+
+        thread = current_thread()
+        if getattr(thread, 'is_pool_worker', False) and not getattr(thread, 'detached', False):
+            thread.detached = True
+            with self.__workers_lock:
+                self.__running_workers -= 1
+                self.__start_worker()
+
+    def add_status_stream_subscriber(self):
+        """:returns: `!False` if the number of `/status_stream` subscribers already reached the limit"""
+        with self.__workers_lock:
+            if self.__status_stream_subscribers >= self.status_stream_max_subscribers:
+                return False
+            self.__status_stream_subscribers += 1
+            return True
+
+    def remove_status_stream_subscriber(self):
+        with self.__workers_lock:
+            self.__status_stream_subscribers -= 1
+
+    @property
+    def parks_idle_connections(self):
+        return bool(self.keepalive and self.__workers)
+
+    def pop_served_requests(self, request):
+        with self.__workers_lock:
+            return self.__served_requests.pop(request, 0)
+
+    def __resume_connection(self, request, client_address, served):
+        with self.__workers_lock:
+            self.__served_requests[request] = served
+        self.process_request(request, client_address)
+
+    def __park_connection(self, request, client_address, served):
+        with self.__workers_lock:
+            if not self.__idle_connections:
+                self.__idle_connections = IdleConnections(self.__resume_connection, self.shutdown_request)
+                self.__idle_connections.start()
+        self.__idle_connections.add(request, client_address, served, self.keepalive_timeout)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+            if getattr(handler, 'idle', False):
+                return self.__park_connection(request, client_address, handler.requests)
+        except Exception:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.__workers:
+            return ThreadingMixIn.process_request(self, request, client_address)
+        try:
+            self.__requests.put_nowait((request, client_address))
+        except Full:
+            logger.warning('All %s REST API workers are busy, dropping connection from %s:%s',
+                           self.__workers, client_address[0], client_address[1])
+            self.pop_served_requests(request)
+            self.shutdown_request(request)
+
     @staticmethod
     def handle_error(request, client_address):
         address, port = client_address
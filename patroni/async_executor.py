@@ -1,5 +1,8 @@
 import logging
-from threading import Event, Lock, RLock, Thread
+import time
+
+from contextlib import contextmanager
+from threading import Condition, Event, Lock, RLock, Thread
 
 logger = logging.getLogger(__name__)
 
@@ -129,3 +132,82 @@ class AsyncExecutor(object):
 
     def __exit__(self, *args):
         self._thread_lock.release()
+
+
+class DCSWriteScheduler(object):
+    """Executes DCS writes, which results are not needed for HA decisions, in a background thread.
+
+    Every write is identified by a key and a newer write replaces the pending one with the same key.
+    Pending writes are executed in order of their priority (lower goes first) and are dropped if they
+    could not be started before their deadline. While the leader lock is being refreshed in the `priority()`
+    block no new writes are started, so the refresh doesn't have to compete with them."""
+
+    def __init__(self):
+        self._condition = Condition()
+        self._pending = {}
+        self._seq = 0
+        self._priority_operations = 0
+        self._running = False
+        self._thread = None
+
+    def schedule(self, key, func, args=(), priority=0, timeout=None):
+        with self._condition:
+            if not self._thread:  # the thread is started on the first use
+                self._thread = Thread(target=self.run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._seq += 1
+            deadline = timeout and time.time() + timeout
+            self._pending[key] = (priority, self._seq, deadline, func, args)
+            self._condition.notify()
+
+    def cancel(self, key):
+        """:returns: `!True` if the pending write was cancelled"""
+        with self._condition:
+            return self._pending.pop(key, None) is not None
+
+    @property
+    def pending(self):
+        with self._condition:
+            return sorted(self._pending)
+
+    def _next(self):
+        with self._condition:
+            while True:
+                while self._priority_operations or not self._pending:
+                    self._condition.wait()
+                key = min(self._pending, key=lambda k: self._pending[k][:2])
+                _, _, deadline, func, args = self._pending.pop(key)
+                if not deadline or deadline >= time.time():
+                    self._running = True
+                    return key, func, args
+                logger.warning('Dropping %s, it was not started before the deadline', key)
+
+    def run(self):
+        while True:
+            key, func, args = self._next()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Exception when executing %s', key)
+            finally:
+                with self._condition:
+                    self._running = False
+                    self._condition.notify_all()
+
+    @contextmanager
+    def priority(self, timeout=0):
+        """Don't start new writes in the block. Entering waits up to `timeout` seconds for the running write
+        to finish, but not longer: the DCS clients are safe to use concurrently with the running write."""
+
+        deadline = time.time() + timeout
+        with self._condition:
+            self._priority_operations += 1
+            while self._running and deadline > time.time():
+                self._condition.wait(deadline - time.time())
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._priority_operations -= 1
+                self._condition.notify_all()
@@ -45,6 +45,10 @@ class Config(object):
         'maximum_lag_on_failover': 1048576,
         'check_timeline': False,
         'master_start_timeout': 300,
+        'slow_cycle_ttl_percentage': 50,
+        'xlog_location_min_delta': 0,
+        'xlog_location_min_interval': 0,
+        'async_member_updates': False,
         'synchronous_mode': False,
         'synchronous_mode_strict': False,
         'standby_cluster': {
@@ -300,8 +304,9 @@ class Config(object):
                         value = parse_bool(value)
                     if value:
                         ret[name.lower()][suffix.lower()] = value
-        if 'etcd' in ret:
-            ret['etcd'].update(_get_auth('etcd'))
+        for name in ('etcd', 'etcd3'):
+            if name in ret:
+                ret[name].update(_get_auth(name))
 
         users = {}
         for param in list(os.environ.keys()):
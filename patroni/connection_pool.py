@@ -0,0 +1,128 @@
+import logging
+import psycopg2
+import time
+
+from contextlib import contextmanager
+from patroni.exceptions import PostgresConnectionException
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from threading import Condition
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+
+    """Pool of connections to the local PostgreSQL for threads other than the HA loop (REST API handlers,
+    async executor), which otherwise would have to share the connection of the HA loop.
+
+    Connections are opened on demand up to `max_size`, if all of them are busy the caller waits up to `timeout`
+    seconds for a free one. Connections are checked on checkout: closed or broken connections are replaced
+    and connections which were idle longer than `check_interval` seconds are pinged with `SELECT 1`."""
+
+    def __init__(self, connect, max_size=4, timeout=5, check_interval=30):
+        """:param connect: function returning a new connection"""
+        self._connect = connect
+        self._max_size = max_size
+        self._timeout = timeout
+        self._check_interval = check_interval
+        self._condition = Condition()
+        self._idle = []  # list of (connection, time it was returned to the pool)
+        self._in_use = {}  # connection -> generation of the pool it was created in
+        self._generation = 0
+        self._stats = {'created': 0, 'checkouts': 0, 'waits': 0, 'timeouts': 0, 'health_check_failures': 0}
+
+    @property
+    def size(self):
+        return len(self._idle) + len(self._in_use)
+
+    def stats(self):
+        """:returns: dict with the number of idle and busy connections and counters of pool events"""
+        with self._condition:
+            ret = self._stats.copy()
+            ret.update(idle=len(self._idle), in_use=len(self._in_use))
+        return ret
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed != 0 or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return False
+        if returned_at + self._check_interval < time.time():
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _checkout(self):
+        deadline = time.time() + self._timeout
+        with self._condition:
+            self._stats['checkouts'] += 1
+            if not self._idle and self.size >= self._max_size:
+                self._stats['waits'] += 1
+                while not self._idle and self.size >= self._max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PostgresConnectionException('no free connection in the pool')
+                    self._condition.wait(remaining)
+            conn, returned_at = self._idle.pop() if self._idle else (None, None)
+            # reserve the slot, the connection is checked or opened without holding the lock
+            key = conn or object()
+            self._in_use[key] = self._generation
+
+        try:
+            if conn and not self._is_healthy(conn, returned_at):
+                logger.info('Closing broken connection from the pool')
+                self._close(conn)
+                with self._condition:
+                    self._stats['health_check_failures'] += 1
+                conn = None
+            if not conn:
+                conn = self._connect()
+                with self._condition:
+                    self._stats['created'] += 1
+        except Exception as e:
+            with self._condition:
+                del self._in_use[key]
+                self._condition.notify()
+            if isinstance(e, psycopg2.Error):
+                raise PostgresConnectionException('connection problems')
+            raise
+
+        if conn is not key:
+            with self._condition:
+                self._in_use[conn] = self._in_use.pop(key)
+        return conn
+
+    def _checkin(self, conn):
+        with self._condition:
+            generation = self._in_use.pop(conn)
+            if generation == self._generation and conn.closed == 0:
+                self._idle.append((conn, time.time()))
+                conn = None
+            self._condition.notify()
+        if conn:
+            self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._checkin(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            logger.exception('Failed to close connection')
+
+    def close(self):
+        """Close idle connections, connections which are in use will be closed when they are returned"""
+        with self._condition:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
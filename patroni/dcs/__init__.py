@@ -12,12 +12,13 @@ import sys
 import time
 
 from collections import defaultdict, namedtuple
+from contextlib import contextmanager
 from copy import deepcopy
 from patroni.exceptions import PatroniException
-from patroni.utils import parse_bool
+from patroni.utils import deep_compare, parse_bool
 from random import randint
 from six.moves.urllib_parse import urlparse, urlunparse, parse_qsl
-from threading import Event, Lock
+from threading import Event, Lock, Thread
 
 slot_name_re = re.compile('^[a-z0-9_]{1,63}$')
 logger = logging.getLogger(__name__)
@@ -481,6 +482,11 @@ class Cluster(namedtuple('Cluster', 'initialize,config,leader,last_leader_operat
 
         return slots
 
+    def replication_slots_fingerprint(self, name, role):
+        """:returns: hashable value which changes if the result of `get_replication_slots(name, role)` could change"""
+        return (name, role, self.leader and self.leader.name, self.config and self.config.modify_index,
+                tuple((m.name, m.replicatefrom) for m in self.members))
+
     def has_permanent_logical_slots(self, name):
         slots = self.get_replication_slots(name, 'master').values()
         return any(v for v in slots if v.get("type") == "logical")
@@ -519,6 +525,9 @@ class AbstractDCS(object):
     _LEADER_OPTIME = _OPTIME + '/' + _LEADER
     _SYNC = 'sync'
 
+    _SUPPORTS_PREFIX_WATCH = False
+    _PREFIX_WATCH_TIMEOUT = 30
+
     def __init__(self, config):
         """
         :param config: dict, reference to config section of selected DCS.
@@ -535,6 +544,14 @@ class AbstractDCS(object):
         self._last_leader_operation = ''
         self.event = Event()
 
+        self._watch_prefix = bool(parse_bool(config.get('watch_prefix')))
+        if self._watch_prefix and not self._SUPPORTS_PREFIX_WATCH:
+            logger.warning('watch_prefix is not supported by %s, ignoring it', type(self).__name__)
+            self._watch_prefix = False
+        self._watch_leader = False
+        self._prefix_watcher = None
+        self._member_cache = None  # (data, index) of the last successful write of the member key
+
     def client_path(self, path):
         return '/'.join([self._base_path, path.lstrip('/')])
 
@@ -630,6 +647,16 @@ class AbstractDCS(object):
             self._cluster = None
             self._cluster_valid_till = 0
 
+    @contextmanager
+    def batch(self):
+        """Writes of the leader optime, history and failover keys done inside of this block could be
+        postponed until the end of the block and executed together as one atomic request, if the backend
+        supports it. In that case the write methods return `!True` immediately, therefore the block should
+        not contain writes which results are used for decisions. Only writes from the thread which opened
+        the block are postponed, conditional (compare-and-set) writes are always executed immediately."""
+
+        yield
+
     @abc.abstractmethod
     def _write_leader_optime(self, last_operation):
         """write current xlog location into `/optime/leader` key in DCS
@@ -693,6 +720,20 @@ class AbstractDCS(object):
     def set_config_value(self, value, index=None):
         """Create or update `/config` key"""
 
+    def _cached_member(self, data):
+        """Write-through cache of the member key, allows to skip writes of the data which didn't change.
+
+        :returns: `(True, index)` if `data` is equal to the payload of the last successful `touch_member()`
+            write, otherwise `(False, None)`. The `index` is `!None` if the backend doesn't report it."""
+
+        cached = self._member_cache
+        if cached and deep_compare(data, cached[0]):
+            return True, cached[1]
+        return False, None
+
+    def _set_cached_member(self, data, index=None):
+        self._member_cache = None if data is None else (deepcopy(data), index)
+
     @abc.abstractmethod
     def touch_member(self, data, permanent=False):
         """Update member key in DCS.
@@ -765,5 +806,45 @@ class AbstractDCS(object):
         :param timeout: timeout in seconds
         :returns: `!True` if you would like to reschedule the next run of ha cycle"""
 
+        if self._watch_prefix:
+            self._watch_leader = bool(leader_index)
+            self._start_prefix_watcher()
+
         self.event.wait(timeout)
         return self.event.isSet()
+
+    def _watch_prefix_changes(self, timeout):
+        """Block until any key under the cluster prefix is changed or `timeout` expires.
+        Must be implemented by backends setting `_SUPPORTS_PREFIX_WATCH`.
+
+        :returns: list of changed keys relative to the cluster prefix, `*` if it is not known what has changed"""
+
+        raise NotImplementedError  # pragma: no cover
+
+    def _relevant_changes(self, keys):
+        """Member keys and the leader optime are updated by every node on every HA cycle and the leader key
+        is renewed by the leader itself, therefore these changes should not wake up the HA loop. The leader key
+        is relevant only when we are watching it, i.e. somebody else is holding the leader lock.
+
+        :returns: sorted list of keys which changes are worth of running the HA cycle"""
+
+        return sorted(set(k for k in keys if not k.startswith((self._MEMBERS, self._OPTIME + '/'))
+                          and (k != self._LEADER or self._watch_leader)))
+
+    def _prefix_watcher_loop(self):
+        while True:
+            try:
+                changes = self._relevant_changes(self._watch_prefix_changes(self._PREFIX_WATCH_TIMEOUT))
+            except Exception as e:
+                logger.warning('Failed to watch the cluster prefix: %r', e)
+                time.sleep(1)
+                continue
+            if changes:
+                logger.info('Keys changed in DCS: %s, waking up', ', '.join(changes))
+                self.event.set()
+
+    def _start_prefix_watcher(self):
+        if self._prefix_watcher is None:
+            self._prefix_watcher = Thread(target=self._prefix_watcher_loop)
+            self._prefix_watcher.daemon = True
+            self._prefix_watcher.start()
@@ -1,4 +1,5 @@
 from __future__ import absolute_import
+import base64
 import json
 import logging
 import os
@@ -8,6 +9,7 @@ import ssl
 import time
 import urllib3
 
+from contextlib import contextmanager
 from consul import ConsulException, NotFound, base
 from patroni.dcs import AbstractDCS, ClusterConfig, Cluster, Failover, Leader, Member, SyncState, TimelineHistory
 from patroni.exceptions import DCSError
@@ -15,6 +17,7 @@ from patroni.utils import deep_compare, parse_bool, Retry, RetryFailedError, spl
 from urllib3.exceptions import HTTPError
 from six.moves.urllib.parse import urlencode, urlparse, quote
 from six.moves.http_client import HTTPException
+from threading import Lock, RLock, local
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +68,7 @@ class HTTPClient(object):
             self._read_timeout = self._fixed_timeout
         self.http = urllib3.PoolManager(num_pools=10, **kwargs)
         self._ttl = None
+        self.last_kv_write = 0  # time when the last request modifying KV was started
 
     def set_read_timeout(self, timeout):
         if self._fixed_timeout:
@@ -113,6 +117,8 @@ class HTTPClient(object):
                     data = data[:-1] + ', ' + ttl + '}'
             if isinstance(params, list):  # starting from v1.1.0 python-consul switched from `dict` to `list` for params
                 params = {k: v for k, v in params}
+            if method in ('put', 'delete') and path.startswith(('/v1/kv/', '/v1/txn')):
+                self.last_kv_write = time.time()
             kwargs = {'retries': 0, 'preload_content': False, 'body': data}
             if method == 'get' and isinstance(params, dict) and 'index' in params:
                 timeout = float(params['wait'][:-1]) if 'wait' in params else 300
@@ -180,6 +186,16 @@ def force_if_last_failed(func):
     return wrapper
 
 
+def synchronized_session(func):
+    """Operations with the session could be called from the HA loop and from the background thread
+    writing the member key, they must not create or reset the session concurrently. The lock is not
+    held while the member key is written, so that a slow write doesn't delay the leader lock refresh"""
+    def wrapper(self, *args, **kwargs):
+        with self._session_lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 def service_name_from_scope_name(scope_name):
     """Translate scope name to service name which can be used in dns.
 
@@ -196,12 +212,23 @@ def service_name_from_scope_name(scope_name):
 
 class Consul(AbstractDCS):
 
+    _SUPPORTS_PREFIX_WATCH = True
+
     def __init__(self, config):
         super(Consul, self).__init__(config)
         self._scope = config['scope']
         self._2node = config.get('consul2node', False)
         self._session = None
+        self._session_lock = RLock()
         self.__do_not_watch = False
+        self._cluster_index = None  # X-Consul-Index of the last recursive read of the cluster prefix
+        self._nodes_cache = {}  # relative key -> (ModifyIndex, object built from the node)
+        self._prefix_watch_index = None
+        self._prefix_watch_state = None  # relative key -> ModifyIndex, as seen by the prefix watcher
+        self._prefix_watch_results = None  # nodes returned by the last query of the prefix watcher
+        self._prefix_watch_snapshot = None  # (started, expires, index, nodes) while the watcher is blocked
+        self._prefix_watch_lock = Lock()
+        self._batch = local()  # KV writes postponed until the end of the `batch()` block, only in its thread
         self._retry = Retry(deadline=config['retry_timeout'], max_delay=1, max_tries=-1,
                             retry_exceptions=(ConsulInternalError, HTTPException,
                                               HTTPError, socket.error, socket.timeout))
@@ -259,6 +286,7 @@ class Consul(AbstractDCS):
                 logger.info('waiting on consul')
                 time.sleep(5)
 
+    @synchronized_session
     def set_ttl(self, ttl):
         if self._client.http.set_ttl(ttl/2.0):  # Consul multiplies the TTL by 2x
             self._session = None
@@ -305,6 +333,7 @@ class Consul(AbstractDCS):
         self._last_session_refresh = time.time()
         return ret
 
+    @synchronized_session
     def refresh_session(self):
         try:
             return self.retry(self._do_refresh_session)
@@ -319,18 +348,49 @@ class Consul(AbstractDCS):
     def member(node):
         return Member.from_node(node['ModifyIndex'], os.path.basename(node['Key']), node.get('Session'), node['Value'])
 
+    def _parse_nodes(self, path, results):
+        """Decode values of KV nodes and build objects from them. Objects built from nodes whose
+        `ModifyIndex` didn't change since the previous read are reused instead of being parsed again.
+
+        :returns: dict, relative key -> object"""
+
+        cache, self._nodes_cache = self._nodes_cache, {}
+        ret = {}
+        for node in results:
+            key = node['Key'][len(path):].lstrip('/')
+            cached = cache.get(key)
+            if not cached or cached[0] != node['ModifyIndex']:
+                node = dict(node, Value=(node['Value'] or b'').decode('utf-8'))
+                if key == self._CONFIG:
+                    value = ClusterConfig.from_node(node['ModifyIndex'], node['Value'])
+                elif key == self._HISTORY:
+                    value = TimelineHistory.from_node(node['ModifyIndex'], node['Value'])
+                elif key == self._FAILOVER:
+                    value = Failover.from_node(node['ModifyIndex'], node['Value'])
+                elif key == self._SYNC:
+                    value = SyncState.from_node(node['ModifyIndex'], node['Value'])
+                elif key.startswith(self._MEMBERS) and key.count('/') == 1:
+                    value = self.member(node)
+                else:
+                    value = node
+                cached = (node['ModifyIndex'], value)
+            self._nodes_cache[key] = cached
+            ret[key] = cached[1]
+        return ret
+
     def _load_cluster(self):
         try:
             path = self.client_path('/')
-            _, results = self.retry(self._client.kv.get, path, recurse=True)
+            snapshot = self._fresh_prefix_watch_snapshot()
+            if snapshot:
+                self._cluster_index, results = snapshot
+            else:
+                self._cluster_index, results = self.retry(self._client.kv.get, path, recurse=True)
 
             if results is None:
                 raise NotFound
 
-            nodes = {}
-            for node in results:
-                node['Value'] = (node['Value'] or b'').decode('utf-8')
-                nodes[node['Key'][len(path):].lstrip('/')] = node
+            nodes = self._parse_nodes(path, results)
 
             # get initialize flag
             initialize = nodes.get(self._INITIALIZE)
@@ -338,18 +398,16 @@ class Consul(AbstractDCS):
 
             # get global dynamic configuration
             config = nodes.get(self._CONFIG)
-            config = config and ClusterConfig.from_node(config['ModifyIndex'], config['Value'])
 
             # get timeline history
             history = nodes.get(self._HISTORY)
-            history = history and TimelineHistory.from_node(history['ModifyIndex'], history['Value'])
 
             # get last leader operation
             last_leader_operation = nodes.get(self._LEADER_OPTIME)
             last_leader_operation = 0 if last_leader_operation is None else int(last_leader_operation['Value'])
 
             # get list of members
-            members = [self.member(n) for k, n in nodes.items() if k.startswith(self._MEMBERS) and k.count('/') == 1]
+            members = [n for k, n in nodes.items() if k.startswith(self._MEMBERS) and k.count('/') == 1]
 
             # get leader
             leader = nodes.get(self._LEADER)
@@ -366,12 +424,9 @@ class Consul(AbstractDCS):
 
             # failover key
             failover = nodes.get(self._FAILOVER)
-            if failover:
-                failover = Failover.from_node(failover['ModifyIndex'], failover['Value'])
 
             # get synchronization state
-            sync = nodes.get(self._SYNC)
-            sync = SyncState.from_node(sync and sync['ModifyIndex'], sync and sync['Value'])
+            sync = nodes.get(self._SYNC) or SyncState.from_node(None, None)
 
             return Cluster(initialize, config, leader, last_leader_operation, members, failover, sync, history)
         except NotFound:
@@ -390,22 +445,28 @@ class Consul(AbstractDCS):
         cluster = self.cluster
         member = cluster and cluster.get_member(self._name, fallback_to_leader=False)
         create_member = not permanent and self.refresh_session()
+        session = self._session
 
-        if member and (create_member or member.session != self._session):
+        if member and (create_member or member.session != session):
             self._client.kv.delete(self.member_path)
             create_member = True
 
-        if not create_member and member and deep_compare(data, member.data):
+        # the key is protected by the session, renewing the session is enough when the data didn't change
+        if not create_member and member and (self._cached_member(data)[0] or deep_compare(data, member.data)):
             return True
 
+        self._set_cached_member(None)
         try:
-            args = {} if permanent else {'acquire': self._session}
+            args = {} if permanent else {'acquire': session}
             self._client.kv.put(self.member_path, json.dumps(data, separators=(',', ':')), **args)
+            self._set_cached_member(data)
             if self._register_service:
                 self.update_service(not create_member and member and member.data or {}, data)
             return True
         except InvalidSession:
-            self._session = None
+            with self._session_lock:
+                if self._session == session:  # it could have been already replaced by the HA loop
+                    self._session = None
             logger.error('Our session disappeared from Consul, can not "touch_member"')
         except ConsulNoClusterLeader:
             if self._2node:
@@ -479,6 +540,7 @@ class Consul(AbstractDCS):
             self.refresh_session()
             return self.retry(self._client.kv.put, self.leader_path, self._name, acquire=self._session)
 
+    @synchronized_session
     def attempt_to_acquire_leader(self, permanent=False):
         if not self._session and not permanent:
             self.refresh_session()
@@ -492,9 +554,76 @@ class Consul(AbstractDCS):
     def take_leader(self):
         return self.attempt_to_acquire_leader()
 
+    @staticmethod
+    def _kv_operation(verb, key, value=None, index=None, session=None):
+        operation = {'Verb': verb, 'Key': key}
+        if value is not None:
+            operation['Value'] = base64.b64encode(str(value).encode('utf-8')).decode('utf-8')
+        if index is not None:
+            operation['Index'] = index
+        if session:
+            operation['Session'] = session
+        return {'KV': operation}
+
+    def _txn(self, operations):
+        """Execute `operations` in one transaction. If any operation fails, none of them are applied
+        and the `/v1/txn` endpoint responds with 409, which is raised as `ClientError`."""
+        return self._client.http.put(base.CB.json(), '/v1/txn', data=json.dumps(operations))
+
+    def _leader_check(self):
+        """:returns: list with the operation aborting the transaction if our session doesn't hold the leader lock"""
+        cluster = self.cluster
+        if self._session and cluster and isinstance(cluster.leader, Leader) and cluster.leader.name == self._name:
+            return [self._kv_operation('check-session', self.leader_path, session=self._session)]
+        return []
+
+    def _write(self, operation, func, *args, **kwargs):
+        """Postpone `operation` if the current thread is inside of the `batch()` block, otherwise execute `func`.
+        Conditional writes are never postponed, because the failed condition would abort the whole transaction."""
+        writes = getattr(self._batch, 'writes', None)
+        if writes is not None and operation['KV']['Verb'] != 'cas':
+            writes.append((operation, func, args, kwargs))
+            return True
+        return func(*args, **kwargs)
+
+    @contextmanager
+    def batch(self):
+        if getattr(self._batch, 'writes', None) is not None:  # nested block, the outer one will flush
+            yield
+            return
+
+        self._batch.writes = []
+        try:
+            yield
+        finally:
+            writes, self._batch.writes = self._batch.writes, None
+            if writes and not self._flush_batch([operation for operation, _, _, _ in writes]):
+                self._retry_batched_writes(writes)
+
+    @catch_consul_errors
+    def _flush_batch(self, operations):
+        self._txn(self._leader_check() + operations)
+        return True
+
+    def _retry_batched_writes(self, writes):
+        """The transaction has failed, execute postponed writes one by one in order to apply
+        all of them which could be applied and to report failures of every individual write"""
+        for operation, func, args, kwargs in writes:
+            key = operation['KV']['Key']
+            try:
+                ret = func(*args, **kwargs)
+            except Exception:
+                logger.exception('Failed to write %s', key)
+                ret = False
+            if not ret:
+                logger.error('Failed to write %s', key)
+                if key == self.leader_optime_path:
+                    self._last_leader_operation = ''  # the optime wasn't written, don't skip it next time
+
     @catch_consul_errors
     def set_failover_value(self, value, index=None):
-        return self._client.kv.put(self.failover_path, value, cas=index)
+        operation = self._kv_operation('set' if index is None else 'cas', self.failover_path, value, index)
+        return self._write(operation, self._client.kv.put, self.failover_path, value, cas=index)
 
     @catch_consul_errors
     def set_config_value(self, value, index=None):
@@ -502,9 +631,14 @@ class Consul(AbstractDCS):
 
     @catch_consul_errors
     def _write_leader_optime(self, last_operation):
-        return self._client.kv.put(self.leader_optime_path, last_operation)
+        operation = self._kv_operation('set', self.leader_optime_path, last_operation)
+        check = self._leader_check()
+        if check:  # the optime is written only if we are still holding the leader lock
+            return self._write(operation, self._txn, check + [operation])
+        return self._write(operation, self._client.kv.put, self.leader_optime_path, last_operation)
 
     @catch_consul_errors
+    @synchronized_session
     def _update_leader(self):
         if self._session:
             self.retry(self._client.session.renew, self._session)
@@ -526,7 +660,8 @@ class Consul(AbstractDCS):
 
     @catch_consul_errors
     def set_history_value(self, value):
-        return self._client.kv.put(self.history_path, value)
+        operation = self._kv_operation('set', self.history_path, value)
+        return self._write(operation, self._client.kv.put, self.history_path, value)
 
     @catch_consul_errors
     def delete_leader(self):
@@ -548,7 +683,7 @@ class Consul(AbstractDCS):
             self.__do_not_watch = False
             return True
 
-        if leader_index:
+        if leader_index and not self._watch_prefix:
             end_time = time.time() + timeout
             while timeout >= 1:
                 try:
@@ -560,6 +695,47 @@ class Consul(AbstractDCS):
                 timeout = end_time - time.time()
 
         try:
-            return super(Consul, self).watch(None, timeout)
+            return super(Consul, self).watch(leader_index, timeout)
         finally:
             self.event.clear()
+
+    def _fresh_prefix_watch_snapshot(self):
+        """While the prefix watcher is blocked on the index of its last results nothing under the cluster
+        prefix has changed, and the cluster could be built from these results without reading the whole
+        prefix again. Results are not used if the query takes longer than expected (the watcher could be stuck)
+        or if we modified KV after the query was started, because the watcher may not have seen our write yet.
+
+        :returns: (index, nodes) or `!None`"""
+
+        with self._prefix_watch_lock:
+            snapshot = self._prefix_watch_snapshot
+        if snapshot and snapshot[0] > self._client.http.last_kv_write and snapshot[1] > time.time():
+            return snapshot[2:]
+
+    def _watch_prefix_changes(self, timeout):
+        if self._prefix_watch_index is None:
+            self._prefix_watch_index = self._cluster_index
+            self._prefix_watch_state = {key: value[0] for key, value in self._nodes_cache.items()}
+
+        path = self.client_path('/')
+        index = self._prefix_watch_index
+        if index is None:  # the cluster wasn't read yet, just take the current state
+            self._prefix_watch_index, results = self._client.kv.get(path, recurse=True)
+            self._prefix_watch_results = results
+            self._prefix_watch_state = {n['Key'][len(path):].lstrip('/'): n['ModifyIndex'] for n in results or []}
+            return []
+
+        if self._prefix_watch_results is not None:
+            with self._prefix_watch_lock:
+                # the blocking query doesn't return while nothing has changed, so the last results stay up to date
+                now = time.time()
+                self._prefix_watch_snapshot = (now, now + timeout, index, self._prefix_watch_results)
+        try:
+            idx, results = self._client.kv.get(path, recurse=True, index=index, wait=str(int(timeout)) + 's')
+        finally:
+            with self._prefix_watch_lock:
+                self._prefix_watch_snapshot = None
+        self._prefix_watch_results = results
+        state = {n['Key'][len(path):].lstrip('/'): n['ModifyIndex'] for n in results or []}
+        prev, self._prefix_watch_index, self._prefix_watch_state = self._prefix_watch_state, idx, state
+        return [key for key in set(state) | set(prev) if state.get(key) != prev.get(key)]
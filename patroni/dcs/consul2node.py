@@ -167,6 +167,10 @@ class Consul2Node(consul.Consul):
     def _update_leader(self):
         pass
 
+    def batch(self):
+        # in the static mode writes must be applied to the static cluster immediately
+        return super(consul.Consul, self).batch()
+
     @log_invocation
     def set_history_value(self, value):
         if self._static_mode:
@@ -20,7 +20,7 @@ from requests.exceptions import RequestException
 from six.moves.queue import Queue
 from six.moves.http_client import HTTPException
 from six.moves.urllib_parse import urlparse
-from threading import Thread
+from threading import RLock, Thread
 
 logger = logging.getLogger(__name__)
 
@@ -81,6 +81,9 @@ class DnsCachingResolver(Thread):
 class Client(etcd.Client):
 
     def __init__(self, config, dns_resolver, cache_ttl=300):
+        # The client is used by the HA loop and by background threads (i.e. asynchronous member updates).
+        # Requests are executed concurrently, the lock protects only switching of `_base_uri` and `_machines_cache`.
+        self._lock = RLock()
         self._dns_resolver = dns_resolver
         self.set_machines_cache_ttl(cache_ttl)
         self._machines_cache_updated = 0
@@ -168,7 +171,8 @@ class Client(etcd.Client):
                 raise etcd.EtcdWatchTimedOut("Watch timed out: {0}".format(e), cause=e)
             logger.error("Request to server %s failed: %r", self._base_uri, e)
             logger.info("Reconnection allowed, looking for another server.")
-            self._base_uri = self._next_server(cause=e)
+            with self._lock:
+                self._base_uri = self._next_server(cause=e)
             response = False
         return response
 
@@ -186,14 +190,15 @@ class Client(etcd.Client):
         else:
             raise etcd.EtcdException('HTTP method {0} not supported'.format(method))
 
-        # Update machines_cache if previous attempt of update has failed
-        if self._update_machines_cache:
-            self._load_machines_cache()
-        elif not self._use_proxies and time.time() - self._machines_cache_updated > self._machines_cache_ttl:
-            self._refresh_machines_cache()
-            self._machines_cache_updated = time.time()
+        with self._lock:
+            # Update machines_cache if previous attempt of update has failed
+            if self._update_machines_cache:
+                self._load_machines_cache()
+            elif not self._use_proxies and time.time() - self._machines_cache_updated > self._machines_cache_ttl:
+                self._refresh_machines_cache()
+                self._machines_cache_updated = time.time()
 
-        kwargs.update(self._build_request_parameters())
+            kwargs.update(self._build_request_parameters())
 
         if timeout is not None:
             kwargs.update({'retries': 0, 'timeout': timeout})
@@ -208,12 +213,14 @@ class Client(etcd.Client):
                 if response is False:
                     some_request_failed = True
             if some_request_failed:
-                self._refresh_machines_cache()
+                with self._lock:
+                    self._refresh_machines_cache()
         except etcd.EtcdConnectionFailed as e:
-            if isinstance(e, etcd.EtcdWatchTimedOut) and self._machines_cache:
-                self._base_uri = self._next_server()
-            else:
-                self._update_machines_cache = True
+            with self._lock:
+                if isinstance(e, etcd.EtcdWatchTimedOut) and self._machines_cache:
+                    self._base_uri = self._next_server()
+                else:
+                    self._update_machines_cache = True
             if not response:
                 raise
         return self._handle_server_response(response)
@@ -314,6 +321,8 @@ class Client(etcd.Client):
 
 class Etcd(AbstractDCS):
 
+    _SUPPORTS_PREFIX_WATCH = True
+
     def __init__(self, config):
         super(Etcd, self).__init__(config)
         self._ttl = int(config.get('ttl') or 30)
@@ -324,6 +333,9 @@ class Etcd(AbstractDCS):
         self._client = self.get_etcd_client(config)
         self.__do_not_watch = False
         self._has_failed = False
+        self._cluster_index = None
+        self._prefix_watch_index = None
+        self._ttl_refresh_supported = None  # not known until the version of the etcd cluster is checked
 
     def retry(self, *args, **kwargs):
         return self._retry.copy()(*args, **kwargs)
@@ -459,6 +471,7 @@ class Etcd(AbstractDCS):
         cluster = None
         try:
             result = self.retry(self._client.read, self.client_path(''), recursive=True)
+            self._cluster_index = result.etcd_index
             nodes = {node.key[len(result.key):].lstrip('/'): node for node in result.leaves}
 
             # get initialize flag
@@ -505,10 +518,58 @@ class Etcd(AbstractDCS):
         self._has_failed = False
         return cluster
 
+    def _check_ttl_refresh_support(self):
+        """TTL refresh requires etcd 2.3.0+ and python-etcd 0.4.4+, older versions would wipe out the value.
+
+        :returns: `!True` if supported, `!None` if the version of the etcd cluster could not be checked"""
+
+        if 'refresh' not in getattr(etcd.Client, '_comparison_conditions', ()):
+            logger.info('TTL refresh is not supported by python-etcd, the member key will be fully rewritten')
+            return False
+        try:
+            version = getattr(self._client, 'cluster_version', None) or self._client.version
+        except Exception as e:
+            logger.debug('Failed to get version of etcd: %r', e)
+            return None
+        try:
+            supported = tuple(map(int, version.split('.')[:2])) >= (2, 3)
+        except (AttributeError, ValueError):
+            supported = False
+        if not supported:
+            logger.info('TTL refresh is not supported by etcd %s, the member key will be fully rewritten', version)
+        return supported
+
+    def _refresh_member(self, value, index):
+        """Update only the TTL of the member key if it still has the `index`. Refresh doesn't notify watchers.
+
+        :returns: the new `modifiedIndex` of the key or `!None` if it must be rewritten"""
+
+        try:
+            result = self._client.write(self.member_path, None, ttl=self._ttl, refresh=True, prevIndex=index)
+        except (etcd.EtcdCompareFailed, etcd.EtcdKeyNotFound):
+            logger.info('Member key was changed or has expired, rewriting it')
+            return None
+        if result.value != value:  # one of members of the etcd cluster doesn't know about refresh
+            logger.warning('TTL refresh is not supported by etcd, falling back to full writes of the member key')
+            self._ttl_refresh_supported = False
+            return None
+        return result.modifiedIndex
+
     @catch_etcd_errors
     def touch_member(self, data, permanent=False):
-        data = json.dumps(data, separators=(',', ':'))
-        return self._client.set(self.member_path, data, None if permanent else self._ttl)
+        value = json.dumps(data, separators=(',', ':'))
+        cached, index = self._cached_member(data)
+        if not cached or not index or permanent:
+            index = None
+        else:
+            if self._ttl_refresh_supported is None:
+                self._ttl_refresh_supported = self._check_ttl_refresh_support()
+            index = self._refresh_member(value, index) if self._ttl_refresh_supported else None
+        if not index:
+            self._set_cached_member(None)
+            index = self._client.set(self.member_path, value, None if permanent else self._ttl).modifiedIndex
+        self._set_cached_member(data, index)
+        return True
 
     @catch_etcd_errors
     def take_leader(self):
@@ -576,7 +637,7 @@ class Etcd(AbstractDCS):
             self.__do_not_watch = False
             return True
 
-        if leader_index:
+        if leader_index and not self._watch_prefix:
             end_time = time.time() + timeout
 
             while timeout >= 1:  # when timeout is too small urllib3 doesn't have enough time to connect
@@ -599,6 +660,22 @@ class Etcd(AbstractDCS):
                 timeout = end_time - time.time()
 
         try:
-            return super(Etcd, self).watch(None, timeout)
+            return super(Etcd, self).watch(leader_index, timeout)
         finally:
             self.event.clear()
+
+    def _watch_prefix_changes(self, timeout):
+        if self._prefix_watch_index is None and self._cluster_index:
+            self._prefix_watch_index = self._cluster_index + 1
+        path = self.client_path('')
+        try:
+            result = self._client.watch(path, index=self._prefix_watch_index, timeout=timeout, recursive=True)
+        except etcd.EtcdWatchTimedOut:
+            return []
+        except (etcd.EtcdEventIndexCleared, etcd.EtcdWatcherCleared):
+            # we have missed some events, start from the current state
+            self._prefix_watch_index = None
+            self._cluster_index = None
+            return ['*']
+        self._prefix_watch_index = result.modifiedIndex + 1
+        return [result.key[len(path):].lstrip('/')]
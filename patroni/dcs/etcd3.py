@@ -0,0 +1,563 @@
+from __future__ import absolute_import
+import base64
+import json
+import logging
+import os
+import six
+import socket
+import time
+import urllib3
+
+from patroni.dcs import AbstractDCS, ClusterConfig, Cluster, Failover, Leader, Member, SyncState, TimelineHistory
+from patroni.exceptions import DCSError, PatroniException
+from patroni.utils import Retry, RetryFailedError, split_host_port
+from six.moves.http_client import HTTPException
+from six.moves.urllib_parse import urlparse
+from threading import RLock
+from urllib3.exceptions import HTTPError, ReadTimeoutError
+
+logger = logging.getLogger(__name__)
+
+GRPC_NOT_FOUND = 5
+GRPC_UNAUTHENTICATED = 16
+
+
+class Etcd3Error(DCSError):
+    pass
+
+
+class Etcd3Exception(PatroniException):
+    pass
+
+
+class Etcd3ConnectionFailed(Etcd3Exception):
+    pass
+
+
+class Etcd3ClientError(Etcd3Exception):
+
+    def __init__(self, code, error):
+        super(Etcd3ClientError, self).__init__(error)
+        self.code = code
+
+
+def base64_encode(value):
+    return base64.b64encode(value.encode('utf-8')).decode('utf-8')
+
+
+def base64_decode(value):
+    return base64.b64decode(value).decode('utf-8')
+
+
+def prefix_range_end(prefix):
+    """:returns: the key following all keys starting with `prefix`, used as `range_end` of prefix requests"""
+    prefix = bytearray(prefix.encode('utf-8'))
+    for i in range(len(prefix) - 1, -1, -1):
+        if prefix[i] < 0xff:
+            prefix[i] += 1
+            return base64.b64encode(bytes(prefix[:i + 1])).decode('utf-8')
+    return base64_encode('\0')
+
+
+class Etcd3Client(object):
+
+    """Minimalistic client of the etcd v3 JSON gateway (grpc-gateway), which is available on the
+    client port of every etcd server starting from v3.2. It doesn't require grpc and tries all
+    configured endpoints one by one on connection errors."""
+
+    def __init__(self, config, read_timeout):
+        self._endpoints = self.get_endpoints(config)
+        if not self._endpoints:
+            raise Etcd3Exception('Neither hosts, host nor url are defined in etcd3 section of config')
+        self._base_uri = self._endpoints[0]
+        self._api_prefix = None
+        # The client is used by the HA loop and by background threads (i.e. asynchronous member updates). Requests
+        # are executed concurrently, the lock protects only switching of the endpoint and the auth token.
+        self._lock = RLock()
+        self._username = config.get('username')
+        self._password = config.get('password')
+        self._token = None
+        self.read_timeout = read_timeout
+
+        kwargs = {'num_pools': 10, 'maxsize': 10}
+        if config.get('cacert'):
+            kwargs.update(cert_reqs='CERT_REQUIRED', ca_certs=config['cacert'])
+        if config.get('cert'):
+            kwargs['cert_file'] = config['cert']
+            if config.get('key'):
+                kwargs['key_file'] = config['key']
+        self._http = urllib3.PoolManager(**kwargs)
+
+    @staticmethod
+    def get_endpoints(config):
+        if 'url' in config:
+            r = urlparse(config['url'])
+            return ['{0}://{1}:{2}'.format(r.scheme, r.hostname, r.port or 2379)]
+
+        protocol = config.get('protocol', 'http')
+        hosts = config.get('hosts') or config.get('host') or []
+        if isinstance(hosts, six.string_types):
+            hosts = hosts.split(',')
+        return ['{0}://{1}:{2}'.format(protocol, *split_host_port(h.strip(), config.get('port', 2379)))
+                for h in hosts if h.strip()]
+
+    @property
+    def _timeout(self):
+        timeout = float(self.read_timeout) / len(self._endpoints)
+        return urllib3.Timeout(connect=min(timeout, 1), read=timeout)
+
+    def _next_endpoint(self):
+        i = self._endpoints.index(self._base_uri) if self._base_uri in self._endpoints else -1
+        self._base_uri = self._endpoints[(i + 1) % len(self._endpoints)]
+        self._api_prefix = self._token = None
+
+    def _urlopen(self, method, path, body=None, timeout=None, **kwargs):
+        headers = {'Content-Type': 'application/json'}
+        if self._token:
+            headers['Authorization'] = self._token
+        body = body if body is None else json.dumps(body, separators=(',', ':'))
+        return self._http.urlopen(method, self._base_uri + path, body=body, headers=headers,
+                                  timeout=timeout or self._timeout, retries=False, **kwargs)
+
+    @staticmethod
+    def _handle_server_response(response):
+        data = response.data.decode('utf-8')
+        try:
+            ret = json.loads(data) if data else {}
+        except (TypeError, ValueError):
+            ret = {'error': data}
+        if response.status != 200:
+            raise Etcd3ClientError(ret.get('code'), ret.get('error') or ret.get('message') or data)
+        return ret
+
+    def _get_api_prefix(self):
+        """The JSON gateway was moving: /v3alpha in 3.2, /v3beta in 3.3 and /v3 since 3.4"""
+        version = self._handle_server_response(self._urlopen('GET', '/version')).get('etcdserver', '')
+        version = tuple(int(v) for v in version.split('.')[:2] if v.isdigit())
+        return '/v3' if version >= (3, 4) else '/v3beta' if version == (3, 3) else '/v3alpha'
+
+    def _authenticate(self):
+        response = self._urlopen('POST', self._api_prefix + '/auth/authenticate',
+                                 {'name': self._username, 'password': self._password})
+        self._token = self._handle_server_response(response).get('token')
+
+    def _execute(self, path, body, timeout, stream):
+        with self._lock:
+            if self._api_prefix is None:
+                self._api_prefix = self._get_api_prefix()
+            if self._username and not self._token:
+                self._authenticate()
+        if stream:
+            response = self._urlopen('POST', self._api_prefix + path, body, timeout, preload_content=False)
+            if response.status != 200:
+                response.read()
+                self._handle_server_response(response)
+            return response
+        return self._handle_server_response(self._urlopen('POST', self._api_prefix + path, body, timeout))
+
+    def call(self, path, body, timeout=None, stream=False):
+        """Execute request trying all known endpoints one by one
+
+        :returns: decoded json response or `urllib3.response.HTTPResponse` if `stream` is `!True`"""
+
+        for _ in range(len(self._endpoints)):
+            try:
+                try:
+                    return self._execute(path, body, timeout, stream)
+                except Etcd3ClientError as e:
+                    if e.code != GRPC_UNAUTHENTICATED or not self._username:
+                        raise
+                    with self._lock:
+                        self._token = None  # the token has expired, authenticate again
+                    return self._execute(path, body, timeout, stream)
+            except (HTTPError, HTTPException, socket.error, socket.timeout) as e:
+                logger.error('Request to etcd server %s failed: %r', self._base_uri, e)
+                with self._lock:
+                    self._next_endpoint()
+        raise Etcd3ConnectionFailed('Failed to execute {0} on all etcd servers'.format(path))
+
+    def watch(self, key, start_revision, timeout, prefix=False):
+        """Watch `key` (or all keys with the `key` prefix) starting from `start_revision`
+
+        :returns: list of the first received events, empty list if `timeout` has expired
+            or `!None` if the `start_revision` was already compacted"""
+
+        request = {'key': base64_encode(key), 'start_revision': start_revision}
+        if prefix:
+            request['range_end'] = prefix_range_end(key)
+        response = self.call('/watch', {'create_request': request}, stream=True,
+                             timeout=urllib3.Timeout(connect=1, read=timeout))
+        try:
+            for line in response:
+                result = json.loads(line.decode('utf-8')).get('result', {})
+                if result.get('compact_revision'):
+                    return None
+                if result.get('events'):
+                    return result['events']
+        except (ReadTimeoutError, socket.timeout):
+            pass
+        except HTTPError as e:  # urllib3 wraps socket errors happened while reading the response
+            if not any(isinstance(arg, socket.timeout) for arg in e.args):
+                raise
+        finally:
+            response.close()  # the server never closes the watch stream itself
+        return []
+
+
+class Etcd3(AbstractDCS):
+
+    """etcd v3 API based implementation. All keys of this node (the member key and the leader key)
+    are attached to a single lease, therefore one keepalive request refreshes all of them."""
+
+    _SUPPORTS_PREFIX_WATCH = True
+
+    def __init__(self, config):
+        super(Etcd3, self).__init__(config)
+        self._ttl = int(config.get('ttl') or 30)
+        self._retry = Retry(deadline=config['retry_timeout'], max_delay=1, max_tries=-1,
+                            retry_exceptions=Etcd3ConnectionFailed)
+        self._client = Etcd3Client(config, config['retry_timeout'])
+        self.__do_not_watch = False
+        self._has_failed = False
+        # The lease is used by the HA loop and by the background thread writing the member key (touch_member),
+        # the lock protects granting, refreshing and resetting of it.
+        self._lease_lock = RLock()
+        self._lease = None
+        self._lease_ttl = None
+        self._lease_refreshed = 0
+        self._leader_lease = None  # the lease the leader key was attached to by us
+        self._leader_revision = None  # mod_revision of the leader key written by us
+        self._cluster_revision = None
+        self._prefix_watch_revision = None
+
+    def retry(self, *args, **kwargs):
+        return self._retry.copy()(*args, **kwargs)
+
+    def _handle_exception(self, e, name='', do_sleep=False, raise_ex=None):
+        if not self._has_failed:
+            logger.exception(name)
+        else:
+            logger.error(e)
+            if do_sleep:
+                time.sleep(1)
+        self._has_failed = True
+        if isinstance(raise_ex, Exception):
+            raise raise_ex
+
+    def catch_etcd3_errors(func):
+        def wrapper(self, *args, **kwargs):
+            try:
+                retval = func(self, *args, **kwargs) is not None
+                self._has_failed = False
+                return retval
+            except (RetryFailedError, Etcd3Exception) as e:
+                if isinstance(e, Etcd3ClientError) and e.code == GRPC_NOT_FOUND:
+                    with self._lease_lock:
+                        self._lease = None  # our lease doesn't exist anymore
+                self._handle_exception(e)
+                return False
+            except Exception as e:
+                self._handle_exception(e, raise_ex=Etcd3Error('unexpected error'))
+
+        return wrapper
+
+    def set_ttl(self, ttl):
+        ttl = int(ttl)
+        self.__do_not_watch = self._ttl != ttl
+        self._ttl = ttl
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    def set_retry_timeout(self, retry_timeout):
+        self._retry.deadline = retry_timeout
+        self._client.read_timeout = retry_timeout
+
+    @staticmethod
+    def _put_request(key, value, lease=None):
+        ret = {'key': base64_encode(key), 'value': base64_encode(value)}
+        if lease:
+            ret['lease'] = lease
+        return {'request_put': ret}
+
+    @staticmethod
+    def _compare(key, target, **value):
+        """:param target: one of `VALUE`, `MOD` or `CREATE`, `value` must contain the field to compare with"""
+        value = {k: base64_encode(v) if k == 'value' else v for k, v in value.items()}
+        return dict(value, key=base64_encode(key), target=target, result='EQUAL')
+
+    def _range(self, key, prefix=False, **kwargs):
+        request = dict(kwargs, key=base64_encode(key))
+        if prefix:
+            request['range_end'] = prefix_range_end(key)
+        return self._client.call('/kv/range', request)
+
+    def _put(self, key, value, lease=None):
+        return self._client.call('/kv/put', self._put_request(key, value, lease)['request_put'])
+
+    def _delete(self, key, prefix=False):
+        request = {'key': base64_encode(key)}
+        if prefix:
+            request['range_end'] = prefix_range_end(key)
+        return self._client.call('/kv/deleterange', request)
+
+    def _txn(self, compare, success):
+        """:returns: the response if the transaction succeeded, otherwise `!None`"""
+        response = self._client.call('/kv/txn', {'compare': compare, 'success': success})
+        return response if response.get('succeeded') else None
+
+    def _write(self, key, value, index=None):
+        """Compare-and-swap write if `index` (mod_revision) is given, otherwise plain put"""
+        if index:
+            return self._txn([self._compare(key, 'MOD', mod_revision=index)], [self._put_request(key, value)])
+        return self._put(key, value)
+
+    def _get_lease(self):
+        """:returns: ID of the lease of this node, a new one is granted if it doesn't exist or `ttl` was changed"""
+
+        with self._lease_lock:
+            if not self._lease or self._lease_ttl != self._ttl:
+                self._lease = self.retry(self._client.call, '/lease/grant', {'TTL': self._ttl})['ID']
+                self._lease_ttl, self._lease_refreshed = self._ttl, time.time()
+                self._set_cached_member(None)  # the member key must be attached to the new lease
+            return self._lease
+
+    def _refresh_lease(self, force=False):
+        """Keep alive the lease. Unless `force` is set it is done not more often than once per HA cycle.
+
+        :returns: `!False` if the lease has expired and all keys attached to it are gone"""
+
+        with self._lease_lock:
+            if not self._lease or self._lease_ttl != self._ttl:
+                return False
+            now = time.time()
+            if not force and now - self._lease_refreshed < self._loop_wait / 2.0:
+                return True
+            result = self.retry(self._client.call, '/lease/keepalive', {'ID': self._lease}).get('result', {})
+            if int(result.get('TTL', 0)) <= 0:
+                logger.warning('Lease %s has expired', self._lease)
+                self._lease = None
+                return False
+            self._lease_refreshed = now  # the lease can't expire earlier than `ttl` seconds after the request
+            return True
+
+    def _refreshed_lease(self, force=False):
+        """:returns: ID of the lease of this node after keeping it alive, a new one is granted if it has expired"""
+        with self._lease_lock:
+            if not self._refresh_lease(force):
+                self._get_lease()
+            return self._lease
+
+    @staticmethod
+    def _revision(response):
+        return int(response.get('header', {}).get('revision', 0)) or None
+
+    def _load_cluster(self):
+        cluster = None
+        try:
+            path = self.client_path('')
+            result = self.retry(self._range, path, prefix=True)
+            self._cluster_revision = int(result['header']['revision'])
+            nodes = {}
+            for kv in result.get('kvs', []):
+                kv.update(value=base64_decode(kv.get('value', '')), mod_revision=int(kv['mod_revision']))
+                nodes[base64_decode(kv['key'])[len(path):]] = kv
+
+            if not nodes:
+                return Cluster(None, None, None, None, [], None, None, None)
+
+            # get initialize flag
+            initialize = nodes.get(self._INITIALIZE)
+            initialize = initialize and initialize['value']
+
+            # get global dynamic configuration
+            config = nodes.get(self._CONFIG)
+            config = config and ClusterConfig.from_node(config['mod_revision'], config['value'])
+
+            # get timeline history
+            history = nodes.get(self._HISTORY)
+            history = history and TimelineHistory.from_node(history['mod_revision'], history['value'])
+
+            # get last leader operation
+            last_leader_operation = nodes.get(self._LEADER_OPTIME)
+            last_leader_operation = 0 if last_leader_operation is None else int(last_leader_operation['value'])
+
+            # get list of members
+            members = [Member.from_node(n['mod_revision'], os.path.basename(k), n.get('lease'), n['value'])
+                       for k, n in nodes.items() if k.startswith(self._MEMBERS) and k.count('/') == 1]
+
+            # get leader
+            leader = nodes.get(self._LEADER)
+            if leader:
+                member = Member(-1, leader['value'], None, {})
+                member = ([m for m in members if m.name == leader['value']] or [member])[0]
+                leader = Leader(leader['mod_revision'], leader.get('lease'), member)
+
+            # failover key
+            failover = nodes.get(self._FAILOVER)
+            if failover:
+                failover = Failover.from_node(failover['mod_revision'], failover['value'])
+
+            # get synchronization state
+            sync = nodes.get(self._SYNC)
+            sync = SyncState.from_node(sync and sync['mod_revision'], sync and sync['value'])
+
+            cluster = Cluster(initialize, config, leader, last_leader_operation, members, failover, sync, history)
+        except Exception as e:
+            self._handle_exception(e, 'get_cluster', raise_ex=Etcd3Error('Etcd is not responding properly'))
+        self._has_failed = False
+        return cluster
+
+    @catch_etcd3_errors
+    def touch_member(self, data, permanent=False):
+        lease = None if permanent else self._refreshed_lease()
+
+        cluster = self.cluster
+        member = cluster and cluster.get_member(self._name, fallback_to_leader=False)
+        if not permanent and member and self._cached_member(data)[0]:
+            return True
+
+        self._set_cached_member(None)
+        self._put(self.member_path, json.dumps(data, separators=(',', ':')), lease)
+        with self._lease_lock:
+            # if the HA loop has granted a new lease meanwhile the key must be written again, attached to it
+            if lease == self._lease:
+                self._set_cached_member(data)
+        return True
+
+    @catch_etcd3_errors
+    def take_leader(self):
+        lease = self._get_lease()
+        ret = self.retry(self._put, self.leader_path, self._name, lease)
+        self._leader_lease, self._leader_revision = lease, self._revision(ret)
+        return ret
+
+    def attempt_to_acquire_leader(self, permanent=False):
+        lease = None
+        try:
+            if not permanent:
+                lease = self._get_lease()
+            ret = self.retry(self._txn, [self._compare(self.leader_path, 'CREATE', create_revision=0)],
+                             [self._put_request(self.leader_path, self._name, lease)])
+            if ret:
+                self._leader_lease, self._leader_revision = lease, self._revision(ret)
+                return True
+            logger.info('Could not take out TTL lock')
+        except (RetryFailedError, Etcd3Exception) as e:
+            if isinstance(e, Etcd3ClientError) and e.code == GRPC_NOT_FOUND:
+                with self._lease_lock:
+                    if self._lease == lease:
+                        self._lease = None
+        return False
+
+    @catch_etcd3_errors
+    def set_failover_value(self, value, index=None):
+        return self._write(self.failover_path, value, index)
+
+    @catch_etcd3_errors
+    def set_config_value(self, value, index=None):
+        return self._write(self.config_path, value, index)
+
+    @catch_etcd3_errors
+    def _write_leader_optime(self, last_operation):
+        return self._put(self.leader_optime_path, str(last_operation))
+
+    @catch_etcd3_errors
+    def _update_leader(self):
+        # the keepalive is always sent, the caller assumes that the lock will not expire earlier than in `ttl`
+        lease = self._refreshed_lease(force=True)
+
+        # the leader key must belong to us and must not have been rewritten since we wrote it
+        compare = [self._compare(self.leader_path, 'VALUE', value=self._name)]
+        revision = self._leader_revision
+        if not revision:
+            cluster = self.cluster
+            if cluster and isinstance(cluster.leader, Leader) and cluster.leader.name == self._name:
+                revision = cluster.leader.index
+        if revision:
+            compare.append(self._compare(self.leader_path, 'MOD', mod_revision=revision))
+
+        # the leader key is still attached to our lease, otherwise it is attached to the new one
+        success = [] if self._leader_lease == lease else [self._put_request(self.leader_path, self._name, lease)]
+        ret = self.retry(self._txn, compare, success)
+        if ret:
+            self._leader_lease = lease
+            if success:
+                self._leader_revision = self._revision(ret)
+            elif not self._leader_revision:
+                self._leader_revision = revision
+        return ret
+
+    @catch_etcd3_errors
+    def initialize(self, create_new=True, sysid=""):
+        compare = [dict(self._compare(self.initialize_path, 'CREATE', create_revision=0),
+                        result='EQUAL' if create_new else 'GREATER')]
+        return self.retry(self._txn, compare, [self._put_request(self.initialize_path, sysid)])
+
+    @catch_etcd3_errors
+    def delete_leader(self):
+        self._leader_lease = self._leader_revision = None
+        return self._txn([self._compare(self.leader_path, 'VALUE', value=self._name)],
+                         [{'request_delete_range': {'key': base64_encode(self.leader_path)}}])
+
+    @catch_etcd3_errors
+    def cancel_initialization(self):
+        return self.retry(self._delete, self.initialize_path)
+
+    @catch_etcd3_errors
+    def delete_cluster(self):
+        return self.retry(self._delete, self.client_path(''), prefix=True)
+
+    @catch_etcd3_errors
+    def set_history_value(self, value):
+        return self._put(self.history_path, value)
+
+    @catch_etcd3_errors
+    def set_sync_state_value(self, value, index=None):
+        return self.retry(self._write, self.sync_path, value, index)
+
+    @catch_etcd3_errors
+    def delete_sync_state(self, index=None):
+        request = {'request_delete_range': {'key': base64_encode(self.sync_path)}}
+        if index:
+            return self.retry(self._txn, [self._compare(self.sync_path, 'MOD', mod_revision=index)], [request])
+        return self.retry(self._delete, self.sync_path)
+
+    def watch(self, leader_index, timeout):
+        if self.__do_not_watch:
+            self.__do_not_watch = False
+            return True
+
+        if leader_index and self._cluster_revision and not self._watch_prefix:
+            end_time = time.time() + timeout
+
+            while timeout >= 1:  # when timeout is too small urllib3 doesn't have enough time to connect
+                try:
+                    events = self._client.watch(self.leader_path, self._cluster_revision + 1, timeout)
+                    self._has_failed = False
+                    # `None` means that the revision was compacted, the cluster must be reloaded anyway
+                    return events is None or bool(events)
+                except Etcd3Exception as e:
+                    self._handle_exception(e, 'watch', True)
+
+                timeout = end_time - time.time()
+
+        try:
+            return super(Etcd3, self).watch(leader_index, timeout)
+        finally:
+            self.event.clear()
+
+    def _watch_prefix_changes(self, timeout):
+        path = self.client_path('')
+        if self._prefix_watch_revision is None:
+            revision = self._cluster_revision or int(self._range(path, True, count_only=True)['header']['revision'])
+            self._prefix_watch_revision = revision + 1
+
+        events = self._client.watch(path, self._prefix_watch_revision, timeout, prefix=True)
+        if events is None:  # the revision was compacted, we have missed some events
+            self._prefix_watch_revision = self._cluster_revision = None
+            return ['*']
+        if events:
+            self._prefix_watch_revision = max(int(e['kv']['mod_revision']) for e in events) + 1
+        return [base64_decode(e['kv']['key'])[len(path):] for e in events]
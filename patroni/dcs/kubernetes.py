@@ -7,10 +7,12 @@ import socket
 import sys
 import time
 
+from collections import namedtuple
 from kubernetes import client as k8s_client, config as k8s_config, watch as k8s_watch
 from patroni.dcs import AbstractDCS, ClusterConfig, Cluster, Failover, Leader, Member, SyncState, TimelineHistory
 from patroni.exceptions import DCSError
-from patroni.utils import deep_compare, tzutc, Retry, RetryFailedError
+from patroni.utils import deep_compare, parse_bool, tzutc, Retry, RetryFailedError
+from threading import Lock, Thread
 from urllib3.exceptions import HTTPError
 from six.moves.http_client import HTTPException
 
@@ -70,8 +72,117 @@ def catch_kubernetes_errors(func):
     return wrapper
 
 
+def _resource_version_is_newer(old, new):
+    try:
+        return int(new.metadata.resource_version) >= int(old.metadata.resource_version)
+    except (TypeError, ValueError):
+        return True  # resourceVersion is supposed to be opaque, in doubt trust the latest update
+
+
+class ObjectCache(Thread):
+
+    """Informer-style local cache of the objects labeled with the cluster labels.
+
+    The objects are listed once and the cache is kept up to date by the watch stream,
+    which is resumed from the last seen resourceVersion. The full list is repeated only
+    when Kubernetes API reports that the resourceVersion is too old (410 Gone)."""
+
+    _Response = namedtuple('_Response', 'data')
+
+    def __init__(self, dcs, func, return_type):
+        super(ObjectCache, self).__init__()
+        self.daemon = True
+        self._dcs = dcs
+        self._func = func
+        self._return_type = return_type
+        self._api_client = k8s_client.ApiClient()
+        self._object_cache = {}
+        self._object_cache_lock = Lock()
+        self._resource_version = None
+        self._is_ready = False
+        self.start()
+
+    def get(self):
+        """:returns: tuple (resourceVersion, {name: object}) or `None` if the cache is not ready yet"""
+        with self._object_cache_lock:
+            return (self._resource_version, dict(self._object_cache)) if self._is_ready else None
+
+    def set(self, obj):
+        with self._object_cache_lock:
+            name = obj.metadata.name
+            old = self._object_cache.get(name)
+            if not old or _resource_version_is_newer(old, obj):
+                self._object_cache[name] = obj
+
+    def delete(self, name):
+        with self._object_cache_lock:
+            self._object_cache.pop(name, None)
+
+    def _list(self):
+        response = self._dcs.retry(self._func, self._dcs.namespace, label_selector=self._dcs.label_selector)
+        with self._object_cache_lock:
+            self._object_cache = {item.metadata.name: item for item in response.items}
+            self._resource_version = response.metadata.resource_version
+            self._is_ready = True
+
+    def _relist(self):
+        logger.info('resourceVersion %s of %s is too old, relisting', self._resource_version, self._return_type)
+        with self._object_cache_lock:
+            self._resource_version = None
+
+    def _process_event(self, event):
+        raw_object = event['raw_object']
+        if event['type'] == 'ERROR':
+            if raw_object.get('code') == 410:
+                return self._relist()
+            raise KubernetesError(raw_object.get('message'))
+
+        obj = self._api_client.deserialize(self._Response(json.dumps(raw_object)), self._return_type)
+        if event['type'] == 'DELETED':
+            self.delete(obj.metadata.name)
+        else:
+            self.set(obj)
+        with self._object_cache_lock:
+            self._resource_version = obj.metadata.resource_version
+            self._is_ready = True
+
+    def _watch(self):
+        timeout = max(self._dcs.loop_wait, 1)
+        for event in k8s_watch.Watch().stream(self._func, self._dcs.namespace, label_selector=self._dcs.label_selector,
+                                              resource_version=self._resource_version, timeout_seconds=timeout,
+                                              _request_timeout=(1, timeout + 1)):
+            self._process_event(event)
+            if self._resource_version is None:
+                return
+        with self._object_cache_lock:
+            self._is_ready = True
+
+    def run(self):
+        while True:
+            try:
+                if self._resource_version is None:
+                    self._list()
+                self._watch()
+            except k8s_client.rest.ApiException as e:
+                if e.status == 410:
+                    self._relist()
+                else:
+                    self._failed(e)
+            except Exception as e:
+                self._failed(e)
+
+    def _failed(self, e):
+        # until the watch is resumed the readers should fall back to the API, the cache might be stale
+        with self._object_cache_lock:
+            self._is_ready = False
+        logger.error('ObjectCache(%s): %r', self._return_type, e)
+        time.sleep(1)
+
+
 class Kubernetes(AbstractDCS):
 
+    _SUPPORTS_PREFIX_WATCH = True
+
     def __init__(self, config):
         self._labels = config['labels']
         self._labels[config.get('scope_label', 'cluster-name')] = config['scope']
@@ -108,7 +219,19 @@ class Kubernetes(AbstractDCS):
         self._leader_resource_version = None
         self._leader_observed_subsets = []
         self._config_resource_version = None
+        self._kinds_resource_version = None  # resourceVersion of the last list of the cluster objects
+        self._prefix_watch_index = None
         self.__do_not_watch = False
+        self._use_cache = not self._ctl and parse_bool(config.get('use_cache', False))
+        self._pods = self._kinds = None
+
+    @property
+    def namespace(self):
+        return self._namespace
+
+    @property
+    def label_selector(self):
+        return self._label_selector
 
     def retry(self, *args, **kwargs):
         return self._retry.copy()(*args, **kwargs)
@@ -140,14 +263,37 @@ class Kubernetes(AbstractDCS):
         member.data['pod_labels'] = pod.metadata.labels
         return member
 
+    def _start_cache(self):
+        kind = 'V1Endpoints' if self.__subsets else 'V1ConfigMap'
+        self._pods = ObjectCache(self, self._api.list_namespaced_pod, 'V1Pod')
+        self._kinds = ObjectCache(self, self._api.list_namespaced_kind, kind)
+
+    def _list_objects(self):
+        """:returns: tuple (pods, resourceVersion of the cluster objects, {name: object})"""
+        if self._use_cache:
+            if not self._kinds:
+                self._start_cache()
+            pods, kinds = self._pods.get(), self._kinds.get()
+            if pods and kinds:
+                return list(pods[1].values()), kinds[0], kinds[1]
+
+        # the cache is not enabled or not populated yet
+        response = self.retry(self._api.list_namespaced_pod, self._namespace, label_selector=self._label_selector)
+        pods = response.items
+        response = self.retry(self._api.list_namespaced_kind, self._namespace, label_selector=self._label_selector)
+        return pods, response.metadata.resource_version, {item.metadata.name: item for item in response.items}
+
+    def _update_cache(self, cache, obj):
+        if cache and isinstance(obj, (k8s_client.V1Pod, k8s_client.V1ConfigMap, k8s_client.V1Endpoints)):
+            cache.set(obj)
+
     def _load_cluster(self):
         try:
+            pods, resource_version, nodes = self._list_objects()
             # get list of members
-            response = self.retry(self._api.list_namespaced_pod, self._namespace, label_selector=self._label_selector)
-            members = [self.member(pod) for pod in response.items]
+            members = [self.member(pod) for pod in pods]
 
-            response = self.retry(self._api.list_namespaced_kind, self._namespace, label_selector=self._label_selector)
-            nodes = {item.metadata.name: item for item in response.items}
+            self._kinds_resource_version = resource_version
 
             config = nodes.get(self.config_path)
             metadata = config and config.metadata
@@ -195,7 +341,7 @@ class Kubernetes(AbstractDCS):
             if metadata:
                 member = Member(-1, leader, None, {})
                 member = ([m for m in members if m.name == leader] or [member])[0]
-                leader = Leader(response.metadata.resource_version, None, member)
+                leader = Leader(resource_version, None, member)
 
             # failover key
             failover = nodes.get(self.failover_path)
@@ -279,7 +425,9 @@ class Kubernetes(AbstractDCS):
             body = k8s_client.V1Endpoints(**endpoints)
         else:
             body = k8s_client.V1ConfigMap(metadata=metadata)
-        return self.retry(func, self._namespace, body) if retry else func(self._namespace, body)
+        ret = self.retry(func, self._namespace, body) if retry else func(self._namespace, body)
+        self._update_cache(self._kinds, ret)
+        return ret
 
     def patch_or_create_config(self, annotations, resource_version=None, patch=False, retry=True):
         # SCOPE-config endpoint requires corresponding service otherwise it might be "cleaned" by k8s master
@@ -379,6 +527,7 @@ class Kubernetes(AbstractDCS):
                         'annotations': {'status': json.dumps(data, separators=(',', ':'))}}
             body = k8s_client.V1Pod(metadata=k8s_client.V1ObjectMeta(**metadata))
             ret = self._api.patch_namespaced_pod(self._name, self._namespace, body)
+            self._update_cache(self._pods, ret)
         if self.__subsets and self._should_create_config_service:
             self._create_config_service()
         return ret
@@ -417,7 +566,7 @@ class Kubernetes(AbstractDCS):
             self.__do_not_watch = False
             return True
 
-        if leader_index:
+        if leader_index and not self._watch_prefix:
             end_time = time.time() + timeout
             w = k8s_watch.Watch()
             while timeout >= 1:
@@ -436,6 +585,22 @@ class Kubernetes(AbstractDCS):
                 timeout = end_time - time.time()
 
         try:
-            return super(Kubernetes, self).watch(None, timeout)
+            return super(Kubernetes, self).watch(leader_index, timeout)
         finally:
             self.event.clear()
+
+    def _watch_prefix_changes(self, timeout):
+        # members are pods, they are not watched, all other keys are mapped to objects labeled with the cluster labels
+        keys = {self.leader_path: self._LEADER, self.config_path: self._CONFIG,
+                self.failover_path: self._FAILOVER, self.sync_path: self._SYNC}
+        resource_version = self._prefix_watch_index or self._kinds_resource_version
+        for event in k8s_watch.Watch().stream(self._api.list_namespaced_kind, self._namespace,
+                                              label_selector=self._label_selector, resource_version=resource_version,
+                                              timeout_seconds=int(timeout), _request_timeout=(1, timeout + 1)):
+            metadata = event['raw_object'].get('metadata', {})
+            if event['type'] == 'ERROR':  # most likely 410 Gone, we have missed some events
+                self._prefix_watch_index = self._kinds_resource_version = None
+                return ['*']
+            self._prefix_watch_index = metadata.get('resourceVersion')
+            return [keys.get(metadata.get('name'), metadata.get('name'))]
+        return []
@@ -9,6 +9,7 @@ from kazoo.handlers.threading import SequentialThreadingHandler
 from patroni.dcs import AbstractDCS, ClusterConfig, Cluster, Failover, Leader, Member, SyncState, TimelineHistory
 from patroni.exceptions import DCSError
 from patroni.utils import deep_compare
+from threading import Lock
 
 logger = logging.getLogger(__name__)
 
@@ -71,6 +72,12 @@ class ZooKeeper(AbstractDCS):
 
         self._fetch_cluster = True
 
+        # member znodes are cached and re-read only after their data watch has fired
+        self._members_cache = {}
+        self._members_cache_lock = Lock()
+        self._changed_members = set()
+        self._sync_standby = None
+
         self._orig_kazoo_connect = self._client._connection._connect
         self._client._connection._connect = self._kazoo_connect
 
@@ -93,8 +100,18 @@ class ZooKeeper(AbstractDCS):
 
     def session_listener(self, state):
         if state in [KazooState.SUSPENDED, KazooState.LOST]:
+            with self._members_cache_lock:  # watches might be lost together with the session
+                self._members_cache.clear()
             self.cluster_watcher(None)
 
+    def member_watcher(self, event):
+        name = event.path[len(self.members_path):]
+        with self._members_cache_lock:
+            self._members_cache.pop(name, None)
+            self._changed_members.add(name)
+        if name == self._sync_standby:
+            self.cluster_watcher(event)
+
     def cluster_watcher(self, event):
         self._fetch_cluster = True
         self.event.set()
@@ -152,13 +169,33 @@ class ZooKeeper(AbstractDCS):
             return []
 
     def load_members(self, sync_standby):
-        members = []
-        for member in self.get_children(self.members_path, self.cluster_watcher):
-            watch = member == sync_standby and self.cluster_watcher or None
-            data = self.get_node(self.members_path + member, watch)
-            if data is not None:
-                members.append(self.member(member, *data))
-        return members
+        """Only members which are not in the cache are read, all requests are sent at once.
+
+        :returns: list of `Member` objects"""
+
+        self._sync_standby = sync_standby
+        names = self.get_children(self.members_path, self.cluster_watcher)
+        with self._members_cache_lock:
+            self._changed_members.clear()
+            for name in set(self._members_cache) - set(names):
+                del self._members_cache[name]
+            members = dict(self._members_cache)
+
+        requests = [(name, self._client.get_async(self.members_path + name, self.member_watcher))
+                    for name in names if name not in members]
+        for name, request in requests:
+            try:
+                data, znode = request.get()
+            except NoNodeError:
+                continue
+            members[name] = self.member(name, data.decode('utf-8'), znode)
+
+        with self._members_cache_lock:
+            for name, _ in requests:
+                # the znode might have been changed after it was read, it will be read again next time
+                if name in members and name not in self._changed_members:
+                    self._members_cache[name] = members[name]
+        return [members[name] for name in names if name in members]
 
     def _inner_load_cluster(self):
         self._fetch_cluster = False
@@ -284,19 +321,23 @@ class ZooKeeper(AbstractDCS):
             member = None
 
         if member:
-            if deep_compare(data, member.data):
+            if self._cached_member(data)[0] or deep_compare(data, member.data):
                 return True
         else:
+            self._set_cached_member(None)
             try:
                 self._client.create_async(self.member_path, encoded_data, makepath=True,
                                           ephemeral=not permanent).get(timeout=1)
+                self._set_cached_member(data)
                 return True
             except Exception as e:
                 if not isinstance(e, NodeExistsError):
                     logger.exception('touch_member')
                     return False
+        self._set_cached_member(None)
         try:
             self._client.set_async(self.member_path, encoded_data).get(timeout=1)
+            self._set_cached_member(data)
             return True
         except Exception:
             logger.exception('touch_member')
@@ -3,22 +3,27 @@ import functools
 import json
 import logging
 import psycopg2
-import requests
 import sys
 import time
 import uuid
 
 from collections import namedtuple
+from contextlib import closing
 from multiprocessing.pool import ThreadPool
-from patroni.async_executor import AsyncExecutor, CriticalTask
+from patroni.async_executor import AsyncExecutor, CriticalTask, DCSWriteScheduler
 from patroni.exceptions import DCSError, PostgresConnectionException, PatroniException
+from patroni.metrics import CycleTimings, DCS_OPERATION_SECONDS, DEMOTIONS, HA_CYCLE_SECONDS, LEADER_LOCK_LOSSES
 from patroni.postgresql import ACTION_ON_START, ACTION_ON_ROLE_CHANGE
-from patroni.utils import polling_loop, tzutc
+from patroni.request import MemberConnectionPools, MemberStatusCache
+from patroni.utils import parse_bool, polling_loop, tzutc
 from patroni.dcs import RemoteMember
-from threading import RLock
+from threading import Event, Lock, RLock
 
 logger = logging.getLogger(__name__)
 
+# Upper limit on the number of threads used to fetch statuses of other members in parallel
+MAX_STATUS_FETCH_WORKERS = 10
+
 
 class _MemberStatus(namedtuple('_MemberStatus', ['member', 'reachable', 'in_recovery', 'timeline',
                                                  'wal_position', 'tags', 'watchdog_failed'])):
@@ -73,13 +78,33 @@ class Ha(object):
         self._start_timeout = None
         self._async_executor = AsyncExecutor(self.state_handler, self.wakeup)
         self.watchdog = patroni.watchdog
+        # Keep-alive connections to REST API of other members, used to fetch their statuses
+        self._member_pools = MemberConnectionPools(timeout=2)
+        # Long-lived bounded pool of threads executing these requests, created on first use, stopped by shutdown()
+        self._fetch_pool = None
+        self._fetch_pool_lock = Lock()
+        # Statuses pushed by other members via `/status_stream`, used instead of polling when enabled
+        self._status_cache = MemberStatusCache()
         # TODO(lukedirtwalker): consider: instead of this, handle this in consul by setting _session
         # = "y" when losing cluster connection.
         self._dcs_failed = False
+        # Time of the last HA cycle which didn't fail to talk to DCS
+        self._last_cycle_time = time.time()
+        # Breakdown of the wall time of recent HA cycles
+        self.cycle_timings = CycleTimings()
 
         # Each member publishes various pieces of information to the DCS using touch_member. This lock protects
         # the state and publishing procedure to have consistent ordering and avoid publishing stale values.
         self._member_state_lock = RLock()
+        # Sequence number of the last member data prepared for publishing and of the last one which was published.
+        # The latter is protected by _member_publish_lock, which is held while the member key is being written.
+        self._member_data_seq = self._published_member_seq = 0
+        self._member_publish_lock = Lock()
+        # Background writer of the member key, used when `async_member_updates` is enabled
+        self._dcs_writes = DCSWriteScheduler()
+        # Role, state, timeline and xlog_location published by the last touch_member together with the time
+        # the position was taken, used to rate-limit publishing of the constantly moving WAL position.
+        self._published_wal = None
         # Count of concurrent sync disabling requests. Value above zero means that we don't want to be synchronous
         # standby. Changes protected by _member_state_lock.
         self._disable_sync = 0
@@ -117,16 +142,27 @@ class Ha(object):
         with self._is_leader_lock:
             return self._is_leader > time.time() and not self._leader_access_is_restricted
 
-    def set_is_leader(self, value):
+    def set_is_leader(self, value, updated_at=None):
+        """:param updated_at: the time when the request updating the leader lock was sent, the lock
+            can't expire earlier than `ttl` seconds after it"""
+        with self._is_leader_lock:
+            self._is_leader = (updated_at or time.time()) + self.dcs.ttl if value else 0
+
+    def lock_expires_in(self):
+        """:returns: number of seconds left till the expiration of the leader lock held by this node or `None`"""
         with self._is_leader_lock:
-            self._is_leader = time.time() + self.dcs.ttl if value else 0
+            return self._is_leader - time.time() if self._is_leader else None
 
     def set_leader_access_is_restricted(self, value):
         with self._is_leader_lock:
             self._leader_access_is_restricted = value
 
+    def _time_dcs_operation(self, operation):
+        return DCS_OPERATION_SECONDS.time(backend=self.dcs.__class__.__name__.lower(), operation=operation)
+
     def load_cluster_from_dcs(self):
-        cluster = self.dcs.get_cluster()
+        with self._time_dcs_operation('get_cluster'):
+            cluster = self.dcs.get_cluster()
 
         # We want to keep the state of cluster when it was healthy
         if not cluster.is_unlocked() or not self.old_cluster:
@@ -138,10 +174,22 @@ class Ha(object):
 
         self._leader_timeline = None if cluster.is_unlocked() else cluster.leader.timeline
 
+        # forget connection pools of members which disappeared from DCS
+        self._member_pools.prune([m.name for m in cluster.members + self.old_cluster.members])
+
+        restapi = self.patroni.config.get('restapi', {})
+        if parse_bool(restapi.get('use_status_stream')):
+            members = [m for m in cluster.members if m.name != self.state_handler.name and m.api_url]
+            self._status_cache.set_members(members, float(restapi.get('status_stream_interval') or 1))
+        else:
+            self._status_cache.set_members([])
+
     def acquire_lock(self):
         self.set_leader_access_is_restricted(self.cluster.has_permanent_logical_slots(self.state_handler.name))
-        ret = self.dcs.attempt_to_acquire_leader()
-        self.set_is_leader(ret)
+        updated_at = time.time()
+        with self._time_dcs_operation('attempt_to_acquire_leader'):
+            ret = self.dcs.attempt_to_acquire_leader()
+        self.set_is_leader(ret, updated_at)
         return ret
 
     def update_lock(self, write_leader_optime=False):
@@ -151,12 +199,33 @@ class Ha(object):
                 last_operation = self.state_handler.last_operation()
             except Exception:
                 logger.exception('Exception when called state_handler.last_operation()')
-        ret = self.dcs.update_leader(last_operation, self._leader_access_is_restricted)
-        self.set_is_leader(ret)
+        updated_at = time.time()
+        # pending member key writes are not started while the leader lock is being refreshed, the member key write
+        # which is already running is given time to finish, but only as long as it doesn't put the lock at risk
+        expires_in = self.lock_expires_in() or 0
+        wait = max(0, expires_in - self.patroni.config['retry_timeout'])
+        with self._time_dcs_operation('update_leader'), self._dcs_writes.priority(wait):
+            ret = self.dcs.update_leader(last_operation, self._leader_access_is_restricted)
+        self.set_is_leader(ret, updated_at)
         if ret:
             self.watchdog.keepalive()
+        else:
+            LEADER_LOCK_LOSSES.inc()
         return ret
 
+    def renew_lock_if_expiring(self):
+        """Refresh the leader lock in the middle of the HA cycle if it could expire before the next cycle
+        refreshes it, that is in less than `loop_wait` + `retry_timeout` seconds. It might happen if some
+        operation (e.g. replication slots synchronization) took too long.
+
+        :returns: `!True` if the lock was refreshed"""
+
+        expires_in = self.lock_expires_in()
+        if expires_in is None or expires_in >= self.dcs.loop_wait + self.patroni.config['retry_timeout']:
+            return False
+        logger.warning('Leader lock expires in %.3f seconds, renewing it', expires_in)
+        return self.update_lock()
+
     def has_lock(self):
         lock_owner = self.cluster.leader and self.cluster.leader.name
         logger.info('Lock owner: %s; I am %s', lock_owner, self.state_handler.name)
@@ -170,7 +239,40 @@ class Ha(object):
             tags['nosync'] = True
         return tags
 
-    def touch_member(self):
+    def _wal_position_to_publish(self, data):
+        """Changing WAL position makes every member key update unique and they are written on every HA cycle.
+        The position is queried not more often than `xlog_location_min_interval` seconds and republished only
+        if it has moved by at least `xlog_location_min_delta` bytes, unless the role, state or timeline changed.
+
+        :returns: (timeline, wal_position) tuple"""
+
+        config = self.patroni.config
+        min_interval = config.get('xlog_location_min_interval') or 0
+        min_delta = config.get('xlog_location_min_delta') or 0
+        last = self._published_wal
+        same_role = last and last['role'] == data['role'] and last['state'] == data['state']
+        if same_role and time.time() - last['time'] < min_interval:
+            # Checking the timeline is cheap: the timeline of the primary is fetched once per HA cycle anyway
+            # and the timeline of a replica is cached until the timeline of the leader changes.
+            timeline = self.state_handler.get_master_timeline() or \
+                self.state_handler.replica_cached_timeline(self._leader_timeline)
+            if timeline == last['timeline']:
+                return last['timeline'], last['xlog_location']
+
+        timeline, wal_position = self.state_handler.timeline_wal_position()
+        if not timeline:
+            timeline = self.state_handler.replica_cached_timeline(self._leader_timeline)
+        if same_role and last['timeline'] == timeline and abs(wal_position - last['xlog_location']) < min_delta:
+            return timeline, last['xlog_location']
+
+        self._published_wal = {'role': data['role'], 'state': data['state'], 'timeline': timeline,
+                               'xlog_location': wal_position, 'time': time.time()}
+        return timeline, wal_position
+
+    def touch_member(self, wait=True):
+        """:param wait: if `False` and `async_member_updates` is enabled the member key is written
+            by the background thread and the method returns immediately"""
+
         with self._member_state_lock:
             data = {
                 'conn_url': self.state_handler.connection_string,
@@ -190,10 +292,8 @@ class Ha(object):
             if self._async_executor.scheduled_action in (None, 'promote') \
                     and data['state'] in ['running', 'restarting', 'starting']:
                 try:
-                    timeline, wal_position = self.state_handler.timeline_wal_position()
+                    timeline, wal_position = self._wal_position_to_publish(data)
                     data['xlog_location'] = wal_position
-                    if not timeline:
-                        timeline = self.state_handler.replica_cached_timeline(self._leader_timeline)
                     if timeline:
                         data['timeline'] = timeline
                 except Exception:
@@ -206,7 +306,23 @@ class Ha(object):
             if self.is_paused():
                 data['pause'] = True
 
-            return self.dcs.touch_member(data)
+            self._member_data_seq += 1
+            if not wait and self.patroni.config.get('async_member_updates'):
+                # the newer member data supersede the pending write and it has no value after ttl
+                self._dcs_writes.schedule('touch_member', self._publish_member_data,
+                                          (data, self._member_data_seq), timeout=self.dcs.ttl)
+                return True
+
+            self._dcs_writes.cancel('touch_member')
+            return self._publish_member_data(data, self._member_data_seq)
+
+    def _publish_member_data(self, data, seq):
+        with self._member_publish_lock:
+            if seq < self._published_member_seq:  # newer data were already published
+                return True
+            self._published_member_seq = seq
+            with self._time_dcs_operation('touch_member'):
+                return self.dcs.touch_member(data)
 
     def clone(self, clone_member=None, msg='(without leader)'):
         if self.is_standby_cluster() and not isinstance(clone_member, RemoteMember):
@@ -538,26 +654,61 @@ class Ha(object):
                                                args=(self.dcs.loop_wait, self._leader_access_is_restricted))
             return promote_message
 
-    @staticmethod
-    def fetch_node_status(member):
-        """This function perform http get request on member.api_url and fetches its status
+    def fetch_node_status(self, member):
+        """This function perform http get request on member.api_url and fetches its status.
+        Connection to the member is kept open and reused by the next call.
         :returns: `_MemberStatus` object
         """
 
         try:
-            response = requests.get(member.api_url, timeout=2, verify=False)
-            logger.info('Got response from %s %s: %s', member.name, member.api_url, response.content)
-            return _MemberStatus.from_api_response(member, response.json())
+            response = self._member_pools(member)
+            data = response.data.decode('utf-8')
+            logger.info('Got response from %s %s: %s', member.name, member.api_url, data)
+            return _MemberStatus.from_api_response(member, json.loads(data))
         except Exception as e:
             logger.warning("Request failed to %s: GET %s (%s)", member.name, member.api_url, e)
         return _MemberStatus.unknown(member)
 
+    def streamed_nodes_statuses(self, members):
+        """Statuses recently pushed by `members` via `/status_stream`, no requests are made.
+
+        :returns: generator of `_MemberStatus` objects, members without a fresh status are skipped"""
+        for member in members:
+            data = self._status_cache.get(member)
+            if data is not None:
+                try:
+                    yield _MemberStatus.from_api_response(member, data)
+                except Exception as e:
+                    logger.warning('Invalid status streamed by %s: %r (%s)', member.name, data, e)
+
+    def member_connection_stats(self):
+        return self._member_pools.stats()
+
+    def _get_fetch_pool(self):
+        with self._fetch_pool_lock:
+            if self._fetch_pool is None:
+                self._fetch_pool = ThreadPool(MAX_STATUS_FETCH_WORKERS)
+            return self._fetch_pool
+
     def fetch_nodes_statuses(self, members):
-        pool = ThreadPool(len(members))
-        results = pool.map(self.fetch_node_status, members)  # Run API calls on members in parallel
-        pool.close()
-        pool.join()
-        return results
+        """Run API calls on members in parallel using the long-lived pool of worker threads
+
+        :returns: generator of `_MemberStatus` objects in the order they arrive. The caller is free to stop
+            consuming it as soon as the decision is known, without waiting for slow members. When the generator
+            is closed requests which were not yet started are cancelled and reported as unknown."""
+        if not members:
+            return
+
+        cancelled = Event()
+
+        def fetch_node_status(member):
+            return _MemberStatus.unknown(member) if cancelled.is_set() else self.fetch_node_status(member)
+
+        try:
+            for st in self._get_fetch_pool().imap_unordered(fetch_node_status, members):
+                yield st
+        finally:
+            cancelled.set()
 
     def is_lagging(self, wal_position):
         """Returns if instance with an wal should consider itself unhealthy to be promoted due to replication lag.
@@ -586,36 +737,42 @@ class Ha(object):
         # Prepare list of nodes to run check against
         members = [m for m in members if m.name != self.state_handler.name and not m.nofailover and m.api_url]
 
-        if members:
-            for st in self.fetch_nodes_statuses(members):
-                if st.failover_limitation() is None:
-                    if not st.in_recovery:
-                        logger.warning('Master (%s) is still alive', st.member.name)
-                        return False
-                    if my_wal_position < st.wal_position:
-                        logger.info('Wal position of %s is ahead of my wal position', st.member.name)
-                        return False
+        # Statuses are evaluated as they arrive. The first one which disqualifies us decides
+        # the outcome, requests to the remaining members are cancelled when the generator is closed.
+        # Statuses pushed via status streams could be used to disqualify us quickly without making
+        # any requests, but the decision that we are the healthiest node is always made on freshly
+        # polled statuses.
+        for statuses in (self.streamed_nodes_statuses(members), self.fetch_nodes_statuses(members)):
+            with closing(statuses):
+                for st in statuses:
+                    if st.failover_limitation() is None:
+                        if not st.in_recovery:
+                            logger.warning('Master (%s) is still alive', st.member.name)
+                            return False
+                        if my_wal_position < st.wal_position:
+                            logger.info('Wal position of %s is ahead of my wal position', st.member.name)
+                            return False
         return True
 
     def is_failover_possible(self, members):
-        ret = False
         cluster_timeline = self.cluster.timeline
         members = [m for m in members if m.name != self.state_handler.name and not m.nofailover and m.api_url]
         if members:
-            for st in self.fetch_nodes_statuses(members):
-                not_allowed_reason = st.failover_limitation()
-                if not_allowed_reason:
-                    logger.info('Member %s is %s', st.member.name, not_allowed_reason)
-                elif self.is_lagging(st.wal_position):
-                    logger.info('Member %s exceeds maximum replication lag', st.member.name)
-                elif self.check_timeline() and (not st.timeline or st.timeline < cluster_timeline):
-                    logger.info('Timeline %s of member %s is behind the cluster timeline %s',
-                                st.timeline, st.member.name, cluster_timeline)
-                else:
-                    ret = True
+            with closing(self.fetch_nodes_statuses(members)) as statuses:
+                for st in statuses:
+                    not_allowed_reason = st.failover_limitation()
+                    if not_allowed_reason:
+                        logger.info('Member %s is %s', st.member.name, not_allowed_reason)
+                    elif self.is_lagging(st.wal_position):
+                        logger.info('Member %s exceeds maximum replication lag', st.member.name)
+                    elif self.check_timeline() and (not st.timeline or st.timeline < cluster_timeline):
+                        logger.info('Timeline %s of member %s is behind the cluster timeline %s',
+                                    st.timeline, st.member.name, cluster_timeline)
+                    else:
+                        return True  # one healthy candidate is enough, don't wait for the rest
         else:
             logger.warning('manual failover: members list is empty')
-        return ret
+        return False
 
     def manual_failover_process_no_leader(self):
         failover = self.cluster.failover
@@ -730,6 +887,7 @@ class Ha(object):
             'immediate-nolock': dict(stop='immediate', checkpoint=False, release=False, offline=False, async_req=True),
         }[mode]
 
+        DEMOTIONS.inc(mode=mode)
         self.state_handler.trigger_check_diverged_lsn()
         self.state_handler.stop(mode_control['stop'], checkpoint=mode_control['checkpoint'],
                                 on_safepoint=self.watchdog.disable if self.watchdog.is_running else None)
@@ -1189,7 +1347,8 @@ class Ha(object):
         dcs_failed_before = self._dcs_failed
         try:
             self.state_handler.reset_cluster_info_state()
-            self.load_cluster_from_dcs()
+            with self.cycle_timings.phase('load_cluster'):
+                self.load_cluster_from_dcs()
             self._dcs_failed = False
 
             # If the dcs failed before and we were leader, it means our consul node went down, and
@@ -1210,7 +1369,8 @@ class Ha(object):
                 self._was_paused = False
 
             if not self.cluster.has_member(self.state_handler.name):
-                self.touch_member()
+                with self.cycle_timings.phase('touch_member'):
+                    self.touch_member()
 
             # cluster has leader key but not initialize key
             if not (self.cluster.is_unlocked() or self.sysid_valid(self.cluster.initialize)) and self.has_lock():
@@ -1221,9 +1381,11 @@ class Ha(object):
                 self.cluster = self.dcs.get_cluster()
 
             if self._async_executor.busy:
-                return self.handle_long_action_in_progress()
+                with self.cycle_timings.phase('long_action'):
+                    return self.handle_long_action_in_progress()
 
-            msg = self.handle_starting_instance()
+            with self.cycle_timings.phase('starting_instance'):
+                msg = self.handle_starting_instance()
             if msg is not None:
                 return msg
 
@@ -1239,7 +1401,9 @@ class Ha(object):
                     return msg
 
             # is data directory empty?
-            if self.state_handler.data_directory_empty():
+            with self.cycle_timings.phase('data_directory_check'):
+                data_directory_empty = self.state_handler.data_directory_empty()
+            if data_directory_empty:
                 self.state_handler.set_role('uninitialized')
                 self.state_handler.stop('immediate')
                 # In case datadir went away while we were master.
@@ -1250,7 +1414,8 @@ class Ha(object):
                     self.release_leader_key_voluntarily()
                     return 'released leader key voluntarily as data dir empty and currently leader'
 
-                return self.bootstrap()  # new node
+                with self.cycle_timings.phase('bootstrap'):
+                    return self.bootstrap()  # new node
             # "bootstrap", but data directory is not empty
             elif not self.sysid_valid(self.cluster.initialize) and self.cluster.is_unlocked() and not self.is_paused():
                 if not self.state_handler.cb_called and self.state_handler.is_running() \
@@ -1272,7 +1437,9 @@ class Ha(object):
                                  self.state_handler.name, self.cluster.initialize, self.state_handler.sysid)
                     sys.exit(1)
 
-            if not self.state_handler.is_healthy():
+            with self.cycle_timings.phase('postgres_health'):
+                is_healthy = self.state_handler.is_healthy()
+            if not is_healthy:
                 if self.is_paused():
                     if self.has_lock():
                         self._delete_leader()
@@ -1287,20 +1454,27 @@ class Ha(object):
                         return 'postgres is not running'
 
                 # try to start dead postgres
-                return self.recover()
+                with self.cycle_timings.phase('recover'):
+                    return self.recover()
 
             try:
-                if self.cluster.is_unlocked():
-                    return self.process_unhealthy_cluster()
-                else:
-                    msg = self.process_healthy_cluster()
-                    return self.evaluate_scheduled_restart() or msg
+                with self.cycle_timings.phase('process_cluster'):
+                    if self.cluster.is_unlocked():
+                        return self.process_unhealthy_cluster()
+                    else:
+                        # optime and history are written together at the end of the block
+                        with self.dcs.batch():
+                            msg = self.process_healthy_cluster()
+                        return self.evaluate_scheduled_restart() or msg
             finally:
                 # we might not have a valid PostgreSQL connection here if another thread
                 # stops PostgreSQL, therefore, we only reload replication slots if no
                 # asynchronous processes are running (should be always the case for the master)
                 if not self._async_executor.busy and not self.state_handler.is_starting():
-                    self.state_handler.sync_replication_slots(self.cluster)
+                    self.renew_lock_if_expiring()
+                    with self.cycle_timings.phase('sync_replication_slots'):
+                        self.state_handler.sync_replication_slots(self.cluster)
+                    self.renew_lock_if_expiring()
                     if not self.state_handler.cb_called:
                         if not self.state_handler.is_leader():
                             self.state_handler.trigger_check_diverged_lsn()
@@ -1316,14 +1490,40 @@ class Ha(object):
             return 'Error communicating with PostgreSQL. Will try again later'
         finally:
             if not self._dcs_failed:
-                self.touch_member()
+                with self.cycle_timings.phase('touch_member'):
+                    self.touch_member(wait=False)
+
+    def last_cycle_age(self):
+        """:returns: number of seconds since the last HA cycle with working DCS"""
+        return time.time() - self._last_cycle_time
+
+    def _log_slow_cycle(self, cycle):
+        threshold = self.dcs.ttl * (self.patroni.config.get('slow_cycle_ttl_percentage') or 0) / 100.0
+        if threshold and cycle['duration'] > threshold:
+            logger.warning('HA cycle took %.3fs (more than %.3fs): %s', cycle['duration'], threshold,
+                           json.dumps(cycle, separators=(',', ':')))
 
     def run_cycle(self):
-        with self._async_executor:
+        with self._async_executor, HA_CYCLE_SECONDS.time():
+            self.cycle_timings.start()
             info = self._run_cycle()
+            self._log_slow_cycle(self.cycle_timings.finish(info))
+            if not self._dcs_failed:
+                self._last_cycle_time = time.time()
             return (self.is_paused() and 'PAUSE: ' or '') + info
 
+    def _stop_status_fetching(self):
+        """Stop worker threads fetching statuses of other members, status streams and close connections to members"""
+        with self._fetch_pool_lock:
+            pool, self._fetch_pool = self._fetch_pool, None
+        if pool:
+            pool.terminate()
+            pool.join()
+        self._status_cache.set_members([])
+        self._member_pools.close()
+
     def shutdown(self):
+        self._stop_status_fetching()
         if self.is_paused():
             logger.info('Leader key is not deleted and Postgresql is not stopped due paused state')
             self.watchdog.disable()
@@ -0,0 +1,215 @@
+"""Minimalistic implementation of Prometheus metrics.
+
+Metrics are process-wide and registered in the module level `REGISTRY`, which is rendered
+in the Prometheus text exposition format by the `/metrics` REST API endpoint."""
+
+import time
+
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                             .replace('\n', '\\n')) for name, value in labels) + '}'
+
+
+class _Metric(object):
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = OrderedDict()  # tuple of label values -> value
+        self._lock = Lock()
+        self.clear()
+        if registry is not False:
+            (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('Expected labels {0} for {1}, got {2}'.format(self.labelnames, self.name, list(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self, key, value):
+        yield '', list(zip(self.labelnames, key)), value
+
+    def collect(self):
+        """:returns: list of (name_suffix, labels, value) tuples"""
+        with self._lock:
+            values = [(key, value[:] if isinstance(value, list) else value) for key, value in self._values.items()]
+        return [sample for key, value in values for sample in self._samples(key, value)]
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def _initial_value(self):
+        return 0
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            if not self.labelnames:  # metrics without labels are exported even if nothing was observed
+                self._values[()] = self._initial_value()
+
+
+class Counter(_Metric):
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+
+    def _initial_value(self):
+        # non-cumulative counts per bucket followed by the sum of observed values
+        return [0] * len(self.buckets) + [0.0]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = self._initial_value()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            values[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the `with` block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _samples(self, key, value):
+        labels = list(zip(self.labelnames, key))
+        count = 0
+        for bound, bucket in zip(self.buckets, value):
+            count += bucket
+            yield '_bucket', labels + [('le', _format_value(bound))], count
+        yield '_sum', labels, value[-1]
+        yield '_count', labels, count
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError('Metric {0} is already registered'.format(metric.name))
+            self._metrics[metric.name] = metric
+
+    def render(self, gauges=None):
+        """Render all registered metrics in the Prometheus text format
+
+        :param gauges: optional list of (name, documentation, [(labels, value), ...]) tuples
+            with point-in-time values computed by the caller.
+        :returns: string"""
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for name, documentation, metric_type, samples in \
+                [(m.name, m.documentation, m.TYPE, m.collect()) for m in metrics] + \
+                [(name, documentation, 'gauge', [('', sorted(labels.items()), value) for labels, value in values])
+                 for name, documentation, values in gauges or []]:
+            lines.append('# HELP {0} {1}'.format(name, documentation))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            for suffix, labels, value in samples:
+                lines.append('{0}{1}{2} {3}'.format(name, suffix, format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HA_CYCLE_SECONDS = Histogram('patroni_ha_cycle_duration_seconds', 'Duration of the HA loop cycle')
+DCS_OPERATION_SECONDS = Histogram('patroni_dcs_operation_duration_seconds', 'Duration of DCS operations',
+                                  ('backend', 'operation'))
+RETRIES = Counter('patroni_retries_total', 'Number of retried calls')
+LEADER_LOCK_LOSSES = Counter('patroni_leader_lock_losses_total', 'Number of failed leader lock updates')
+DEMOTIONS = Counter('patroni_demotions_total', 'Number of demotions of the primary', ('mode',))
+REPLICATION_SLOT_OPERATION_SECONDS = Histogram('patroni_replication_slot_operation_duration_seconds',
+                                               'Duration of batched replication slot operations', ('operation',))
+HA_PHASE_SECONDS = Histogram('patroni_ha_phase_duration_seconds', 'Duration of HA loop cycle phases', ('phase',))
+
+
+class CycleTimings(object):
+
+    """Wall time spent in every phase of the HA cycle. The breakdowns of the last `history`
+    cycles are kept in a ring buffer, phases are also exported via `HA_PHASE_SECONDS`.
+
+    Phases are accounted only from the thread running the HA cycle."""
+
+    def __init__(self, history=20):
+        self._history = deque(maxlen=history)
+        self._lock = Lock()
+        self._current = None
+        self._started = 0
+
+    def start(self):
+        self._current = OrderedDict()
+        self._started = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            HA_PHASE_SECONDS.observe(elapsed, phase=name)
+            if self._current is not None:
+                self._current[name] = self._current.get(name, 0) + elapsed
+
+    def finish(self, result):
+        """Close the current cycle and add it to the history
+
+        :returns: dict with the start time, total duration, time per phase and result of the cycle"""
+
+        duration = time.time() - self._started
+        phases = self._current or OrderedDict()
+        phases['other'] = max(duration - sum(phases.values()), 0)
+        cycle = {'started': self._started, 'duration': round(duration, 6), 'result': result,
+                 'phases': OrderedDict((name, round(elapsed, 6)) for name, elapsed in phases.items())}
+        self._current = None
+        with self._lock:
+            self._history.append(cycle)
+        return cycle
+
+    def history(self):
+        with self._lock:
+            return list(self._history)
@@ -0,0 +1,132 @@
+"""Reader of the `global/pg_control` file.
+
+Decodes the subset of `ControlFileData` fields used by Patroni without calling `pg_controldata`.
+The layout of the structure depends on the major version and on the platform (it is written with
+the native byte order and alignment), the file is trusted only if its CRC matches. Versions older
+than 9.5 are not supported: they protect the file with a non-standard variant of CRC-32 and their
+pg_control is read with `pg_controldata`."""
+
+import logging
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+PG_CONTROL_FILE = os.path.join('global', 'pg_control')
+
+DB_STATES = ('starting up', 'shut down', 'shut down in recovery', 'shutting down',
+             'in crash recovery', 'in archive recovery', 'in production')
+
+
+class PgControlError(Exception):
+    pass
+
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data):
+    crc = 0xFFFFFFFF
+    for byte in bytearray(data):
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def _layout(major_version):
+    """:returns: list of (name, format) tuples describing `ControlFileData` up to the `crc` field,
+        fields with `None` as a name are not decoded"""
+
+    # CheckPoint structure, embedded into ControlFileData
+    checkpoint = [('redo', 'Q'), ('checkpoint_tli', 'I'), ('prev_tli', 'I'), (None, '?')]
+    checkpoint += [(None, 'Q')] if major_version >= 120000 else [(None, 'I'), (None, 'I')]  # nextXid (and epoch)
+    checkpoint += [(None, 'I')] * 7 + [(None, 'q')]  # nextOid, nextMulti, ..., oldestMultiDB, time
+    checkpoint += [(None, 'I')] * 3  # oldestCommitTsXid, newestCommitTsXid, oldestActiveXid
+    checkpoint += [(None, '0q')]  # pad the structure to its alignment
+
+    layout = [('system_identifier', 'Q'), ('pg_control_version', 'I'), ('catalog_version_no', 'I'),
+              ('state', 'i'), (None, 'q'), ('checkpoint', 'Q')]
+    if major_version < 110000:
+        layout.append((None, 'Q'))  # prevCheckPoint
+    layout += checkpoint
+    layout += [(None, 'Q'), ('min_recovery_point', 'Q'), ('min_recovery_point_tli', 'I'),
+               (None, 'Q'), (None, 'Q'), (None, '?'), (None, 'i')]  # backup start/end points, wal_level
+    layout += [('wal_log_hints', '?'), ('max_connections', 'i'), ('max_worker_processes', 'i')]
+    if major_version >= 120000:
+        layout.append(('max_wal_senders', 'i'))
+    layout += [('max_prepared_xacts', 'i'), ('max_locks_per_xact', 'i'), ('track_commit_timestamp', '?')]
+    layout += [(None, 'I'), (None, 'd')] + [(None, 'I')] * 8  # maxAlign, floatFormat, blcksz ... loblksize
+    # enableIntTimes (before 10), float4ByVal (before 13) and float8ByVal
+    layout += [(None, '?')] * (1 if major_version >= 130000 else 2 if major_version >= 100000 else 3)
+    layout.append(('data_checksum_version', 'I'))
+    if major_version >= 100000:
+        layout.append((None, '32s'))  # mock_authentication_nonce
+    return layout
+
+
+def _format_lsn(lsn):
+    return '{0:X}/{1:X}'.format(lsn >> 32, lsn & 0xFFFFFFFF)
+
+
+def _check_major_version(major_version):
+    if major_version < 90500:
+        raise PgControlError('PostgreSQL {0} is not supported'.format(major_version))
+
+
+def parse_pg_control(data, major_version):
+    """Decode the contents of pg_control
+
+    :returns: dict with the same keys and values as in the `pg_controldata` output"""
+
+    _check_major_version(major_version)
+    layout = _layout(major_version)
+    fmt = '@' + ''.join(f for _, f in layout)
+    crc_offset = struct.calcsize(fmt + '0I')
+    if len(data) < crc_offset + 4:
+        raise PgControlError('pg_control is too short')
+
+    crc = struct.unpack_from('@I', data, crc_offset)[0]
+    if crc != crc32c(data[:crc_offset]):
+        raise PgControlError('incorrect checksum in pg_control')
+
+    fields = [name for name, f in layout if not f.startswith('0')]  # zero-length paddings don't produce values
+    c = {name: value for name, value in zip(fields, struct.unpack_from(fmt, data)) if name}
+
+    state = c['state']
+    result = {
+        'pg_control version number': str(c['pg_control_version']),
+        'Catalog version number': str(c['catalog_version_no']),
+        'Database system identifier': str(c['system_identifier']),
+        'Database cluster state': DB_STATES[state] if 0 <= state < len(DB_STATES) else 'unrecognized status code',
+        'Latest checkpoint location': _format_lsn(c['checkpoint']),
+        "Latest checkpoint's REDO location": _format_lsn(c['redo']),
+        "Latest checkpoint's TimeLineID": str(c['checkpoint_tli']),
+        "Latest checkpoint's PrevTimeLineID": str(c['prev_tli']),
+        'Minimum recovery ending location': _format_lsn(c['min_recovery_point']),
+        "Min recovery ending loc's timeline": str(c['min_recovery_point_tli']),
+        'Data page checksum version': str(c['data_checksum_version'])
+    }
+    for name in ('wal_log_hints', 'track_commit_timestamp'):
+        if name in c:
+            result[name + ' setting'] = 'on' if c[name] else 'off'
+    for name in ('max_connections', 'max_worker_processes', 'max_wal_senders', 'max_prepared_xacts',
+                 'max_locks_per_xact'):
+        if name in c:
+            result[name + ' setting'] = str(c[name])
+    return result
+
+
+def read_pg_control(data_dir, major_version):
+    """:returns: dict with the same keys and values as in the `pg_controldata` output"""
+    _check_major_version(major_version)  # don't read the file if it can't be parsed
+    with open(os.path.join(data_dir, PG_CONTROL_FILE), 'rb') as f:
+        return parse_pg_control(f.read(), major_version)
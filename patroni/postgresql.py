@@ -13,8 +13,11 @@ import time
 from collections import defaultdict
 from contextlib import contextmanager
 from patroni.callback_executor import CallbackExecutor
+from patroni.connection_pool import ConnectionPool
 from patroni.exceptions import PostgresConnectionException, PostgresException
+from patroni.metrics import REPLICATION_SLOT_OPERATION_SECONDS
 from patroni.utils import compare_values, parse_bool, parse_int, Retry, RetryFailedError, polling_loop, split_host_port
+from patroni.pg_control import read_pg_control
 from patroni.postmaster import PostmasterProcess
 from patroni.dcs import slot_name_from_member_name, RemoteMember, Leader
 from requests.structures import CaseInsensitiveDict
@@ -140,8 +143,12 @@ class Postgresql(object):
         self._connection_lock = Lock()
         self._connection = None
         self._cursor_holder = None
+        # connections for threads other than the HA loop, i.e. REST API handlers
+        self._connection_pool = ConnectionPool(self._pool_connect)
         self._sysid = None
         self._replication_slots = {}  # already existing replication slots
+        self._slot_connections = {}  # database -> connection used to create logical slots
+        self._slots_fingerprint = None  # state of the cluster for which `_replication_slots` were reconciled
         self.retry = Retry(max_tries=-1, deadline=config['retry_timeout']/2.0, max_delay=1,
                            retry_exceptions=PostgresConnectionException)
 
@@ -460,6 +467,15 @@ class Postgresql(object):
                 self.server_version = self._connection.server_version
         return self._connection
 
+    def _pool_connect(self):
+        conn = psycopg2.connect(application_name='Patroni pool', **self._local_connect_kwargs)
+        conn.autocommit = True
+        return conn
+
+    @property
+    def connection_pool(self):
+        return self._connection_pool
+
     def _cursor(self):
         if not self._cursor_holder or self._cursor_holder.closed or self._cursor_holder.connection.closed != 0:
             logger.info("establishing a new patroni connection to the postgres cluster")
@@ -471,6 +487,8 @@ class Postgresql(object):
             self._connection.close()
             logger.info("closed patroni connection to the postgresql cluster")
         self._cursor_holder = self._connection = None
+        self._connection_pool.close()
+        self._close_slot_connections()
 
     def _query(self, sql, *params):
         """We are always using the same cursor, therefore this method is not thread-safe!!!
@@ -988,6 +1006,8 @@ class Postgresql(object):
                 on_safepoint()
             return True, False
 
+        self._close_slot_connections()  # they would delay the shutdown
+
         if checkpoint and not self.is_starting():
             self.checkpoint()
 
@@ -1226,6 +1246,10 @@ class Postgresql(object):
         result = {}
         # Don't try to call pg_controldata during backup restore
         if self._version_file_exists() and self.state != 'creating replica':
+            try:
+                return read_pg_control(self._data_dir, self._major_version or self.get_major_version())
+            except Exception as e:
+                logger.debug('Failed to read pg_control: %r, falling back to pg_controldata', e)
             try:
                 env = {'LANG': 'C', 'LC_ALL': 'C', 'PATH': os.getenv('PATH')}
                 if os.getenv('SYSTEMROOT') is not None:
@@ -1505,11 +1529,32 @@ class Postgresql(object):
         except IOError:
             logger.exception('unable to restore configuration files from backup')
 
-    def _wait_promote(self, wait_seconds):
-        for _ in polling_loop(wait_seconds - 1):
-            data = self.controldata()
-            if data.get('Database cluster state') == 'in production':
-                return True
+    def wait_for_promotion(self, timeout):
+        """Wait until PostgreSQL leaves recovery. `pg_is_in_recovery()` is checked via a dedicated connection
+        (the main one is not thread-safe), pg_control is checked when the connection is not possible.
+        The checks are repeated with the interval growing from 10ms to 0.5s.
+
+        :returns: `!True` if the promotion has completed in `timeout` seconds, `None` otherwise"""
+
+        conn = None
+        try:
+            for _ in polling_loop(timeout, interval=0.01, max_interval=0.5):
+                try:
+                    if not conn or conn.closed != 0:
+                        conn = psycopg2.connect(**self._local_connect_kwargs)
+                        conn.autocommit = True
+                    with conn.cursor() as cur:
+                        cur.execute('SELECT pg_catalog.pg_is_in_recovery()')
+                        if not cur.fetchone()[0]:
+                            return True
+                    continue
+                except psycopg2.Error:
+                    pass
+                if self.controldata().get('Database cluster state') == 'in production':
+                    return True
+        finally:
+            if conn:
+                conn.close()
 
     def promote(self, wait_seconds, access_is_restricted=False):
         if self.role == 'master':
@@ -1521,7 +1566,7 @@ class Postgresql(object):
             self._rewind_state = REWIND_STATUS.INITIAL
             if not access_is_restricted:
                 self.call_nowait(ACTION_ON_ROLE_CHANGE)
-            ret = self._wait_promote(wait_seconds)
+            ret = self.wait_for_promotion(wait_seconds - 1)
         return ret
 
     def create_or_update_role(self, name, password, options):
@@ -1543,11 +1588,11 @@ $$""".format(name, ' '.join(options)), name, password, password)
 
     def timeline_wal_position(self):
         # This method could be called from different threads (simultaneously with some other `_query` calls).
-        # If it is called not from main thread we will create a new cursor to execute statement.
+        # If it is called not from main thread we will take a connection from the pool to execute statement.
         if current_thread().ident == self.__thread_ident:
             return self._cluster_info_state_get('timeline'), self._cluster_info_state_get('wal_position')
 
-        with self.connection().cursor() as cursor:
+        with self._connection_pool.connection() as conn, conn.cursor() as cursor:
             cursor.execute(cluster_info_query.format(self.wal_name, self.lsn_name))
             return cursor.fetchone()[:2]
 
@@ -1582,60 +1627,152 @@ $$""".format(name, ' '.join(options)), name, password, password)
         return s1['type'] == s2['type'] and\
                 (s1['type'] == 'physical' or s1['database'] == s2['database'] and s1['plugin'] == s2['plugin'])
 
+    def _drop_replication_slots(self, names):
+        """Drop all inactive slots from `names` with one statement
+
+        :returns: set of names of slots which were not dropped (either don't exist or still active)"""
+
+        with REPLICATION_SLOT_OPERATION_SECONDS.time(operation='drop'):
+            try:
+                cursor = self._query('SELECT slot_name, pg_catalog.pg_drop_replication_slot(slot_name)' +
+                                     ' FROM pg_catalog.pg_replication_slots WHERE slot_name = ANY(%s) AND NOT active',
+                                     sorted(names))
+                return set(names) - set(r[0] for r in cursor)
+            except Exception:
+                # i.e. one of slots became active after it was checked, the whole statement is rolled back
+                logger.exception('Failed to drop replication slots %s, dropping them one by one', sorted(names))
+
+            not_dropped = set()
+            for name in sorted(names):
+                try:
+                    if not self.drop_replication_slot(name):
+                        not_dropped.add(name)
+                except Exception:
+                    logger.exception("Failed to drop replication slot '%s'", name)
+                    not_dropped.add(name)
+            return not_dropped
+
+    def _create_physical_replication_slots(self, names):
+        """Create missing physical slots from `names` with one statement, if it fails they are created one by one"""
+
+        query = ("SELECT pg_catalog.pg_create_physical_replication_slot(s.name{0})" +
+                 " FROM (VALUES {{0}}) AS s(name) WHERE NOT EXISTS (SELECT 1" +
+                 " FROM pg_catalog.pg_replication_slots WHERE slot_type = 'physical'" +
+                 " AND slot_name = s.name)").format(', true' if self._major_version >= 90600 else '')
+        with REPLICATION_SLOT_OPERATION_SECONDS.time(operation='create_physical'):
+            try:
+                return self._query(query.format(', '.join(['(%s)'] * len(names))), *names)
+            except Exception:
+                # i.e. one slot exists as a logical one, the whole statement is rolled back
+                logger.exception('Failed to create physical replication slots %s, creating them one by one', names)
+
+            for name in names:
+                try:
+                    self._query(query.format('(%s)'), name)
+                except Exception:
+                    logger.exception("Failed to create physical replication slot '%s'", name)
+                    self._schedule_load_slots = True
+
+    def _slot_connection(self, database):
+        """:returns: cached connection to the `database`, logical slots can be created only from it"""
+        conn = self._slot_connections.get(database)
+        if not conn or conn.closed != 0:
+            conn_kwargs = self._local_connect_kwargs
+            conn_kwargs['database'] = database
+            conn = self._slot_connections[database] = psycopg2.connect(**conn_kwargs)
+            conn.autocommit = True
+        return conn
+
+    def _close_slot_connections(self, keep=()):
+        """Close cached connections to databases except `keep`"""
+        for database in set(self._slot_connections) - set(keep):
+            conn = self._slot_connections.pop(database)
+            if conn.closed == 0:
+                conn.close()
+
+    def _create_logical_replication_slots(self, database, slots):
+        """Create missing logical slots in the `database` with one statement, if it fails they are created one by one"""
+
+        query = ("SELECT pg_catalog.pg_create_logical_replication_slot(s.name, s.plugin)" +
+                 " FROM (VALUES {0}) AS s(name, plugin) WHERE NOT EXISTS (SELECT 1" +
+                 " FROM pg_catalog.pg_replication_slots WHERE slot_type = 'logical'" +
+                 " AND slot_name = s.name)")
+        names = sorted(slots)
+        with REPLICATION_SLOT_OPERATION_SECONDS.time(operation='create_logical'):
+            try:
+                with self._slot_connection(database).cursor() as cur:
+                    cur.execute(query.format(', '.join(['(%s, %s)'] * len(names))),
+                                [v for name in names for v in (name, slots[name]['plugin'])])
+                return
+            except psycopg2.OperationalError:
+                logger.exception("Failed to create logical replication slots %s in database '%s'", names, database)
+                conn = self._slot_connections.pop(database, None)
+                if conn and conn.closed == 0:
+                    conn.close()
+                self._schedule_load_slots = True
+                return
+            except Exception:
+                # i.e. the output plugin of one slot doesn't exist, the whole statement is rolled back
+                logger.exception("Failed to create logical replication slots %s in database '%s', creating them"
+                                 " one by one", names, database)
+
+            for name in names:
+                try:
+                    with self._slot_connection(database).cursor() as cur:
+                        cur.execute(query.format('(%s, %s)'), (name, slots[name]['plugin']))
+                except Exception:
+                    logger.exception("Failed to create logical replication slot '%s' plugin='%s'",
+                                     name, slots[name]['plugin'])
+                    self._schedule_load_slots = True
+
     def sync_replication_slots(self, cluster):
+        """Reconcile existing replication slots with the desired ones. The difference is applied with
+        at most one statement for dropping slots, one for creating physical slots and one per database
+        for creating logical slots. If one of these statements fails, its slots are handled one by one."""
+
         if self.use_slots:
             try:
+                # Nothing to do if neither desired slots nor existing slots could change since the last run.
+                # Existing slots are reloaded only when postgres was restarted or the previous run has failed.
+                fingerprint = cluster.replication_slots_fingerprint(self.name, self.role)
+                if fingerprint == self._slots_fingerprint and not self._schedule_load_slots:
+                    return
+
                 self.load_replication_slots()
 
                 slots = cluster.get_replication_slots(self.name, self.role)
 
-                # drop old replication slots which are not presented in desired slots
-                for name in set(self._replication_slots) - set(slots):
-                    if not self.drop_replication_slot(name):
-                        logger.error("Failed to drop replication slot '%s'", name)
-                        self._schedule_load_slots = True
-
-                immediately_reserve = ', true' if self._major_version >= 90600 else ''
-
-                logical_slots = defaultdict(dict)
+                # drop old replication slots which are not presented in desired slots or have to be changed
+                to_drop = set(self._replication_slots) - set(slots)
                 for name, value in slots.items():
                     if name in self._replication_slots and not self.compare_slots(value, self._replication_slots[name]):
                         logger.info("Trying to drop replication slot '%s' because value is changing from %s to %s",
                                     name, self._replication_slots[name], value)
-                        if not self.drop_replication_slot(name):
-                            logger.error("Failed to drop replication slot '%s'", name)
-                            self._schedule_load_slots = True
-                            continue
-                        self._replication_slots.pop(name)
-                    if name not in self._replication_slots:
-                        if value['type'] == 'physical':
-                            try:
-                                self._query(("SELECT pg_catalog.pg_create_physical_replication_slot(%s{0})" +
-                                             " WHERE NOT EXISTS (SELECT 1 FROM pg_catalog.pg_replication_slots" +
-                                             " WHERE slot_type = 'physical' AND slot_name = %s)").format(
-                                                 immediately_reserve), name, name)
-                            except Exception:
-                                logger.exception("Failed to create physical replication slot '%s'", name)
-                                self._schedule_load_slots = True
-                        elif value['type'] == 'logical' and name not in self._replication_slots:
-                            logical_slots[value['database']][name] = value
-
-                # create new logical slots
+                        to_drop.add(name)
+
+                not_dropped = self._drop_replication_slots(to_drop) if to_drop else set()
+                for name in sorted(not_dropped):
+                    logger.error("Failed to drop replication slot '%s'", name)
+                    self._schedule_load_slots = True
+
+                physical_slots = []
+                logical_slots = defaultdict(dict)
+                for name, value in slots.items():
+                    if name in self._replication_slots and name not in to_drop or name in not_dropped:
+                        continue
+                    if value['type'] == 'physical':
+                        physical_slots.append(name)
+                    elif value['type'] == 'logical':
+                        logical_slots[value['database']][name] = value
+
+                if physical_slots:
+                    self._create_physical_replication_slots(sorted(physical_slots))
                 for database, values in logical_slots.items():
-                    conn_kwargs = self._local_connect_kwargs
-                    conn_kwargs['database'] = database
-                    with self._get_connection_cursor(**conn_kwargs) as cur:
-                        for name, value in values.items():
-                            try:
-                                cur.execute("SELECT pg_catalog.pg_create_logical_replication_slot(%s, %s)" +
-                                            " WHERE NOT EXISTS (SELECT 1 FROM pg_catalog.pg_replication_slots" +
-                                            " WHERE slot_type = 'logical' AND slot_name = %s)",
-                                            (name, value['plugin'], name))
-                            except Exception:
-                                logger.exception("Failed to create logical replication slot '%s' plugin='%s'",
-                                                 name, value['plugin'])
-                                self._schedule_load_slots = True
+                    self._create_logical_replication_slots(database, values)
+                # connections to databases without logical slots (i.e. after demotion) aren't needed anymore
+                self._close_slot_connections(set(v['database'] for v in slots.values() if v['type'] == 'logical'))
                 self._replication_slots = slots
+                self._slots_fingerprint = fingerprint
             except Exception:
                 logger.exception('Exception when changing replication slots')
                 self._schedule_load_slots = True
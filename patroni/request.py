@@ -0,0 +1,211 @@
+import json
+import logging
+import ssl
+import time
+import urllib3
+
+from six import reraise
+from six.moves import http_client
+from six.moves.urllib_parse import urlparse
+from threading import Event, Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+
+class StaleConnectionRetry(urllib3.util.retry.Retry):
+
+    """Retries the request once when a reused keep-alive connection turned out to be closed by the member.
+    Timeouts are not retried, otherwise an unresponsive member would cost twice the timeout."""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('total', 1)
+        kwargs.setdefault('redirect', False)
+        kwargs.setdefault('status', 0)
+        super(StaleConnectionRetry, self).__init__(**kwargs)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if isinstance(error, urllib3.exceptions.TimeoutError):
+            reraise(type(error), error, _stacktrace)
+        return super(StaleConnectionRetry, self).increment(method, url, response, error, _pool, _stacktrace)
+
+
+class MemberConnectionPools(object):
+
+    """Keeps one persistent (keep-alive) http connection pool per cluster member.
+
+    `requests.get()` opens a new TCP (and TLS) connection for every call, therefore every member health
+    check was paying for a full handshake. Pools are created lazily, live as long as the owner object
+    and are rebuilt only when the `api_url` of the member changes in DCS."""
+
+    def __init__(self, timeout=2):
+        self._timeout = timeout
+        self._pools = {}  # member name -> (api_url, pool)
+        self._lock = Lock()
+
+    @staticmethod
+    def _create_pool(api_url):
+        kwargs = {'maxsize': 2, 'block': False, 'retries': False}
+        if urlparse(api_url).scheme == 'https':
+            kwargs['cert_reqs'] = 'CERT_NONE'  # the same as `verify=False` in requests
+        return urllib3.connectionpool.connection_from_url(api_url, **kwargs)
+
+    def _get_pool(self, member):
+        with self._lock:
+            api_url, pool = self._pools.get(member.name, (None, None))
+            if api_url != member.api_url:
+                if pool:
+                    logger.info('api_url of %s changed from %s to %s, recreating connection pool',
+                                member.name, api_url, member.api_url)
+                    pool.close()
+                pool = self._create_pool(member.api_url)
+                self._pools[member.name] = (member.api_url, pool)
+            return pool
+
+    def __call__(self, member, method='GET', body=None, timeout=None):
+        """Execute http request against `member.api_url` reusing already established connection if possible
+
+        :returns: `urllib3.response.HTTPResponse` object"""
+
+        pool = self._get_pool(member)
+        r = urlparse(member.api_url)
+        url = (r.path or '/') + ('?' + r.query if r.query else '')
+        # only idempotent requests could be safely repeated on a fresh connection
+        retries = StaleConnectionRetry() if method == 'GET' else False
+        return pool.urlopen(method, url, body=body, timeout=timeout or self._timeout, retries=retries)
+
+    def prune(self, names):
+        """Close and forget pools of members which are not in `names` anymore"""
+        with self._lock:
+            for name in set(self._pools) - set(names):
+                self._pools.pop(name)[1].close()
+
+    def close(self):
+        self.prune([])
+
+    def stats(self):
+        """:returns: dict with number of handshakes (new connections) and reuse ratio per member"""
+        with self._lock:
+            pools = list(self._pools.items())
+        ret = {}
+        for name, (api_url, pool) in pools:
+            num_requests, handshakes = pool.num_requests, pool.num_connections
+            ret[name] = {'api_url': api_url, 'requests': num_requests, 'handshakes': handshakes,
+                         'reuse_ratio': round(1.0 - float(handshakes) / num_requests, 4) if num_requests else 0.0}
+        return ret
+
+
+class MemberStatusStream(Thread):
+
+    """Subscription to the `/status_stream` endpoint of a single member.
+
+    Runs in the background, reconnects on errors and keeps the last received status
+    together with the time it was received."""
+
+    def __init__(self, api_url, interval):
+        super(MemberStatusStream, self).__init__()
+        self.daemon = True
+        self.api_url = api_url
+        self._interval = interval
+        self._stopped = Event()
+        self._lock = Lock()
+        self._status = None
+        self._received = 0
+
+    def stop(self):
+        self._stopped.set()
+
+    def _set_status(self, status):
+        with self._lock:
+            self._status = status
+            self._received = time.time()
+
+    def get(self, max_age):
+        """:returns: the last received status if it is not older than `max_age` seconds"""
+        with self._lock:
+            if self._status is not None and self._received + max_age >= time.time():
+                return self._status
+
+    def _connect(self):
+        r = urlparse(self.api_url)
+        # the server sends an event every `interval` seconds, silence for longer than that means problems
+        timeout = max(self._interval * 3, 2)
+        if r.scheme == 'https':
+            conn = http_client.HTTPSConnection(r.hostname, r.port or 443, timeout=timeout,
+                                               context=ssl._create_unverified_context())
+        else:
+            conn = http_client.HTTPConnection(r.hostname, r.port or 80, timeout=timeout)
+        conn.request('GET', '/status_stream', headers={'Accept': 'text/event-stream'})
+        return conn, conn.getresponse()
+
+    def _consume(self):
+        conn, response = self._connect()
+        try:
+            if response.status == 503:  # the member has too many subscribers, try again later
+                logger.info('%s rejected the status stream subscription', self.api_url)
+                return self._stopped.wait(max(self._interval * 30, 30))
+            if response.status != 200 or not response.getheader('Content-Type', '').startswith('text/event-stream'):
+                logger.info('%s does not support status streams, falling back to polling', self.api_url)
+                return self.stop()
+
+            while not self._stopped.is_set():
+                line = response.fp.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8').strip()
+                if line.startswith('data:'):
+                    self._set_status(json.loads(line[5:]))
+        finally:
+            conn.close()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._consume()
+            except Exception as e:
+                logger.debug('Status stream from %s failed: %r', self.api_url, e)
+            with self._lock:  # stream is broken, the last status will become stale soon
+                self._status = None
+            self._stopped.wait(self._interval)
+
+
+class MemberStatusCache(object):
+
+    """Keeps continuously refreshed statuses of other members received via their status streams"""
+
+    def __init__(self):
+        self._streams = {}  # member name -> MemberStatusStream
+        self._lock = Lock()
+        self._interval = 1
+
+    @property
+    def max_age(self):
+        # events are pushed every `interval` seconds, allow a bit of time for querying and delivering them
+        return self._interval * 1.5
+
+    @property
+    def enabled(self):
+        return bool(self._streams)
+
+    def set_members(self, members, interval=1):
+        """Subscribe to status streams of `members`. Subscriptions to members which are not
+        in the list anymore or changed their `api_url` are cancelled."""
+
+        with self._lock:
+            restart, self._interval = self._interval != interval, interval
+            wanted = {m.name: m.api_url for m in members}
+            for name, stream in list(self._streams.items()):
+                if restart or wanted.get(name) != stream.api_url:
+                    stream.stop()
+                    del self._streams[name]
+
+            for name, api_url in wanted.items():
+                if name not in self._streams:
+                    self._streams[name] = stream = MemberStatusStream(api_url, interval)
+                    stream.start()
+
+    def get(self, member):
+        """:returns: the status of `member` as it was published by it, if it is fresh enough, otherwise `!None`"""
+        with self._lock:
+            stream = self._streams.get(member.name)
+        if stream and stream.api_url == member.api_url:
+            return stream.get(self.max_age)
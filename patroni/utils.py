@@ -3,6 +3,7 @@ import time
 
 from dateutil import tz
 from patroni.exceptions import PatroniException
+from patroni.metrics import RETRIES
 
 tzutc = tz.tzutc()
 
@@ -257,6 +258,7 @@ class Retry(object):
                 if self._attempts == self.max_tries:
                     raise RetryFailedError("Too many retry attempts")
                 self._attempts += 1
+                RETRIES.inc()
                 sleeptime = self._cur_delay + (random.randint(0, self.max_jitter) / 100.0)
 
                 if self._cur_stoptime is not None and time.time() + sleeptime >= self._cur_stoptime:
@@ -266,15 +268,18 @@ class Retry(object):
                 self._cur_delay = min(self._cur_delay * self.backoff, self.max_delay)
 
 
-def polling_loop(timeout, interval=1):
-    """Returns an iterator that returns values until timeout has passed. Timeout is measured from start of iteration."""
+def polling_loop(timeout, interval=1, max_interval=None):
+    """Returns an iterator that returns values until timeout has passed. Timeout is measured from start of iteration.
+    If `max_interval` is specified the interval is doubled after every iteration until it reaches `max_interval`."""
     start_time = time.time()
     iteration = 0
     end_time = start_time + timeout
     while time.time() < end_time:
         yield iteration
         iteration += 1
-        time.sleep(interval)
+        time.sleep(max(min(interval, end_time - time.time()), 0) if max_interval else interval)
+        if max_interval:
+            interval = min(interval * 2, max_interval)
 
 
 def split_host_port(value, default_port):
@@ -1,15 +1,23 @@
 import datetime
+import io
 import json
 import psycopg2
+import socket
+import time
 import unittest
 
 from mock import Mock, PropertyMock, patch
-from patroni.api import RestApiHandler, RestApiServer
+from patroni.api import IdleConnections, RestApiHandler, RestApiServer
+from patroni.connection_pool import ConnectionPool
 from patroni.dcs import ClusterConfig, Member
 from patroni.ha import _MemberStatus
-from patroni.utils import tzutc
+from patroni.metrics import CycleTimings
+from patroni.utils import polling_loop, tzutc
 from six import BytesIO as IO
 from six.moves import BaseHTTPServer
+from six.moves.queue import Full
+from six.moves.socketserver import ThreadingMixIn
+from threading import Event
 from test_postgresql import psycopg2_connect, MockCursor
 
 
@@ -28,6 +36,7 @@ class MockPostgresql(object):
     pending_restart = True
     wal_name = 'wal'
     lsn_name = 'lsn'
+    connection_pool = ConnectionPool(lambda: MockPostgresql.connection())
 
     @staticmethod
     def connection():
@@ -73,7 +82,7 @@ class MockHa(object):
 
     @staticmethod
     def fetch_nodes_statuses(members):
-        return [_MemberStatus(None, True, None, 0, None, {}, False)]
+        yield _MemberStatus(None, True, None, 0, None, {}, False)
 
     @staticmethod
     def schedule_future_restart(data):
@@ -91,6 +100,12 @@ class MockHa(object):
     def wakeup():
         pass
 
+    @staticmethod
+    def last_cycle_age():
+        return 1
+
+    cycle_timings = CycleTimings()
+
     @staticmethod
     def is_paused():
         return True
@@ -128,6 +143,17 @@ class MockRequest(object):
     def sendall(self, *args, **kwargs):
         pass
 
+    def settimeout(self, *args, **kwargs):
+        pass
+
+    @staticmethod
+    def gettimeout():
+        return None
+
+
+class MockReader(io.BufferedReader):
+    pass
+
 
 class MockRestApiServer(RestApiServer):
 
@@ -175,12 +201,99 @@ class TestRestApiHandler(unittest.TestCase):
             MockRestApiServer(RestApiHandler, 'GET /standby_leader')
 
     def test_do_OPTIONS(self):
-        self.assertIsNotNone(MockRestApiServer(RestApiHandler, 'OPTIONS / HTTP/1.0'))
+        with patch.object(RestApiServer, 'query') as mock_query:
+            self.assertIsNotNone(MockRestApiServer(RestApiHandler, 'OPTIONS / HTTP/1.0'))
+            with patch.object(MockPostgresql, 'role', 'standby_leader'):
+                MockRestApiServer(RestApiHandler, 'OPTIONS /replica HTTP/1.0')
+        mock_query.assert_not_called()
+
+    @patch.object(RestApiServer, 'query')
+    def test_fast_health_checks(self, mock_query):
+        config = {'listen': '127.0.0.1:8008', 'fast_health_checks': 'on'}
+        with patch.object(RestApiHandler, '_write_status_response') as mock_write:
+            MockRestApiServer(RestApiHandler, 'GET /replica', config)
+            mock_write.assert_called_with(503, {'state': 'running', 'role': 'master'})
+            with patch.object(MockPostgresql, 'role', 'replica'):
+                MockRestApiServer(RestApiHandler, 'GET /replica', config)
+                self.assertEqual(mock_write.call_args[0][0], 200)
+                config['health_check_max_cycle_age'] = 0.5
+                MockRestApiServer(RestApiHandler, 'GET /replica', config)
+                self.assertEqual(mock_write.call_args[0][0], 503)
+        mock_query.assert_not_called()
+
+    def test_keepalive(self):
+        config = {'listen': '127.0.0.1:8008', 'keepalive': 'on', 'keepalive_max_requests': 3,
+                  'fast_health_checks': 'on'}
+        request = 'OPTIONS /master HTTP/1.1\r\n\r\nGET /replica HTTP/1.1\r\n\r\n' +\
+            'POST /reload HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}GET /master HTTP/1.1\r\n\r\n'
+        with patch.object(MockRequest, 'sendall') as mock_sendall:
+            MockRestApiServer(RestApiHandler, request, config)
+        responses = b''.join(c[0][0] for c in mock_sendall.call_args_list).split(b'HTTP/1.1 ')[1:]
+        self.assertEqual(len(responses), 3)  # connection is closed after the request with the body
+        self.assertIn(b'Content-Length: 0\r\n', responses[0])
+        self.assertNotIn(b'Connection: close', responses[1])
+        self.assertIn(b'Connection: close', responses[2])
+
+        config['keepalive_max_requests'] = 1
+        with patch.object(MockRequest, 'sendall') as mock_sendall:
+            MockRestApiServer(RestApiHandler, request, config)
+        self.assertEqual(len(mock_sendall.call_args_list), 2)
+        self.assertIn(b'Connection: close', mock_sendall.call_args_list[0][0][0])
+
+    @patch.object(RestApiHandler, 'query_postgresql_status',
+                  Mock(side_effect=lambda *args: {'role': 'master', 'postmaster_start_time': 'now'}))
+    def test_get_postgresql_status(self):
+        server = MockRestApiServer(RestApiHandler, 'GET /master')
+        self.assertEqual(server.status_cache_ttl, 0)
+        server.status_cache_ttl = 1
+        server.status_snapshot = None
+        RestApiHandler.query_postgresql_status.reset_mock()
+        handler = Mock(server=server, query_postgresql_status=RestApiHandler.query_postgresql_status)
+        status = RestApiHandler.get_postgresql_status(handler)
+        status['foo'] = 'bar'
+        self.assertEqual(RestApiHandler.get_postgresql_status(handler),
+                         {'role': 'master', 'postmaster_start_time': 'now'})
+        self.assertEqual(RestApiHandler.query_postgresql_status.call_count, 1)
+        RestApiHandler.get_postgresql_status(handler, True)
+        self.assertEqual(RestApiHandler.query_postgresql_status.call_count, 2)
+        server.status_cache_ttl = 0
+        RestApiHandler.get_postgresql_status(handler)
+        self.assertEqual(RestApiHandler.query_postgresql_status.call_count, 3)
+
+        server.status_cache_ttl = 1
+        server.status_snapshot = None
+        RestApiHandler.query_postgresql_status.side_effect = lambda *args: {'state': 'unknown', 'role': 'master'}
+        RestApiHandler.get_postgresql_status(handler)
+        RestApiHandler.get_postgresql_status(handler)  # failures are not cached
+        self.assertEqual(RestApiHandler.query_postgresql_status.call_count, 5)
 
     @patch.object(MockPostgresql, 'state', PropertyMock(return_value='stopped'))
     def test_do_GET_patroni(self):
         self.assertIsNotNone(MockRestApiServer(RestApiHandler, 'GET /patroni'))
 
+    @patch('time.sleep', Mock())
+    def test_do_GET_status_stream(self):
+        with patch.object(MockRequest, 'sendall', Mock(side_effect=[None, None, socket.error])) as mock_sendall:
+            MockRestApiServer(RestApiHandler, 'GET /status_stream')
+        self.assertEqual(mock_sendall.call_count, 3)
+        self.assertTrue(mock_sendall.call_args_list[1][0][0].startswith(b'data: {'))
+        with patch.object(MockRequest, 'sendall') as mock_sendall:
+            MockRestApiServer(RestApiHandler, 'GET /status_stream',
+                              {'listen': '127.0.0.1:8008', 'status_stream_max_subscribers': 0})
+        self.assertIn(b'Error code: 503', b''.join(c[0][0] for c in mock_sendall.call_args_list))
+
+    def test_do_GET_ha_cycles(self):
+        self.assertIsNotNone(MockRestApiServer(RestApiHandler, 'GET /ha_cycles'))
+
+    def test_do_GET_metrics(self):
+        with patch.object(MockRequest, 'sendall') as mock_sendall:
+            MockRestApiServer(RestApiHandler, 'GET /metrics HTTP/1.0')
+        response = b''.join(c[0][0] for c in mock_sendall.call_args_list)
+        self.assertIn(b'text/plain; version=0.0.4', response)
+        self.assertIn(b'\npatroni_postgres_running 1\n', response)
+        self.assertIn(b'\npatroni_ha_cycle_duration_seconds_count ', response)
+        self.assertIn(b'\npatroni_connection_pool_idle ', response)
+
     def test_basicauth(self):
         self.assertIsNotNone(MockRestApiServer(RestApiHandler, 'POST /restart HTTP/1.0'))
         MockRestApiServer(RestApiHandler, 'POST /restart HTTP/1.0\nAuthorization:')
@@ -298,6 +411,7 @@ class TestRestApiHandler(unittest.TestCase):
     def test_RestApiServer_query(self):
         with patch.object(MockCursor, 'execute', Mock(side_effect=psycopg2.OperationalError)):
             self.assertIsNotNone(MockRestApiServer(RestApiHandler, 'GET /patroni'))
+        MockPostgresql.connection_pool.close()
         with patch.object(MockPostgresql, 'connection', Mock(side_effect=psycopg2.OperationalError)):
             self.assertIsNotNone(MockRestApiServer(RestApiHandler, 'GET /patroni'))
 
@@ -361,7 +475,7 @@ class TestRestApiHandler(unittest.TestCase):
         MockRestApiServer(RestApiHandler, request)
         dcs.manual_failover.return_value = True
 
-        with patch.object(MockHa, 'fetch_nodes_statuses', Mock(return_value=[])):
+        with patch.object(MockHa, 'fetch_nodes_statuses', Mock(return_value=(st for st in ()))):
             MockRestApiServer(RestApiHandler, request)
 
         # Valid future date
@@ -407,3 +521,126 @@ class TestRestApiServer(unittest.TestCase):
             raise Exception()
         except Exception:
             self.assertIsNone(MockRestApiServer.handle_error(None, ('127.0.0.1', 55555)))
+
+    @patch.object(MockRequest, 'makefile', lambda self, *args: MockReader(IO(self.request)))
+    @patch.object(IdleConnections, 'start', Mock())
+    def test_park_idle_connection(self):
+        srv = MockRestApiServer(RestApiHandler, 'GET /master HTTP/1.1\r\n\r\n',
+                                {'listen': '127.0.0.1:8008', 'keepalive': 'on', 'workers': 1,
+                                 'fast_health_checks': 'on'})
+        srv.RequestHandlerClass = RestApiHandler
+        srv.shutdown_request = Mock()
+        request = MockRequest('GET /master HTTP/1.1\r\n\r\nGET /replica HTTP/1.1\r\n\r\n')
+        with patch.object(IdleConnections, 'add') as mock_add:
+            srv.process_request_thread(request, ('127.0.0.1', 1))  # pipelined requests are served before parking
+        mock_add.assert_called_once_with(request, ('127.0.0.1', 1), 2, 5)
+
+        with patch.object(MockRestApiServer, 'process_request') as mock_process_request:
+            srv._RestApiServer__resume_connection(request, ('127.0.0.1', 1), 2)
+        mock_process_request.assert_called_once_with(request, ('127.0.0.1', 1))
+        self.assertEqual(srv.pop_served_requests(request), 2)
+        self.assertEqual(srv.pop_served_requests(request), 0)
+
+        with patch.object(MockReader, 'peek', Mock(side_effect=socket.error)), \
+                patch.object(IdleConnections, 'add') as mock_add:
+            srv.process_request_thread(request, ('127.0.0.1', 1))  # broken connections are found by select()
+            mock_add.assert_called_once()
+        with patch.object(RestApiHandler, 'handle_one_request', Mock(side_effect=Exception)):
+            srv.process_request_thread(request, ('127.0.0.1', 1))
+        srv.shutdown_request.assert_called_once_with(request)
+
+    @patch.object(MockRestApiServer, 'shutdown_request')
+    def test_workers(self, mock_shutdown_request):
+        srv = MockRestApiServer(lambda a1, a2, a3: None, '', {'listen': '127.0.0.1:8008', 'workers': 1, 'backlog': 1})
+        processed = []
+        release = Event()
+
+        def process_request_thread(request, client_address):
+            if request == 'stream':
+                srv.detach_worker()
+                release.wait(5)
+            processed.append(request)
+
+        with patch.object(srv, 'process_request_thread', Mock(side_effect=process_request_thread)):
+            srv.process_request('stream', ('127.0.0.1', 1))
+            for _ in polling_loop(5, 0.01):
+                if srv.process_request_thread.called:
+                    break
+            srv.process_request('foo', ('127.0.0.1', 2))  # is processed by the replacement worker
+            for _ in polling_loop(5, 0.01):
+                if processed:
+                    break
+            self.assertEqual(processed, ['foo'])
+            release.set()
+            srv.reload_config({'listen': '127.0.0.1:8008', 'workers': 0})
+            with patch.object(ThreadingMixIn, 'process_request') as mock_process_request:
+                srv.process_request('bar', ('127.0.0.1', 3))
+                mock_process_request.assert_called_once()
+
+        srv._RestApiServer__requests = Mock()
+        srv._RestApiServer__workers = 1
+        srv._RestApiServer__requests.put_nowait.side_effect = Full
+        srv.process_request('baz', ('127.0.0.1', 4))
+        mock_shutdown_request.assert_called_once_with('baz')
+
+    @patch.object(MockRestApiServer, 'shutdown_request', Mock())
+    def test_shrink_workers_with_full_queue(self):
+        srv = MockRestApiServer(lambda a1, a2, a3: None, '', {'listen': '127.0.0.1:8008', 'workers': 2, 'backlog': 1})
+        release = Event()
+        with patch.object(srv, 'process_request_thread', Mock(side_effect=lambda *args: release.wait(5))):
+            for i in range(4):  # two requests occupy workers and two fill the queue
+                srv.process_request(i, ('127.0.0.1', i))
+                for _ in polling_loop(5, 0.01):
+                    if i > 1 or srv.process_request_thread.call_count > i:
+                        break
+            srv.reload_config({'listen': '127.0.0.1:8008', 'workers': 1, 'backlog': 1})  # doesn't block
+            release.set()
+            for _ in polling_loop(5, 0.01):
+                if srv._RestApiServer__running_workers == 1:
+                    break
+            self.assertEqual(srv._RestApiServer__running_workers, 1)
+            for _ in polling_loop(5, 0.01):
+                if srv.process_request_thread.call_count == 4:
+                    break
+            self.assertEqual(srv.process_request_thread.call_count, 4)
+
+    def test_request_deadline(self):
+        srv = MockRestApiServer(lambda a1, a2, a3: None, '', {'listen': '127.0.0.1:8008', 'keepalive': 'on',
+                                                              'request_timeout': 5, 'fast_health_checks': 'on'})
+        a, b = socket.socketpair()
+        b.sendall(b'GET /master HTTP/1.1\r\n\r\n')
+        b.shutdown(socket.SHUT_WR)  # the client doesn't send the next request
+        handler = RestApiHandler(a, ('127.0.0.1', 1), srv)
+        self.assertTrue(handler.close_connection)
+        self.assertTrue(b.recv(1024).startswith(b'HTTP/1.1 200'))
+        handler.deadline = time.time() - 1
+        self.assertRaises(socket.timeout, handler._apply_deadline)
+        handler.deadline = None
+        handler._apply_deadline()
+        self.assertEqual(a.gettimeout(), 5)
+        for s in (a, b):
+            s.close()
+
+
+class TestIdleConnections(unittest.TestCase):
+
+    def test_run(self):
+        dispatch, close = Mock(), Mock()
+        idle = IdleConnections(dispatch, close)
+        a, b = socket.socketpair()
+        c, d = socket.socketpair()
+        idle.add(a, ('127.0.0.1', 1), 2, 5)
+        idle.add(c, ('127.0.0.1', 2), 1, 0.01)
+        b.sendall(b'GET')
+        for _ in polling_loop(5, 0.01):
+            idle._run_once()
+            if close.called:
+                break
+        dispatch.assert_called_once_with(a, ('127.0.0.1', 1), 2)
+        close.assert_called_once_with(c)
+        with patch('select.select', Mock(side_effect=ValueError)):
+            idle.add(a, ('127.0.0.1', 1), 3, 0)
+            idle._run_once()
+        dispatch.assert_called_with(a, ('127.0.0.1', 1), 3)
+        for s in (a, b, c, d):
+            s.close()
@@ -1,7 +1,7 @@
 import unittest
 
 from mock import Mock, patch
-from patroni.async_executor import AsyncExecutor, CriticalTask
+from patroni.async_executor import AsyncExecutor, CriticalTask, DCSWriteScheduler
 from threading import Thread
 
 
@@ -30,3 +30,48 @@ class TestCriticalTask(unittest.TestCase):
         ct = CriticalTask()
         ct.complete(1)
         self.assertFalse(ct.cancel())
+
+
+@patch.object(Thread, 'start', Mock())
+class TestDCSWriteScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.s = DCSWriteScheduler()
+
+    def test_schedule(self):
+        func = Mock(side_effect=[None, Exception, KeyboardInterrupt])
+        self.s.schedule('foo', func, (1,))
+        self.s.schedule('foo', func, (2,))
+        self.s.schedule('bar', func, (3,), priority=-1)
+        self.s.schedule('stale', func, (4,), priority=-2, timeout=-1)
+        self.s.schedule('buzz', func, (5,))
+        self.s.schedule('cancelled', func, (6,))
+        self.assertEqual(self.s.pending, ['bar', 'buzz', 'cancelled', 'foo', 'stale'])
+        self.assertTrue(self.s.cancel('cancelled'))
+        self.assertFalse(self.s.cancel('cancelled'))
+        self.assertRaises(KeyboardInterrupt, self.s.run)
+        self.assertEqual([c[0] for c in func.call_args_list], [(3,), (2,), (5,)])
+
+    def test_priority(self):
+        self.s.schedule('foo', Mock())
+        with self.s.priority(), patch.object(self.s._condition, 'wait', Mock(side_effect=Exception)):
+            self.assertRaises(Exception, self.s._next)
+        self.assertEqual(self.s._next()[0], 'foo')
+
+    def test_enter_waits_for_running_write(self):
+        self.s._running = True
+
+        def finish_write(*args):
+            self.s._running = False
+
+        with patch.object(self.s._condition, 'wait', Mock(side_effect=finish_write)) as mock_wait:
+            with self.s.priority(10):
+                mock_wait.assert_called_once()
+
+        # the wait is bounded, the block is entered while the write is still running
+        self.s._running = True
+        with patch.object(self.s._condition, 'wait', Mock()) as mock_wait, \
+                patch('time.time', Mock(side_effect=[1, 2, 2, 3])):
+            with self.s.priority(2):
+                self.assertTrue(self.s._running)
+            mock_wait.assert_called_once_with(1)
@@ -0,0 +1,54 @@
+import psycopg2
+import unittest
+
+from mock import Mock, patch
+from patroni.connection_pool import ConnectionPool
+from patroni.exceptions import PostgresConnectionException
+from test_postgresql import MockConnect, MockCursor
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = Mock(side_effect=lambda: MockConnect())
+        self.pool = ConnectionPool(self.connect, max_size=2, timeout=0.01, check_interval=30)
+
+    def test_connection(self):
+        with self.pool.connection() as conn1:
+            with self.pool.connection() as conn2:
+                self.assertIsNot(conn1, conn2)
+                self.assertRaises(PostgresConnectionException, self.pool.connection().__enter__)
+        with self.pool.connection() as conn:
+            self.assertIn(conn, (conn1, conn2))
+        stats = self.pool.stats()
+        self.assertEqual(stats['created'], 2)
+        self.assertEqual(stats['idle'], 2)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['timeouts'], 1)
+
+    def test_health_check(self):
+        with self.pool.connection() as conn:
+            pass
+        conn.closed = 1
+        with self.pool.connection() as conn2:
+            self.assertIsNot(conn, conn2)
+        with patch('time.time', Mock(return_value=1e10)), \
+                patch.object(MockCursor, 'execute', Mock(side_effect=psycopg2.OperationalError)):
+            with self.pool.connection() as conn:
+                self.assertIsNot(conn, conn2)
+        self.assertEqual(self.pool.stats()['health_check_failures'], 2)
+
+    def test_connect_failure(self):
+        self.connect.side_effect = psycopg2.OperationalError
+        self.assertRaises(PostgresConnectionException, self.pool.connection().__enter__)
+        self.connect.side_effect = ValueError
+        self.assertRaises(ValueError, self.pool.connection().__enter__)
+        self.assertEqual(self.pool.size, 0)
+
+    @patch.object(MockConnect, 'close', Mock(side_effect=Exception))
+    def test_close(self):
+        with self.pool.connection():
+            with self.pool.connection():
+                pass
+            self.pool.close()
+        self.assertEqual(self.pool.size, 0)
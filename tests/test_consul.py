@@ -1,11 +1,14 @@
 import consul
+import json
+import time
 import unittest
 
 from consul import ConsulException, NotFound
 from mock import Mock, patch
-from patroni.dcs.consul import AbstractDCS, Cluster, Consul, ConsulInternalError, \
+from patroni.dcs.consul import AbstractDCS, Cluster, ClusterConfig, Consul, ConsulInternalError, \
                                 ConsulError, HTTPClient, InvalidSessionTTL, InvalidSession
 from test_etcd import SleepException
+from threading import Thread
 
 
 def kv_get(self, key, **kwargs):
@@ -65,6 +68,9 @@ class TestHTTPClient(unittest.TestCase):
     def test_put(self):
         self.client.put(Mock(), '/v1/session/create')
         self.client.put(Mock(), '/v1/session/create', params=[], data='{"foo": "bar"}')
+        self.assertEqual(self.client.last_kv_write, 0)
+        self.client.put(Mock(), '/v1/kv/service/good/leader')
+        self.assertGreater(self.client.last_kv_write, 0)
 
 
 @patch.object(consul.Consul.KV, 'get', kv_get)
@@ -112,6 +118,18 @@ class TestConsul(unittest.TestCase):
         self.c._session = 'fd4f44fe-2cac-bba5-a60b-304b51ff39b8'
         self.assertIsInstance(self.c.get_cluster(), Cluster)
 
+    def test_get_cluster_reuses_parsed_nodes(self):
+        self.c._base_path = '/service/good'
+        cluster = self.c.get_cluster()
+        self.assertEqual(self.c._cluster_index, '6429')
+        with patch.object(ClusterConfig, 'from_node') as mock_from_node:
+            new_cluster = self.c.get_cluster()
+            mock_from_node.assert_not_called()
+        self.assertIs(new_cluster.config, cluster.config)
+        self.assertIs(new_cluster.members[0], cluster.members[0])
+        self.c._nodes_cache['members/postgresql0'] = (1, None)  # ModifyIndex has changed
+        self.assertIsNot(self.c.get_cluster().members[0], cluster.members[0])
+
     @patch.object(consul.Consul.KV, 'delete', Mock(side_effect=[ConsulException, True, True, True]))
     @patch.object(consul.Consul.KV, 'put', Mock(side_effect=[True, ConsulException, InvalidSession]))
     def test_touch_member(self):
@@ -123,6 +141,31 @@ class TestConsul(unittest.TestCase):
         for _ in range(0, 4):
             self.c.touch_member({'balbla': 'blabla'})
 
+    @patch.object(consul.Consul.KV, 'put', Mock(return_value=True))
+    def test_touch_member_cached(self):
+        self.c.refresh_session = Mock(return_value=False)
+        self.c._session = 'fd4f44fe-2cac-bba5-a60b-304b51ff39b7'
+        self.assertTrue(self.c.touch_member({'foo': 'bar'}))
+        self.assertEqual(self.c._cached_member({'foo': 'bar'}), (True, None))
+        self.assertTrue(self.c.touch_member({'foo': 'bar'}))
+        self.assertEqual(consul.Consul.KV.put.call_count, 1)
+
+    @patch.object(consul.Consul.KV, 'delete', Mock())
+    def test_touch_member_invalid_session(self):
+        self.c.refresh_session = Mock(return_value=False)
+        self.c._session = 'old'
+
+        def replace_session(*args, **kwargs):
+            self.c._session = 'new'  # the HA loop has created a new session in the meantime
+            raise InvalidSession
+
+        with patch.object(consul.Consul.KV, 'put', Mock(side_effect=replace_session)):
+            self.assertFalse(self.c.touch_member({'foo': 'bar'}))
+        self.assertEqual(self.c._session, 'new')
+        with patch.object(consul.Consul.KV, 'put', Mock(side_effect=InvalidSession)):
+            self.assertFalse(self.c.touch_member({'foo': 'bar'}))
+        self.assertIsNone(self.c._session)
+
     @patch.object(consul.Consul.KV, 'put', Mock(side_effect=InvalidSession))
     def test_take_leader(self):
         self.c.set_ttl(20)
@@ -169,6 +212,91 @@ class TestConsul(unittest.TestCase):
         with patch.object(consul.Consul.KV, 'get', Mock(side_effect=ConsulException)):
             self.c.watch(6429, 1)
 
+    @patch.object(AbstractDCS, '_start_prefix_watcher', Mock())
+    def test_watch_prefix(self):
+        self.c._watch_prefix = True
+        with patch.object(consul.Consul.KV, 'get') as mock_get:
+            self.c.watch(6429, 0)
+            mock_get.assert_not_called()
+
+        nodes = [{'Key': 'service/good/leader', 'ModifyIndex': 6429},
+                 {'Key': 'service/good/config', 'ModifyIndex': 6430}]
+        self.c._nodes_cache = {'leader': (6429, None), 'config': (6420, None)}
+        with patch.object(consul.Consul.KV, 'get', Mock(return_value=('6430', nodes))) as mock_get:
+            self.assertEqual(self.c._watch_prefix_changes(1), ['config'])
+            mock_get.assert_called_with('service/good/', recurse=True, index='6429', wait='1s')
+            self.assertEqual(self.c._prefix_watch_index, '6430')
+            self.assertEqual(self.c._watch_prefix_changes(1), [])
+
+        self.c._prefix_watch_index = self.c._cluster_index = None
+        self.c._prefix_watch_results = None
+        with patch.object(consul.Consul.KV, 'get', Mock(return_value=('6430', nodes))) as mock_get:
+            self.assertEqual(self.c._watch_prefix_changes(1), [])
+            mock_get.assert_called_with('service/good/', recurse=True)
+            self.assertEqual(self.c._prefix_watch_state, {'leader': 6429, 'config': 6430})
+
+    def test_get_cluster_from_prefix_watch(self):
+        self.c._base_path = '/service/good'
+        self.c.get_cluster()
+        nodes = kv_get(None, 'service/good/')[1]
+        self.c._prefix_watch_index = '6429'
+        self.c._prefix_watch_results = nodes
+        self.c._prefix_watch_state = {n['Key'][len('service/good/'):]: n['ModifyIndex'] for n in nodes}
+
+        def blocking_get(*args, **kwargs):
+            with patch.object(consul.Consul.KV, 'get', Mock(side_effect=Exception)):
+                cluster = self.c.get_cluster()  # nodes seen by the blocked watcher are used
+            self.assertEqual(cluster.leader.name, 'postgresql1')
+            self.c._client.http.last_kv_write = time.time() + 1  # our own write isn't seen by the watcher yet
+            with patch.object(consul.Consul.KV, 'get', Mock(side_effect=ConsulException)) as mock_get:
+                self.assertRaises(ConsulError, self.c.get_cluster)
+                mock_get.assert_called_once()
+            return '6429', nodes
+
+        with patch.object(consul.Consul.KV, 'get', Mock(side_effect=blocking_get)):
+            self.assertEqual(self.c._watch_prefix_changes(1), [])
+        self.assertIsNone(self.c._prefix_watch_snapshot)
+
+    @patch.object(consul.Consul.KV, 'put', Mock(return_value=True))
+    def test_batch(self):
+        self.c._session = 'fd4f44fe-2cac-bba5-a60b-304b51ff39b7'
+        self.c._name = 'postgresql1'
+        self.c.get_cluster()
+        with patch.object(self.c._client, 'http') as mock_http:
+            with self.c.batch():
+                with self.c.batch():
+                    self.assertTrue(self.c.set_history_value('[]'))
+                self.c.write_leader_optime(1)
+                self.assertTrue(self.c.manual_failover('', ''))
+                # conditional writes and writes from other threads are not postponed
+                self.assertTrue(self.c.manual_failover('', '', index=3))
+                consul.Consul.KV.put.assert_called_with('service/good/failover', '{}', cas=3)
+                thread = Thread(target=self.c.set_history_value, args=('[]',))
+                thread.start()
+                thread.join()
+                self.assertEqual(consul.Consul.KV.put.call_count, 2)
+                mock_http.put.assert_not_called()
+            operations = json.loads(mock_http.put.call_args[1]['data'])
+            self.assertEqual([o['KV']['Verb'] for o in operations], ['check-session', 'set', 'set', 'set'])
+            self.assertEqual(self.c._last_leader_operation, 1)
+
+            # when the transaction fails writes are retried one by one
+            mock_http.put.side_effect = consul.base.ClientError('409 rollback')
+            with self.c.batch():
+                self.c.write_leader_optime(2)
+                self.c.set_history_value('[]')
+            self.assertEqual(self.c._last_leader_operation, '')
+            consul.Consul.KV.put.assert_called_with('service/good/history', '[]')
+            with patch.object(consul.Consul.KV, 'put', Mock(side_effect=Exception)), self.c.batch():
+                self.c.set_history_value('[]')
+
+            mock_http.put.side_effect = None
+            self.assertTrue(self.c._write_leader_optime(3))
+            self.assertEqual(len(json.loads(mock_http.put.call_args[1]['data'])), 2)
+            self.c._session = None
+            self.assertTrue(self.c._write_leader_optime(3))
+            consul.Consul.KV.put.assert_called_with('service/good/optime/leader', 3)
+
     def test_set_retry_timeout(self):
         self.c.set_retry_timeout(10)
 
@@ -6,7 +6,7 @@ import socket
 import unittest
 
 from dns.exception import DNSException
-from mock import Mock, patch
+from mock import Mock, PropertyMock, patch
 from patroni.dcs.etcd import AbstractDCS, Client, Cluster, Etcd, EtcdError, DnsCachingResolver
 from patroni.exceptions import DCSError
 from urllib3.exceptions import ReadTimeoutError
@@ -291,6 +291,41 @@ class TestEtcd(unittest.TestCase):
     def test_touch_member(self):
         self.assertFalse(self.etcd.touch_member('', ''))
 
+    @patch.object(etcd.Client, 'cluster_version', PropertyMock(return_value='3.4.0'), create=True)
+    def test_touch_member_refresh(self):
+        data = {'state': 'running'}
+        with patch.object(self.etcd._client, 'set', Mock(return_value=Mock(modifiedIndex=10))) as mock_set, \
+                patch.object(self.etcd._client, 'write') as mock_write:
+            self.assertTrue(self.etcd.touch_member(data))
+            mock_write.return_value = Mock(modifiedIndex=11, value='{"state":"running"}')
+            self.assertTrue(self.etcd.touch_member(data))
+            mock_write.assert_called_with('/patroni/test/members/foo', None, ttl=30, refresh=True, prevIndex=10)
+            self.assertEqual(mock_set.call_count, 1)
+            self.assertEqual(self.etcd._cached_member(data), (True, 11))
+
+            mock_write.side_effect = etcd.EtcdCompareFailed
+            self.assertTrue(self.etcd.touch_member(data))
+            self.assertEqual(mock_set.call_count, 2)
+
+            mock_write.side_effect = None
+            mock_write.return_value = Mock(modifiedIndex=11, value='')
+            self.assertTrue(self.etcd.touch_member(data))
+            self.assertEqual(mock_set.call_count, 3)
+            self.assertFalse(self.etcd._ttl_refresh_supported)
+            self.assertTrue(self.etcd.touch_member({'state': 'stopped'}))
+            self.assertEqual(mock_set.call_count, 4)
+            self.assertEqual(mock_write.call_count, 3)
+
+    def test_check_ttl_refresh_support(self):
+        with patch.object(etcd.Client, 'cluster_version', PropertyMock(return_value='2.2.0'), create=True):
+            self.assertFalse(self.etcd._check_ttl_refresh_support())
+        with patch.object(etcd.Client, 'cluster_version', PropertyMock(return_value='foo'), create=True):
+            self.assertFalse(self.etcd._check_ttl_refresh_support())
+        with patch.object(etcd.Client, 'cluster_version', PropertyMock(side_effect=etcd.EtcdException), create=True):
+            self.assertIsNone(self.etcd._check_ttl_refresh_support())
+        with patch.object(etcd.Client, '_comparison_conditions', set(['prevValue', 'prevIndex', 'prevExist'])):
+            self.assertFalse(self.etcd._check_ttl_refresh_support())
+
     def test_take_leader(self):
         self.assertFalse(self.etcd.take_leader())
 
@@ -329,6 +364,44 @@ class TestEtcd(unittest.TestCase):
             self.assertTrue(self.etcd.watch(20729, 19.5))
             self.assertRaises(SleepException, self.etcd.watch, 20729, 9.5)
 
+    @patch.object(AbstractDCS, '_start_prefix_watcher', Mock())
+    def test_watch_prefix(self):
+        self.etcd._watch_prefix = True
+        with patch.object(self.etcd._client, 'watch') as mock_watch:
+            self.assertFalse(self.etcd.watch(20729, 0))
+            mock_watch.assert_not_called()
+        self.assertTrue(self.etcd._watch_leader)
+
+        self.etcd._cluster_index = 20729
+        with patch.object(self.etcd._client, 'watch') as mock_watch:
+            mock_watch.return_value = etcd.EtcdResult(node={'key': '/patroni/test/failover', 'modifiedIndex': 20735})
+            self.assertEqual(self.etcd._watch_prefix_changes(1), ['failover'])
+            mock_watch.assert_called_with('/patroni/test/', index=20730, timeout=1, recursive=True)
+            self.assertEqual(self.etcd._prefix_watch_index, 20736)
+            mock_watch.side_effect = etcd.EtcdWatchTimedOut
+            self.assertEqual(self.etcd._watch_prefix_changes(1), [])
+            mock_watch.side_effect = etcd.EtcdEventIndexCleared
+            self.assertEqual(self.etcd._watch_prefix_changes(1), ['*'])
+            self.assertIsNone(self.etcd._prefix_watch_index)
+
+    def test_relevant_changes(self):
+        keys = ['members/foo', 'optime/leader', 'leader', 'sync', 'config', 'sync']
+        self.assertEqual(self.etcd._relevant_changes(keys), ['config', 'sync'])
+        self.etcd._watch_leader = True
+        self.assertEqual(self.etcd._relevant_changes(keys), ['config', 'leader', 'sync'])
+
+    @patch('time.sleep', Mock(side_effect=SleepException))
+    def test_prefix_watcher_loop(self):
+        with patch.object(Etcd, '_watch_prefix_changes', Mock(side_effect=[['config'], Exception])):
+            self.assertRaises(SleepException, self.etcd._prefix_watcher_loop)
+        self.assertTrue(self.etcd.event.is_set())
+
+    @patch('patroni.dcs.Thread')
+    def test_start_prefix_watcher(self, mock_thread):
+        self.etcd._start_prefix_watcher()
+        self.etcd._start_prefix_watcher()
+        mock_thread.return_value.start.assert_called_once_with()
+
     def test_other_exceptions(self):
         self.etcd.retry = Mock(side_effect=AttributeError('foo'))
         self.assertRaises(EtcdError, self.etcd.cancel_initialization)
@@ -0,0 +1,269 @@
+import json
+import socket
+import unittest
+
+from mock import Mock, patch
+from patroni.dcs.etcd3 import AbstractDCS, Cluster, Etcd3, Etcd3Client, Etcd3ClientError, Etcd3ConnectionFailed, \
+    Etcd3Error, base64_decode, base64_encode, prefix_range_end
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+
+def kv(key, value, mod_revision, lease=None):
+    ret = {'key': base64_encode('/service/test/' + key), 'value': base64_encode(value),
+           'create_revision': '1', 'mod_revision': str(mod_revision)}
+    if lease:
+        ret['lease'] = lease
+    return ret
+
+
+KVS = [kv('initialize', '12345', 2), kv('config', '{}', 3), kv('history', '[[1,1,"foo"]]', 4),
+       kv('leader', 'foo', 5, '123'), kv('optime/leader', '1234', 6), kv('failover', '', 7),
+       kv('sync', '{"leader":"foo","sync_standby":"bar"}', 8),
+       kv('members/foo', '{"conn_url":"postgres://u@h:5432/p","api_url":"http://h:8008/patroni"}', 9, '123'),
+       kv('members/bar', '{"conn_url":"postgres://u@h:5433/p","api_url":"http://h:8009/patroni"}', 10, '124')]
+
+
+class MockResponse(object):
+
+    def __init__(self, status=200, content=None, lines=None):
+        self.status = status
+        self.data = json.dumps(content or {}).encode('utf-8')
+        self.lines = lines or []
+
+    def __iter__(self):
+        for line in self.lines:
+            if isinstance(line, Exception):
+                raise line
+            yield json.dumps(line).encode('utf-8')
+
+    def read(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def urlopen(self, method, url, body=None, **kwargs):
+    path = url.split('2379', 1)[1]
+    body = json.loads(body) if body else {}
+    header = {'header': {'revision': '10'}}
+    if path == '/version':
+        return MockResponse(content={'etcdserver': '3.4.3', 'etcdcluster': '3.4.0'})
+    if path == '/v3/auth/authenticate':
+        return MockResponse(content={'token': 'sometoken'})
+    if path == '/v3/kv/range':
+        key = base64_decode(body['key'])
+        if key == '/service/broken/':
+            raise socket.error
+        if key == '/service/empty/':
+            return MockResponse(content=header)
+        return MockResponse(content=dict(header, kvs=KVS, count=str(len(KVS))))
+    if path == '/v3/kv/txn':
+        return MockResponse(content=dict(header, succeeded=True))
+    if path == '/v3/lease/grant':
+        return MockResponse(content=dict(header, ID='123', TTL='30'))
+    if path == '/v3/lease/keepalive':
+        return MockResponse(content={'result': dict(header, ID='123', TTL='30')})
+    if path == '/v3/watch':
+        event = {'type': 'PUT', 'kv': kv('leader', 'foo', 11)}
+        return MockResponse(lines=[{'result': dict(header, created=True)}, {'result': dict(header, events=[event])}])
+    return MockResponse(content=header)
+
+
+@patch('urllib3.PoolManager.urlopen', urlopen)
+class TestEtcd3Client(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Etcd3Client({'hosts': 'localhost:2379,127.0.0.1:2379', 'username': 'u', 'password': 'p',
+                                   'cacert': 'a', 'cert': 'b', 'key': 'c'}, 10)
+
+    def test_get_endpoints(self):
+        self.assertEqual(Etcd3Client.get_endpoints({'url': 'https://localhost'}), ['https://localhost:2379'])
+        self.assertEqual(Etcd3Client.get_endpoints({'host': 'localhost:2380', 'protocol': 'https'}),
+                         ['https://localhost:2380'])
+        self.assertRaises(Exception, Etcd3Client, {}, 10)
+
+    def test_call(self):
+        self.assertEqual(self.client.call('/kv/put', {})['header']['revision'], '10')
+        self.assertEqual(self.client._token, 'sometoken')
+        with patch('urllib3.PoolManager.urlopen', Mock(side_effect=socket.error)):
+            self.assertRaises(Etcd3ConnectionFailed, self.client.call, '/kv/put', {})
+        self.assertEqual(self.client._base_uri, 'http://localhost:2379')
+
+        error = MockResponse(400, {'error': 'etcdserver: invalid auth token', 'code': 16})
+        with patch('urllib3.PoolManager.urlopen', Mock(side_effect=[error, MockResponse(content={'token': 'a'}),
+                                                                    MockResponse(content={'foo': 'bar'})])):
+            self.client._api_prefix = '/v3'
+            self.assertEqual(self.client.call('/kv/put', {}), {'foo': 'bar'})
+        self.client._username = None
+        with patch('urllib3.PoolManager.urlopen', Mock(return_value=error)):
+            self.assertRaises(Etcd3ClientError, self.client.call, '/kv/put', {})
+        with patch('urllib3.PoolManager.urlopen', Mock(return_value=MockResponse(500))):
+            self.assertRaises(Etcd3ClientError, self.client.call, '/watch', {}, stream=True)
+        response = MockResponse(500)
+        response.data = b'foo'
+        with patch('urllib3.PoolManager.urlopen', Mock(return_value=response)):
+            self.assertRaises(Etcd3ClientError, self.client.call, '/kv/put', {})
+
+    def test_get_api_prefix(self):
+        for version, prefix in (('3.2.26', '/v3alpha'), ('3.3.13', '/v3beta'), ('3.4.3', '/v3')):
+            with patch('urllib3.PoolManager.urlopen', Mock(return_value=MockResponse(content={'etcdserver': version}))):
+                self.assertEqual(self.client._get_api_prefix(), prefix)
+
+    def test_watch(self):
+        self.assertEqual(len(self.client.watch('/service/test/leader', 10, 1)), 1)
+        for lines, expected in (([ReadTimeoutError(None, None, 'timeout')], []),
+                                ([{'result': {'compact_revision': '5', 'canceled': True}}], None)):
+            with patch('urllib3.PoolManager.urlopen', Mock(return_value=MockResponse(lines=lines))):
+                self.assertEqual(self.client.watch('/service/test/', 10, 1, True), expected)
+        with patch('urllib3.PoolManager.urlopen',
+                   Mock(return_value=MockResponse(lines=[ProtocolError('foo', socket.timeout())]))):
+            self.assertEqual(self.client.watch('/service/test/', 10, 1, True), [])
+        with patch('urllib3.PoolManager.urlopen', Mock(return_value=MockResponse(lines=[ProtocolError('foo')]))):
+            self.assertRaises(ProtocolError, self.client.watch, '/service/test/', 10, 1, True)
+
+
+@patch('urllib3.PoolManager.urlopen', urlopen)
+class TestEtcd3(unittest.TestCase):
+
+    def setUp(self):
+        self.etcd3 = Etcd3({'ttl': 30, 'retry_timeout': 10, 'scope': 'test', 'name': 'foo', 'host': 'localhost'})
+
+    def test_prefix_range_end(self):
+        self.assertEqual(base64_decode(prefix_range_end('/service/test/')), '/service/test0')
+        self.assertEqual(base64_decode(prefix_range_end('')), '\0')
+
+    def test_get_cluster(self):
+        cluster = self.etcd3.get_cluster()
+        self.assertIsInstance(cluster, Cluster)
+        self.assertEqual(cluster.leader.name, 'foo')
+        self.assertEqual(cluster.leader.index, 5)
+        self.assertEqual(cluster.last_leader_operation, 1234)
+        self.assertEqual(cluster.sync.sync_standby, 'bar')
+        self.assertEqual(len(cluster.members), 2)
+        self.assertEqual(self.etcd3._cluster_revision, 10)
+
+        self.etcd3._base_path = '/service/empty'
+        self.assertIsNone(self.etcd3.get_cluster().initialize)
+        self.etcd3._base_path = '/service/broken'
+        self.etcd3._retry.deadline = 0.1
+        self.assertRaises(Etcd3Error, self.etcd3.get_cluster)
+
+    def test_touch_member(self):
+        self.etcd3.get_cluster()
+        data = {'conn_url': 'postgres://u@h:5432/p'}
+        with patch.object(Etcd3, '_put', Mock()) as mock_put:
+            self.assertTrue(self.etcd3.touch_member(data))
+            self.assertTrue(self.etcd3.touch_member(data))
+            self.assertEqual(mock_put.call_count, 1)
+            self.assertTrue(self.etcd3.touch_member(data, permanent=True))
+            mock_put.assert_called_with('/service/test/members/foo', '{"conn_url":"postgres://u@h:5432/p"}', None)
+        with patch.object(Etcd3, '_put', Mock(side_effect=Etcd3ClientError(5, 'requested lease not found'))):
+            self.assertFalse(self.etcd3.touch_member({}))
+        self.assertIsNone(self.etcd3._lease)
+        with patch.object(Etcd3, '_put', Mock(side_effect=Exception)):
+            self.assertRaises(Etcd3Error, self.etcd3.touch_member, {})
+
+    def test_touch_member_lease_replaced(self):
+        self.etcd3.get_cluster()
+        data = {'conn_url': 'postgres://u@h:5432/p'}
+
+        def replace_lease(*args):
+            self.etcd3._lease = '456'  # the HA loop has granted a new lease meanwhile
+
+        with patch.object(Etcd3, '_put', Mock(side_effect=replace_lease)) as mock_put:
+            self.assertTrue(self.etcd3.touch_member(data))
+            self.assertEqual(mock_put.call_args[0][2], '123')
+            mock_put.side_effect = None
+            # the key wasn't cached and is written again, attached to the new lease
+            self.assertTrue(self.etcd3.touch_member(data))
+            self.assertEqual(mock_put.call_args[0][2], '456')
+            self.assertTrue(self.etcd3.touch_member(data))
+            self.assertEqual(mock_put.call_count, 2)
+
+    def test_refresh_lease(self):
+        self.assertFalse(self.etcd3._refresh_lease())
+        self.etcd3._get_lease()
+        self.assertTrue(self.etcd3._refresh_lease())
+        self.etcd3._lease_refreshed = 0
+        self.assertTrue(self.etcd3._refresh_lease())
+        self.etcd3._lease_refreshed = 0
+        with patch('urllib3.PoolManager.urlopen', Mock(return_value=MockResponse(content={'result': {'ID': '123'}}))):
+            self.assertFalse(self.etcd3._refresh_lease())
+        self.assertIsNone(self.etcd3._lease)
+
+    def test_attempt_to_acquire_leader(self):
+        self.assertTrue(self.etcd3.attempt_to_acquire_leader())
+        self.assertEqual(self.etcd3._leader_lease, '123')
+        with patch.object(Etcd3, '_txn', Mock(return_value=None)):
+            self.assertFalse(self.etcd3.attempt_to_acquire_leader(True))
+        with patch.object(Etcd3, '_txn', Mock(side_effect=Etcd3ClientError(5, 'requested lease not found'))):
+            self.assertFalse(self.etcd3.attempt_to_acquire_leader())
+        self.assertIsNone(self.etcd3._lease)
+
+    def test_update_leader(self):
+        txn_response = {'succeeded': True, 'header': {'revision': '11'}}
+        with patch.object(Etcd3, '_txn', Mock(return_value=txn_response)) as mock_txn:
+            self.assertTrue(self.etcd3.update_leader(None))
+            self.assertEqual(len(mock_txn.call_args[0][1]), 1)  # the leader key is attached to the new lease
+            self.assertEqual(len(mock_txn.call_args[0][0]), 1)  # mod_revision of the leader key is unknown
+            self.assertEqual(self.etcd3._leader_revision, 11)
+            with patch.object(Etcd3Client, 'call', Mock(wraps=self.etcd3._client.call)) as mock_call:
+                self.assertTrue(self.etcd3.update_leader(None))
+                # the lease is kept alive on every update of the leader lock
+                mock_call.assert_called_with('/lease/keepalive', {'ID': '123'})
+            self.assertEqual(mock_txn.call_args[0][1], [])
+            self.assertEqual(mock_txn.call_args[0][0][1]['target'], 'MOD')
+            self.assertEqual(mock_txn.call_args[0][0][1]['mod_revision'], 11)
+            mock_txn.return_value = None
+            self.assertFalse(self.etcd3.update_leader(None))
+
+            # the mod_revision is taken from the leader key we have read
+            self.etcd3._leader_revision = None
+            self.etcd3._name = 'foo'
+            self.etcd3.get_cluster()
+            self.assertFalse(self.etcd3.update_leader(None))
+            self.assertEqual(mock_txn.call_args[0][0][1]['mod_revision'], self.etcd3.cluster.leader.index)
+
+    def test_take_leader(self):
+        self.assertTrue(self.etcd3.take_leader())
+
+    def test_other_operations(self):
+        self.assertTrue(self.etcd3.set_failover_value('', 1))
+        self.assertTrue(self.etcd3.set_config_value('{}'))
+        self.assertTrue(self.etcd3._write_leader_optime('0'))
+        self.assertTrue(self.etcd3.initialize())
+        self.assertTrue(self.etcd3.initialize(False, '123'))
+        self.assertTrue(self.etcd3.delete_leader())
+        self.assertTrue(self.etcd3.cancel_initialization())
+        self.assertTrue(self.etcd3.delete_cluster())
+        self.assertTrue(self.etcd3.set_history_value('[]'))
+        self.assertTrue(self.etcd3.set_sync_state_value('{}', 1))
+        self.assertTrue(self.etcd3.delete_sync_state())
+        self.assertTrue(self.etcd3.delete_sync_state(1))
+        with patch.object(Etcd3, '_txn', Mock(return_value=None)):
+            self.assertFalse(self.etcd3.set_config_value('{}', 1))
+
+    def test_set_ttl(self):
+        self.etcd3.set_ttl(20)
+        self.assertEqual(self.etcd3.ttl, 20)
+        self.assertTrue(self.etcd3.watch(None, 1))
+        self.etcd3.set_retry_timeout(5)
+        self.assertEqual(self.etcd3._client.read_timeout, 5)
+
+    def test_watch(self):
+        self.assertFalse(self.etcd3.watch(None, 0))
+        self.etcd3.get_cluster()
+        self.assertTrue(self.etcd3.watch(5, 10))
+        with patch.object(Etcd3Client, 'watch', Mock(side_effect=[Etcd3ConnectionFailed('foo'), []])), \
+                patch('time.sleep', Mock()):
+            self.etcd3._has_failed = True
+            self.assertFalse(self.etcd3.watch(5, 2))
+
+    @patch.object(AbstractDCS, '_start_prefix_watcher', Mock())
+    def test_watch_prefix_changes(self):
+        self.assertEqual(self.etcd3._watch_prefix_changes(1), ['leader'])
+        self.assertEqual(self.etcd3._prefix_watch_revision, 12)
+        with patch.object(Etcd3Client, 'watch', Mock(return_value=None)):
+            self.assertEqual(self.etcd3._watch_prefix_changes(1), ['*'])
+        self.assertIsNone(self.etcd3._prefix_watch_revision)
@@ -3,13 +3,16 @@ import etcd
 import os
 import unittest
 import sys
+import time
 
 from mock import Mock, MagicMock, PropertyMock, patch
+from patroni.async_executor import DCSWriteScheduler
 from patroni.config import Config
 from patroni.dcs import Cluster, ClusterConfig, Failover, Leader, Member, get_dcs, SyncState, TimelineHistory
 from patroni.dcs.etcd import Client
 from patroni.exceptions import DCSError, PostgresConnectionException, PatroniException
 from patroni.ha import Ha, _MemberStatus
+from patroni.metrics import CycleTimings, DCS_OPERATION_SECONDS, DEMOTIONS, HA_CYCLE_SECONDS, LEADER_LOCK_LOSSES
 from patroni.postgresql import Postgresql
 from patroni.watchdog import Watchdog
 from patroni.utils import tzutc
@@ -19,6 +22,10 @@ from test_postgresql import psycopg2_connect, MockPostmaster
 SYSID = '12345678901'
 
 
+def http_urlopen(self, method, url, **kwargs):
+    return requests_get('{0}://{1}:{2}{3}'.format(self.scheme, self.host, self.port, url), **kwargs)
+
+
 def true(*args, **kwargs):
     return True
 
@@ -191,12 +198,70 @@ class TestHa(unittest.TestCase):
     def test_update_lock(self):
         self.p.last_operation = Mock(side_effect=PostgresConnectionException(''))
         self.assertTrue(self.ha.update_lock(True))
+        lock_losses = LEADER_LOCK_LOSSES.get()
+        with patch.object(self.ha.dcs, 'update_leader', Mock(return_value=False)):
+            self.assertFalse(self.ha.update_lock())
+        self.assertEqual(LEADER_LOCK_LOSSES.get(), lock_losses + 1)
+        self.assertIsNotNone(DCS_OPERATION_SECONDS.get(backend='etcd', operation='update_leader'))
 
     def test_touch_member(self):
         self.p.timeline_wal_position = Mock(return_value=(0, 1))
         self.p.replica_cached_timeline = Mock(side_effect=Exception)
         self.ha.touch_member()
 
+    def test_renew_lock_if_expiring(self):
+        self.assertIsNone(self.ha.lock_expires_in())
+        self.assertFalse(self.ha.renew_lock_if_expiring())
+        self.ha.set_is_leader(True)
+        self.assertFalse(self.ha.renew_lock_if_expiring())
+        self.ha.set_is_leader(True, time.time() - 15)
+        with patch.object(Ha, 'update_lock', Mock(return_value=True)) as mock_update_lock:
+            self.assertTrue(self.ha.renew_lock_if_expiring())
+            mock_update_lock.assert_called_once_with()
+
+    @patch.object(DCSWriteScheduler, 'schedule')
+    def test_touch_member_async(self, mock_schedule):
+        self.ha.touch_member(wait=False)
+        mock_schedule.assert_not_called()
+        self.ha.patroni.config.set_dynamic_configuration({'async_member_updates': True})
+        with patch.object(self.ha.dcs, 'touch_member', Mock(return_value=True)) as mock_touch_member:
+            self.assertTrue(self.ha.touch_member(wait=False))
+            mock_touch_member.assert_not_called()
+            _, func, (data, seq) = mock_schedule.call_args[0]
+            self.assertTrue(self.ha.touch_member())
+            self.assertEqual(mock_touch_member.call_count, 1)
+            self.assertTrue(func(data, seq))  # the newer member data were already published
+            self.assertEqual(mock_touch_member.call_count, 1)
+
+    def test__wal_position_to_publish(self):
+        self.ha.patroni.config.set_dynamic_configuration({'xlog_location_min_delta': 100,
+                                                          'xlog_location_min_interval': 10})
+        data = {'role': 'replica', 'state': 'running'}
+        self.p.get_master_timeline = Mock(return_value=0)
+        self.p.replica_cached_timeline = Mock(return_value=2)
+        self.p.timeline_wal_position = Mock(return_value=(2, 1000))
+        self.assertEqual(self.ha._wal_position_to_publish(data), (2, 1000))
+        self.p.timeline_wal_position.return_value = (2, 1050)
+        self.assertEqual(self.ha._wal_position_to_publish(data), (2, 1000))
+        self.p.timeline_wal_position.assert_called_once()
+        # the timeline has changed within min_interval
+        self.p.replica_cached_timeline.return_value = 3
+        self.p.timeline_wal_position.return_value = (3, 1060)
+        self.assertEqual(self.ha._wal_position_to_publish(data), (3, 1060))
+        self.p.replica_cached_timeline.return_value = 2
+        self.p.timeline_wal_position.return_value = (2, 1050)
+        self.assertEqual(self.ha._wal_position_to_publish(data), (2, 1050))
+        self.p.timeline_wal_position.reset_mock()
+        self.p.timeline_wal_position.return_value = (2, 1080)
+        self.assertEqual(self.ha._wal_position_to_publish(data), (2, 1050))
+        self.p.timeline_wal_position.assert_not_called()
+        self.ha._published_wal['time'] -= 11
+        self.assertEqual(self.ha._wal_position_to_publish(data), (2, 1050))
+        self.p.timeline_wal_position.return_value = (2, 1150)
+        self.assertEqual(self.ha._wal_position_to_publish(data), (2, 1150))
+        self.p.timeline_wal_position.return_value = (3, 1200)
+        self.assertEqual(self.ha._wal_position_to_publish({'role': 'master', 'state': 'running'}), (3, 1200))
+
     def test_is_leader(self):
         self.assertFalse(self.ha.is_leader())
 
@@ -365,8 +430,31 @@ class TestHa(unittest.TestCase):
         self.assertEqual(self.ha.run_cycle(), 'running pg_rewind from leader')
 
     def test_no_etcd_connection_master_demote(self):
+        demotions, cycles = DEMOTIONS.get(mode='offline') or 0, sum(HA_CYCLE_SECONDS.get()[:-1])
         self.ha.load_cluster_from_dcs = Mock(side_effect=DCSError('Etcd is not responding properly'))
         self.assertEqual(self.ha.run_cycle(), 'demoted self because DCS is not accessible and i was a leader')
+        self.assertEqual(DEMOTIONS.get(mode='offline'), demotions + 1)
+        self.assertEqual(sum(HA_CYCLE_SECONDS.get()[:-1]), cycles + 1)
+
+    @patch.object(Ha, '_run_cycle', Mock(return_value='foo'))
+    def test_slow_cycle_logging(self):
+        with patch('patroni.ha.logger.warning') as mock_warning:
+            self.ha.run_cycle()
+            mock_warning.assert_not_called()
+            self.ha.patroni.config.set_dynamic_configuration({'slow_cycle_ttl_percentage': 1})
+            with patch.object(CycleTimings, 'finish', Mock(return_value={'duration': 1})):
+                self.ha.run_cycle()
+            self.assertTrue(mock_warning.call_args[0][0].startswith('HA cycle took'))
+        self.assertEqual(self.ha.cycle_timings.history()[-1]['result'], 'foo')
+
+    def test_last_cycle_age(self):
+        self.ha._last_cycle_time = 0
+        self.ha.load_cluster_from_dcs = Mock(side_effect=DCSError('Etcd is not responding properly'))
+        self.ha.run_cycle()
+        self.assertGreater(self.ha.last_cycle_age(), 1)
+        self.ha.load_cluster_from_dcs = Mock()
+        self.ha.run_cycle()
+        self.assertLess(self.ha.last_cycle_age(), 1)
 
     @patch('time.sleep', Mock())
     def test_bootstrap_from_another_member(self):
@@ -458,7 +546,7 @@ class TestHa(unittest.TestCase):
                     self.assertEqual(self.ha.run_cycle(), 'lost leader lock during restart')
                     mock_terminate.assert_called()
 
-    @patch('requests.get', requests_get)
+    @patch('urllib3.connectionpool.HTTPConnectionPool.urlopen', http_urlopen)
     def test_manual_failover_from_leader(self):
         self.ha.fetch_node_status = get_node_status()
         self.ha.has_lock = true
@@ -506,7 +594,7 @@ class TestHa(unittest.TestCase):
         self.ha.cluster = get_cluster_initialized_with_leader(Failover(0, 'blabla', self.p.name, scheduled))
         self.assertEqual('no action.  i am the leader with the lock', self.ha.run_cycle())
 
-    @patch('requests.get', requests_get)
+    @patch('urllib3.connectionpool.HTTPConnectionPool.urlopen', http_urlopen)
     def test_manual_failover_from_leader_in_pause(self):
         self.ha.has_lock = true
         self.ha.is_paused = true
@@ -516,7 +604,7 @@ class TestHa(unittest.TestCase):
         self.ha.cluster = get_cluster_initialized_with_leader(Failover(0, self.p.name, '', None))
         self.assertEqual('PAUSE: no action.  i am the leader with the lock', self.ha.run_cycle())
 
-    @patch('requests.get', requests_get)
+    @patch('urllib3.connectionpool.HTTPConnectionPool.urlopen', http_urlopen)
     def test_manual_failover_from_leader_in_synchronous_mode(self):
         self.p.is_leader = true
         self.ha.has_lock = true
@@ -529,7 +617,7 @@ class TestHa(unittest.TestCase):
         self.ha.is_failover_possible = true
         self.assertEqual('manual failover: demoting myself', self.ha.run_cycle())
 
-    @patch('requests.get', requests_get)
+    @patch('urllib3.connectionpool.HTTPConnectionPool.urlopen', http_urlopen)
     def test_manual_failover_process_no_leader(self):
         self.p.is_leader = false
         self.ha.cluster = get_cluster_initialized_without_leader(failover=Failover(0, '', self.p.name, None))
@@ -579,7 +667,7 @@ class TestHa(unittest.TestCase):
         self.ha.is_paused = true
         self.assertFalse(self.ha.is_healthiest_node())
 
-    @patch('requests.get', requests_get)
+    @patch('urllib3.connectionpool.HTTPConnectionPool.urlopen', http_urlopen)
     def test__is_healthiest_node(self):
         self.assertTrue(self.ha._is_healthiest_node(self.ha.old_cluster.members))
         self.p.is_leader = false
@@ -597,13 +685,67 @@ class TestHa(unittest.TestCase):
         self.assertFalse(self.ha._is_healthiest_node(self.ha.old_cluster.members))
         self.ha.patroni.nofailover = False
 
-    @patch('requests.get', requests_get)
+    @patch('urllib3.connectionpool.HTTPConnectionPool.urlopen', http_urlopen)
     def test_fetch_node_status(self):
         member = Member(0, 'test', 1, {'api_url': 'http://127.0.0.1:8011/patroni'})
         self.ha.fetch_node_status(member)
         member = Member(0, 'test', 1, {'api_url': 'http://localhost:8011/patroni'})
         self.ha.fetch_node_status(member)
 
+    @patch('patroni.request.MemberStatusStream.start', Mock())
+    def test_fetch_node_status_from_stream(self):
+        self.ha.patroni.config['restapi']['use_status_stream'] = 'on'
+        Ha.load_cluster_from_dcs(self.ha)
+        member = [m for m in self.ha.cluster.members if m.name in self.ha._status_cache._streams][0]
+        self.ha._status_cache._streams[member.name]._set_status({'role': 'replica', 'xlog': {'replayed_location': 5}})
+        others = [m for m in self.ha.cluster.members if m.name != member.name]
+        with patch.object(self.ha, '_member_pools') as mock_pools:
+            # members without a fresh streamed status are skipped, no requests are made
+            self.assertEqual([st.wal_position for st in self.ha.streamed_nodes_statuses(others + [member])], [5])
+            mock_pools.assert_not_called()
+        with patch.object(self.ha, '_member_pools') as mock_pools, \
+                patch('patroni.postgresql.Postgresql.timeline_wal_position', Mock(return_value=(1, 1))):
+            # the streamed status disqualifies us without polling
+            self.assertFalse(self.ha._is_healthiest_node([member], check_replication_lag=False))
+            mock_pools.assert_not_called()
+        with patch.object(self.ha, '_member_pools') as mock_pools, \
+                patch('patroni.postgresql.Postgresql.timeline_wal_position', Mock(return_value=(1, 10))):
+            # the final decision in the leader race is made on freshly polled statuses
+            mock_pools.return_value.data = b'{"role": "replica", "xlog": {"replayed_location": 15}}'
+            self.assertFalse(self.ha._is_healthiest_node([member], check_replication_lag=False))
+            mock_pools.assert_called_once_with(member)
+        self.ha._status_cache._streams[member.name]._set_status({'role': 'replica'})
+        self.assertEqual(list(self.ha.streamed_nodes_statuses([member])), [])
+        del self.ha.patroni.config['restapi']['use_status_stream']
+        Ha.load_cluster_from_dcs(self.ha)
+        self.assertEqual(self.ha._status_cache._streams, {})
+
+    def test_fetch_nodes_statuses(self):
+        self.assertEqual(list(self.ha.fetch_nodes_statuses([])), [])
+        self.ha.fetch_node_status = get_node_status()
+        members = self.ha.old_cluster.members
+        self.assertEqual(len(list(self.ha.fetch_nodes_statuses(members))), len(members))
+        pool = self.ha._fetch_pool
+        self.assertEqual(len(list(self.ha.fetch_nodes_statuses(members))), len(members))
+        self.assertIs(pool, self.ha._fetch_pool)
+
+    def test_fetch_nodes_statuses_cancel(self):
+        functions = []
+
+        def imap_unordered(func, members):
+            functions.append(func)
+            return iter([func(members[0])])
+
+        self.ha._fetch_pool = Mock(imap_unordered=imap_unordered)
+        self.ha.fetch_node_status = Mock(side_effect=get_node_status(in_recovery=False))
+        members = self.ha.old_cluster.members
+        statuses = self.ha.fetch_nodes_statuses(members)
+        self.assertFalse(next(statuses).in_recovery)
+        statuses.close()
+        self.assertFalse(functions[0](members[1]).reachable)  # cancelled request
+        self.ha.fetch_node_status.assert_called_once()
+        self.assertFalse(self.ha._is_healthiest_node(members))
+
     def test_post_recover(self):
         self.p.is_running = false
         self.ha.has_lock = true
@@ -684,7 +826,7 @@ class TestHa(unittest.TestCase):
         msg = 'no action.  i am a secondary and i am following a leader'
         self.assertEqual(self.ha.run_cycle(), msg)
 
-    @patch('requests.get', requests_get)
+    @patch('urllib3.connectionpool.HTTPConnectionPool.urlopen', http_urlopen)
     def test_process_unhealthy_standby_cluster_as_standby_leader(self):
         self.p.is_leader = false
         self.p.name = 'leader'
@@ -993,6 +1135,15 @@ class TestHa(unittest.TestCase):
         self.p.is_running = false
         self.ha.has_lock = true
         self.ha.shutdown()
+        # worker threads fetching member statuses are stopped
+        self.ha.fetch_node_status = get_node_status()
+        members = self.ha.old_cluster.members
+        self.assertEqual(len(list(self.ha.fetch_nodes_statuses(members))), len(members))
+        pool = self.ha._fetch_pool
+        with patch.object(pool, 'terminate', Mock(wraps=pool.terminate)) as mock_terminate:
+            self.ha.shutdown()
+            mock_terminate.assert_called_once()
+        self.assertIsNone(self.ha._fetch_pool)
 
     @patch('time.sleep', Mock())
     def test_leader_with_empty_directory(self):
@@ -1016,7 +1167,7 @@ class TestHa(unittest.TestCase):
             self.assertEqual(self.ha.run_cycle(), 'no action.  i am the leader with the lock')
 
     @patch('sys.exit', return_value=1)
-    @patch('requests.get', requests_get)
+    @patch('urllib3.connectionpool.HTTPConnectionPool.urlopen', http_urlopen)
     def test_abort_join(self, exit_mock):
         self.ha.cluster = get_cluster_not_initialized_without_leader()
         self.p.is_leader = false
@@ -2,7 +2,8 @@ import time
 import unittest
 
 from mock import Mock, patch
-from patroni.dcs.kubernetes import Kubernetes, KubernetesError, k8s_client, k8s_watch, RetryFailedError
+from patroni.dcs.kubernetes import Kubernetes, KubernetesError, ObjectCache, k8s_client, k8s_watch, RetryFailedError
+from test_etcd import SleepException
 
 
 def mock_list_namespaced_config_map(self, *args, **kwargs):
@@ -22,14 +23,16 @@ def mock_list_namespaced_config_map(self, *args, **kwargs):
 def mock_list_namespaced_pod(self, *args, **kwargs):
     metadata = k8s_client.V1ObjectMeta(resource_version='1', name='p-0', annotations={'status': '{}'})
     items = [k8s_client.V1Pod(metadata=metadata)]
-    return k8s_client.V1PodList(items=items)
+    return k8s_client.V1PodList(metadata=k8s_client.V1ListMeta(resource_version='1'), items=items)
 
 
 @patch.object(k8s_client.CoreV1Api, 'patch_namespaced_config_map', Mock())
 @patch.object(k8s_client.CoreV1Api, 'create_namespaced_config_map', Mock())
+@patch.object(ObjectCache, 'run', Mock())
 class TestKubernetes(unittest.TestCase):
 
     @patch('kubernetes.config.load_kube_config', Mock())
+    @patch.object(ObjectCache, 'run', Mock())
     @patch.object(k8s_client.CoreV1Api, 'list_namespaced_config_map', mock_list_namespaced_config_map)
     @patch.object(k8s_client.CoreV1Api, 'list_namespaced_pod', mock_list_namespaced_pod)
     def setUp(self):
@@ -112,6 +115,22 @@ class TestKubernetes(unittest.TestCase):
             self.assertRaises(KeyboardInterrupt, self.k.watch, '1', 2)
             self.assertTrue(self.k.watch('1', 2))
 
+    def test_watch_prefix(self):
+        self.k._watch_prefix = True
+        with patch.object(Kubernetes, '_start_prefix_watcher', Mock()), \
+                patch.object(k8s_watch.Watch, 'stream') as mock_stream:
+            self.assertFalse(self.k.watch('1', 0))
+            mock_stream.assert_not_called()
+
+        events = [{'type': 'MODIFIED', 'raw_object': {'metadata': {'name': 'test-failover', 'resourceVersion': '2'}}}]
+        events = [events, [], [{'type': 'ERROR', 'raw_object': {}}]]
+        with patch.object(k8s_watch.Watch, 'stream', Mock(side_effect=events)):
+            self.assertEqual(self.k._watch_prefix_changes(1), ['failover'])
+            self.assertEqual(self.k._prefix_watch_index, '2')
+            self.assertEqual(self.k._watch_prefix_changes(1), [])
+            self.assertEqual(self.k._watch_prefix_changes(1), ['*'])
+            self.assertIsNone(self.k._prefix_watch_index)
+
     def test_set_history_value(self):
         self.k.set_history_value('{}')
 
@@ -126,3 +145,61 @@ class TestKubernetes(unittest.TestCase):
         self.assertIsNotNone(k.patch_or_create_config({'foo': 'bar'}))
         self.assertIsNotNone(k.patch_or_create_config({'foo': 'bar'}))
         k.touch_member({'state': 'running', 'role': 'replica'})
+
+
+@patch.object(ObjectCache, 'start', Mock())
+class TestObjectCache(unittest.TestCase):
+
+    @patch('kubernetes.config.load_kube_config', Mock())
+    @patch.object(ObjectCache, 'start', Mock())
+    def setUp(self):
+        self.k = Kubernetes({'ttl': 30, 'scope': 'test', 'name': 'p-0', 'retry_timeout': 10, 'labels': {'f': 'b'},
+                             'use_cache': True})
+        self.k._start_cache()
+        self.cache = self.k._kinds
+
+    @patch.object(k8s_client.CoreV1Api, 'list_namespaced_config_map', mock_list_namespaced_config_map)
+    @patch.object(k8s_client.CoreV1Api, 'list_namespaced_pod', mock_list_namespaced_pod)
+    def test_load_cluster_from_cache(self):
+        self.assertIsNone(self.cache.get())
+        self.k._pods._list()
+        self.cache._list()
+        self.assertEqual(self.cache.get()[0], '1')
+        with patch.object(k8s_client.CoreV1Api, 'list_namespaced_config_map', Mock(side_effect=Exception)):
+            cluster = self.k.get_cluster()
+        self.assertEqual(cluster.leader.name, 'p-0')
+        self.assertEqual(cluster.leader.index, '1')
+
+        metadata = k8s_client.V1ObjectMeta(name='test-leader', resource_version='3', annotations={'leader': 'p-1'})
+        self.k._update_cache(self.cache, k8s_client.V1ConfigMap(metadata=metadata))
+        self.k._update_cache(self.cache, True)
+        self.assertEqual(self.cache.get()[1]['test-leader'].metadata.annotations, {'leader': 'p-1'})
+
+    @patch.object(k8s_client.CoreV1Api, 'list_namespaced_config_map', mock_list_namespaced_config_map)
+    def test_run(self):
+        events = [{'type': 'MODIFIED', 'raw_object': {'metadata': {'name': 'test-sync', 'resourceVersion': '3'}}},
+                  {'type': 'MODIFIED', 'raw_object': {'metadata': {'name': 'test-sync', 'resourceVersion': 'x'}}},
+                  {'type': 'DELETED', 'raw_object': {'metadata': {'name': 'test-failover', 'resourceVersion': '4'}}},
+                  {'type': 'ERROR', 'raw_object': {'code': 410}}]
+        with patch.object(k8s_watch.Watch, 'stream', Mock(side_effect=[events, [], Exception,
+                                                                       k8s_client.rest.ApiException(410, ''),
+                                                                       k8s_client.rest.ApiException(500, ''),
+                                                                       [{'type': 'ERROR', 'raw_object': {}}]])), \
+                patch.object(ObjectCache, '_list', Mock()) as mock_list, \
+                patch('time.sleep', Mock(side_effect=[None, None, SleepException])):
+            self.cache._resource_version = '2'
+            self.cache._is_ready = True
+            self.cache._object_cache = {'test-sync': None, 'test-failover': None}
+            self.assertRaises(SleepException, self.cache.run)
+            self.assertEqual(mock_list.call_count, 5)
+
+        self.cache._resource_version = None
+        self.cache._list()
+        self.cache._process_event(events[0])
+        self.cache._process_event(events[2])
+        version, objects = self.cache.get()
+        self.assertEqual(version, '4')
+        self.assertNotIn('test-failover', objects)
+        self.assertEqual(objects['test-sync'].metadata.resource_version, '3')
+        self.cache._process_event(events[3])
+        self.assertIsNone(self.cache._resource_version)
@@ -0,0 +1,55 @@
+import unittest
+
+from patroni.metrics import Counter, CycleTimings, HA_PHASE_SECONDS, Histogram, Registry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = Counter('foo_total', 'Foo', ('mode',), registry=self.registry)
+        counter.inc(mode='fast')
+        counter.inc(2, mode='fast')
+        self.assertEqual(counter.get(mode='fast'), 3)
+        self.assertRaises(ValueError, counter.inc, foo='bar')
+        self.assertRaises(ValueError, Counter, 'foo_total', 'Foo', registry=self.registry)
+        self.assertIn('foo_total{mode="fast"} 3\n', self.registry.render())
+
+    def test_histogram(self):
+        histogram = Histogram('bar_seconds', 'Bar', buckets=(1, 0.1), registry=self.registry)
+        histogram.observe(0.05)
+        histogram.observe(5)
+        with histogram.time():
+            pass
+        self.assertEqual(histogram.get()[:3], [2, 0, 1])
+        text = self.registry.render()
+        self.assertIn('bar_seconds_bucket{le="0.1"} 2\nbar_seconds_bucket{le="1"} 2\n'
+                      'bar_seconds_bucket{le="+Inf"} 3\n', text)
+        self.assertIn('bar_seconds_count 3\n', text)
+        histogram.clear()
+        self.assertEqual(histogram.get(), [0, 0, 0, 0.0])
+
+    def test_render(self):
+        text = self.registry.render([('baz', 'Baz', [({'state': 'run"ning'}, 1)])])
+        self.assertEqual(text, '# HELP baz Baz\n# TYPE baz gauge\nbaz{state="run\\"ning"} 1\n')
+
+
+class TestCycleTimings(unittest.TestCase):
+
+    def test_cycle(self):
+        timings = CycleTimings(history=2)
+        with timings.phase('foo'):  # outside of a cycle only the histogram is updated
+            pass
+        self.assertEqual(timings.history(), [])
+        for i in range(3):
+            timings.start()
+            with timings.phase('foo'):
+                pass
+            with timings.phase('foo'):
+                pass
+            cycle = timings.finish(str(i))
+        self.assertEqual(list(cycle['phases'].keys()), ['foo', 'other'])
+        self.assertEqual([c['result'] for c in timings.history()], ['1', '2'])
+        self.assertEqual(sum(HA_PHASE_SECONDS.get(phase='foo')[:-1]), 7)
@@ -0,0 +1,114 @@
+import binascii
+import os
+import struct
+import sys
+import unittest
+
+from mock import mock_open, patch
+from patroni.pg_control import _layout, crc32c, parse_pg_control, read_pg_control, PgControlError
+
+
+def pg_control(major_version, **values):
+    layout = _layout(major_version)
+    fmt = '@' + ''.join(f for _, f in layout)
+    defaults = {'system_identifier': 6200971513092291716, 'pg_control_version': 1100, 'catalog_version_no': 1,
+                'state': 6, 'checkpoint': 0x100000028, 'redo': 0x100000028, 'checkpoint_tli': 3, 'prev_tli': 2,
+                'min_recovery_point': 0, 'min_recovery_point_tli': 0, 'wal_log_hints': True, 'max_connections': 100,
+                'max_worker_processes': 8, 'max_wal_senders': 10, 'max_prepared_xacts': 0, 'max_locks_per_xact': 64,
+                'track_commit_timestamp': False, 'data_checksum_version': 0}
+    defaults.update(values)
+    data = struct.pack(fmt, *[defaults.get(name, b'' if f == '32s' else 0)
+                              for name, f in layout if not f.startswith('0')])
+    data += struct.pack('@0I')
+    return data + struct.pack('@I', crc32c(data)) + b'\0' * 100
+
+
+# global/pg_control of PostgreSQL 16 on x86_64, promoted to timeline 2 (the rest of the file is zeroed)
+PG16_CONTROL = binascii.unhexlify(
+    '79ac588b053fd56a14050000fff50e0c0600000000000000063fd56a0000000080366c010000000048366c0100000000'
+    '02000000020000000100000000000000da02000000000000e13100000100000000000000d20200000100000001000000'
+    '0100000000000000063fd56a000000000000000000000000da02000000000000e8030000000000000000000000000000'
+    '0000000000000000000000000000000000000000000000000000000001000000010000002a000000080000000a000000'
+    '000000004000000000000000080000000000000087d63241002000000000020000200000000000014000000020000000'
+    'cc0700000008000001000000010000000315068ad75aa0f4c7f191d8b349245c6c96015849df6fea3ab513eea3a865a3'
+    '5a96b9a400000000') + b'\0' * 7896
+
+
+def pg12_control():
+    """global/pg_control of PostgreSQL 12 on x86_64, fields are placed at offsets of `ControlFileData`"""
+    data = bytearray(8192)
+    struct.pack_into('<QII', data, 0, 6200971513092291716, 1201, 201909212)  # system identifier, versions
+    struct.pack_into('<i', data, 16, 5)  # state: in archive recovery
+    struct.pack_into('<QQII?', data, 32, 0x3000108, 0x30000D0, 3, 2, True)  # checkPoint, checkPointCopy.redo, tli
+    struct.pack_into('<QI', data, 136, 0x3000150, 3)  # minRecoveryPoint, minRecoveryPointTLI
+    struct.pack_into('<i?xxxiiiii?', data, 172, 1, True, 200, 16, 5, 10, 128, True)  # wal_level ... track_commit_ts
+    struct.pack_into('<Id8I??', data, 204, 8, 1234567.0, 8192, 131072, 8192, 16777216, 64, 32, 1996, 2048,
+                     True, True)  # maxAlign ... loblksize, float4ByVal, float8ByVal
+    struct.pack_into('<I', data, 252, 1)  # data_checksum_version
+    struct.pack_into('<I', data, 288, crc32c(bytes(data[:288])))
+    return bytes(data)
+
+
+class TestPgControl(unittest.TestCase):
+
+    def test_crc32c(self):
+        self.assertEqual(crc32c(b'123456789'), 0xE3069283)
+
+    def test_parse_pg_control(self):
+        for major_version in (90500, 90600, 100000, 110000, 120000, 130000):
+            data = parse_pg_control(pg_control(major_version), major_version)
+            self.assertEqual(data['Database cluster state'], 'in production')
+            self.assertEqual(data['Latest checkpoint location'], '1/28')
+            self.assertEqual(data["Latest checkpoint's TimeLineID"], '3')
+            self.assertEqual(data['max_connections setting'], '100')
+            self.assertEqual('max_wal_senders setting' in data, major_version >= 120000)
+
+        data = parse_pg_control(pg_control(120000, state=10, wal_log_hints=False), 120000)
+        self.assertEqual(data['Database cluster state'], 'unrecognized status code')
+        self.assertEqual(data['wal_log_hints setting'], 'off')
+
+    @unittest.skipUnless(sys.byteorder == 'little' and struct.calcsize('P') == 8, 'fixtures are from x86_64')
+    def test_parse_real_pg_control(self):
+        data = parse_pg_control(PG16_CONTROL, 160000)
+        self.assertEqual(data['pg_control version number'], '1300')
+        self.assertEqual(data['Database system identifier'], '7698128431104961657')
+        self.assertEqual(data['Database cluster state'], 'in production')
+        self.assertEqual(data['Latest checkpoint location'], '0/16C3680')
+        self.assertEqual(data["Latest checkpoint's REDO location"], '0/16C3648')
+        self.assertEqual(data["Latest checkpoint's TimeLineID"], '2')
+        self.assertEqual(data['wal_log_hints setting'], 'on')
+        self.assertEqual(data['max_connections setting'], '42')
+        self.assertEqual(data['max_wal_senders setting'], '10')
+        self.assertEqual(data['max_locks_per_xact setting'], '64')
+        self.assertEqual(data['Data page checksum version'], '1')
+
+        data = parse_pg_control(pg12_control(), 120000)
+        self.assertEqual(data['pg_control version number'], '1201')
+        self.assertEqual(data['Database cluster state'], 'in archive recovery')
+        self.assertEqual(data['Latest checkpoint location'], '0/3000108')
+        self.assertEqual(data["Latest checkpoint's REDO location"], '0/30000D0')
+        self.assertEqual(data["Latest checkpoint's TimeLineID"], '3')
+        self.assertEqual(data["Latest checkpoint's PrevTimeLineID"], '2')
+        self.assertEqual(data['Minimum recovery ending location'], '0/3000150')
+        self.assertEqual(data["Min recovery ending loc's timeline"], '3')
+        self.assertEqual(data['max_connections setting'], '200')
+        self.assertEqual(data['max_worker_processes setting'], '16')
+        self.assertEqual(data['max_wal_senders setting'], '5')
+        self.assertEqual(data['max_prepared_xacts setting'], '10')
+        self.assertEqual(data['max_locks_per_xact setting'], '128')
+        self.assertEqual(data['track_commit_timestamp setting'], 'on')
+        self.assertEqual(data['Data page checksum version'], '1')
+
+    def test_parse_invalid_pg_control(self):
+        self.assertRaises(PgControlError, parse_pg_control, pg_control(90500), 90400)
+        self.assertRaises(PgControlError, parse_pg_control, b'', 110000)
+        self.assertRaises(PgControlError, parse_pg_control, pg_control(100000), 110000)
+
+    def test_read_pg_control(self):
+        with patch('patroni.pg_control.open', mock_open(read_data=pg_control(110000)), create=True) as mock_file:
+            self.assertEqual(read_pg_control('data', 110000)['Database system identifier'], '6200971513092291716')
+        mock_file.assert_called_with(os.path.join('data', 'global', 'pg_control'), 'rb')
+        # pg_control of versions older than 9.5 is not read, the caller falls back to pg_controldata
+        with patch('patroni.pg_control.open', mock_open(), create=True) as mock_file:
+            self.assertRaises(PgControlError, read_pg_control, 'data', 90400)
+        mock_file.assert_not_called()
@@ -90,6 +90,10 @@ class MockConnect(object):
     def cursor(self):
         return MockCursor(self)
 
+    @staticmethod
+    def get_transaction_status():
+        return 0
+
     def __enter__(self):
         return self
 
@@ -291,8 +295,10 @@ class TestPostgresql(unittest.TestCase):
         # Is running, stopped successfully
         mock_is_running.return_value = mock_postmaster = MockPostmaster()
         mock_callback.reset_mock()
+        self.p._slot_connections['a'] = MockConnect()
         self.assertTrue(self.p.stop(on_safepoint=mock_callback))
         mock_callback.assert_called()
+        self.assertEqual(self.p._slot_connections, {})
         mock_postmaster.signal_stop.assert_called()
 
         # Stop signal failed
@@ -524,6 +530,70 @@ class TestPostgresql(unittest.TestCase):
             self.assertTrue("test-3" in ca, "non matching {0}".format(ca))
             self.assertTrue("test.3" in ca, "non matching {0}".format(ca))
 
+    @patch.object(Postgresql, 'is_running', Mock(return_value=True))
+    def test_sync_replication_slots_batched(self):
+        self.p.start()
+        config = ClusterConfig(1, {'slots': {'ls': {'database': 'a', 'plugin': 'c'},
+                                             'b': {'type': 'logical', 'database': 'a', 'plugin': '1'}}}, 1)
+        cluster = Cluster(True, config, self.leader, 0, [self.me, self.other, self.leadermem], None, None, None)
+        self.p._schedule_load_slots = False
+        self.p._replication_slots = {'foo': {'type': 'physical'}, 'bar': {'type': 'physical'}}
+        with patch.object(MockCursor, 'execute') as mock_execute:
+            self.p.sync_replication_slots(cluster)
+        sqls = [c[0][0] for c in mock_execute.call_args_list]
+        self.assertEqual(len([s for s in sqls if 'pg_drop_replication_slot' in s]), 1)
+        self.assertEqual(len([s for s in sqls if 'pg_create_physical_replication_slot' in s]), 1)
+        self.assertEqual(len([s for s in sqls if 'pg_create_logical_replication_slot' in s]), 1)
+        self.assertIn('a', self.p._slot_connections)
+        self.p.close_connection()
+        self.assertEqual(self.p._slot_connections, {})
+        # the failed logical slot creation closes the cached connection
+        self.p._schedule_load_slots = True
+        self.p._slot_connections['a'] = MockConnect()
+        self.p.sync_replication_slots(cluster)
+        self.assertEqual(self.p._slot_connections, {})
+        self.assertTrue(self.p._schedule_load_slots)
+        # connections are not kept after demotion
+        self.p._slot_connections['a'] = MockConnect()
+        self.p.set_role('replica')
+        self.p.sync_replication_slots(cluster)
+        self.assertEqual(self.p._slot_connections, {})
+
+    def test_drop_replication_slots_one_by_one(self):
+        with patch.object(Postgresql, '_query', Mock(side_effect=[psycopg2.Error, Mock(rowcount=1), Exception])):
+            self.assertEqual(self.p._drop_replication_slots(['a', 'b']), set(['b']))
+
+    def test_create_physical_replication_slots_one_by_one(self):
+        self.p._schedule_load_slots = False
+        with patch.object(Postgresql, '_query', Mock(side_effect=[psycopg2.Error, Mock(), Exception])) as mock_query:
+            self.p._create_physical_replication_slots(['a', 'b'])
+        self.assertEqual([c[0][1:] for c in mock_query.call_args_list], [('a', 'b'), ('a',), ('b',)])
+        self.assertTrue(self.p._schedule_load_slots)
+
+    def test_create_logical_replication_slots_one_by_one(self):
+        self.p._schedule_load_slots = False
+        slots = {'a': {'plugin': 'missing'}, 'b': {'plugin': 'test_decoding'}}
+        with patch.object(MockCursor, 'execute', Mock(side_effect=[psycopg2.Error, psycopg2.Error, None])) as mock_exec:
+            self.p._create_logical_replication_slots('db', slots)
+        self.assertEqual([c[0][1] for c in mock_exec.call_args_list[1:]], [('a', 'missing'), ('b', 'test_decoding')])
+        self.assertTrue(self.p._schedule_load_slots)
+        self.assertIn('db', self.p._slot_connections)
+
+    @patch.object(Postgresql, 'is_running', Mock(return_value=True))
+    @patch.object(MockCursor, 'execute', Mock())
+    def test_sync_replication_slots_unchanged(self):
+        self.p.start()
+        cluster = Cluster(True, ClusterConfig(1, {'slots': {'ls': 0}}, 1), self.leader, 0,
+                          [self.me, self.other, self.leadermem], None, None, None)
+        self.p.sync_replication_slots(cluster)
+        with patch.object(Cluster, 'get_replication_slots') as mock_get_slots:
+            self.p.sync_replication_slots(cluster)
+            mock_get_slots.assert_not_called()
+            cluster = Cluster(True, ClusterConfig(2, {}, 2), self.leader, 0,
+                              [self.me, self.other, self.leadermem], None, None, None)
+            self.p.sync_replication_slots(cluster)
+            self.assertEqual(mock_get_slots.call_count, 1)
+
     @patch.object(MockCursor, 'execute', Mock(side_effect=psycopg2.OperationalError))
     def test__query(self):
         self.assertRaises(PostgresConnectionException, self.p._query, 'blabla')
@@ -557,6 +627,16 @@ class TestPostgresql(unittest.TestCase):
         self.assertIsNone(self.p.promote(0))
         self.assertTrue(self.p.promote(0))
 
+    def test_wait_for_promotion(self):
+        self.assertTrue(self.p.wait_for_promotion(1))
+        controldata = [{}, {'Database cluster state': 'in production'}]
+        with patch('psycopg2.connect', Mock(side_effect=psycopg2.OperationalError)), \
+                patch.object(Postgresql, 'controldata', Mock(side_effect=controldata)):
+            self.assertTrue(self.p.wait_for_promotion(1))
+        with patch.object(MockCursor, 'fetchone', Mock(return_value=(True,))), \
+                patch('patroni.postgresql.polling_loop', Mock(return_value=range(2))):
+            self.assertIsNone(self.p.wait_for_promotion(1))
+
     def test_timeline_wal_position(self):
         self.assertEqual(self.p.timeline_wal_position(), (1, 2))
         Thread(target=self.p.timeline_wal_position).start()
@@ -742,6 +822,12 @@ class TestPostgresql(unittest.TestCase):
         with patch('subprocess.check_output', Mock(side_effect=subprocess.CalledProcessError(1, ''))):
             self.assertEqual(self.p.controldata(), {})
 
+        data = {'Database cluster state': 'in production'}
+        with patch('patroni.postgresql.read_pg_control', Mock(return_value=data)), \
+                patch('subprocess.check_output') as mock_check_output:
+            self.assertEqual(self.p.controldata()['Database cluster state'], 'in production')
+            mock_check_output.assert_not_called()
+
     @patch('patroni.postgresql.Postgresql._version_file_exists', Mock(return_value=True))
     @patch('subprocess.check_output', MagicMock(return_value=0, side_effect=pg_controldata_string))
     def test_sysid(self):
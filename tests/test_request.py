@@ -0,0 +1,116 @@
+import unittest
+
+from mock import Mock, patch
+from patroni.dcs import Member
+from patroni.request import MemberConnectionPools, MemberStatusCache, MemberStatusStream, StaleConnectionRetry
+from six import BytesIO
+from urllib3.exceptions import MaxRetryError, ProtocolError, ReadTimeoutError
+
+
+@patch('urllib3.connectionpool.HTTPConnectionPool.urlopen', Mock())
+class TestMemberConnectionPools(unittest.TestCase):
+
+    def setUp(self):
+        self.pools = MemberConnectionPools()
+        self.member = Member(0, 'foo', 1, {'api_url': 'http://127.0.0.1:8008/patroni'})
+
+    def test_call(self):
+        self.pools(self.member)
+        pool = self.pools._get_pool(self.member)
+        self.assertIsInstance(pool.urlopen.call_args[1]['retries'], StaleConnectionRetry)
+        self.pools(Member(0, 'foo', 1, {'api_url': 'http://127.0.0.1:8008/patroni'}))
+        self.assertIs(pool, self.pools._get_pool(self.member))
+        member = Member(0, 'foo', 1, {'api_url': 'https://127.0.0.1:8009/patroni?foo=bar'})
+        self.pools(member, timeout=1)
+        self.assertIsNot(pool, self.pools._get_pool(member))
+        self.pools(member, 'POST', timeout=1)
+        self.pools._get_pool(member).urlopen.assert_called_with('POST', '/patroni?foo=bar', body=None,
+                                                                timeout=1, retries=False)
+
+    def test_stale_connection_retry(self):
+        retry = StaleConnectionRetry().increment('GET', '/patroni', error=ProtocolError('Connection aborted.'))
+        self.assertRaises(MaxRetryError, retry.increment, 'GET', '/patroni', error=ProtocolError('aborted'))
+        self.assertRaises(ReadTimeoutError, StaleConnectionRetry().increment, 'GET', '/patroni',
+                          error=ReadTimeoutError(None, '/patroni', 'timed out'))
+
+    def test_prune(self):
+        self.pools(self.member)
+        self.pools(Member(0, 'bar', 1, {'api_url': 'http://127.0.0.1:8009/patroni'}))
+        self.pools.prune(['foo'])
+        self.assertEqual(list(self.pools.stats().keys()), ['foo'])
+        self.pools.close()
+        self.assertEqual(self.pools.stats(), {})
+
+    def test_stats(self):
+        self.pools(self.member)
+        self.assertEqual(self.pools.stats()['foo']['reuse_ratio'], 0.0)
+        pool = self.pools._get_pool(self.member)
+        pool.num_requests, pool.num_connections = 4, 1
+        stats = self.pools.stats()['foo']
+        self.assertEqual(stats['handshakes'], 1)
+        self.assertEqual(stats['reuse_ratio'], 0.75)
+
+
+def mock_response(content_type='text/event-stream', body=b'data: {"state": "running"}\n\n', status=200):
+    response = Mock(status=status, fp=BytesIO(body))
+    response.getheader.return_value = content_type
+    return response
+
+
+class TestMemberStatusStream(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = MemberStatusStream('http://127.0.0.1:8008/patroni', 1)
+
+    @patch('six.moves.http_client.HTTPConnection')
+    def test__consume(self, mock_conn):
+        mock_conn.return_value.getresponse.return_value = mock_response()
+        self.stream._consume()
+        mock_conn.return_value.request.assert_called_with('GET', '/status_stream',
+                                                          headers={'Accept': 'text/event-stream'})
+        self.assertEqual(self.stream.get(2), {'state': 'running'})
+        self.assertIsNone(self.stream.get(-1))
+
+        mock_conn.return_value.getresponse.return_value = mock_response(status=503)
+        with patch.object(self.stream._stopped, 'wait') as mock_wait:
+            self.stream._consume()
+        mock_wait.assert_called_with(30)
+        self.assertFalse(self.stream._stopped.is_set())
+
+        mock_conn.return_value.getresponse.return_value = mock_response('application/json')
+        self.stream._consume()
+        self.assertTrue(self.stream._stopped.is_set())
+
+    @patch('six.moves.http_client.HTTPSConnection')
+    def test_run(self, mock_conn):
+        self.stream.api_url = 'https://127.0.0.1:8009/patroni'
+        mock_conn.return_value.getresponse.side_effect = Exception
+        with patch.object(self.stream._stopped, 'wait', Mock(side_effect=lambda _: self.stream.stop())):
+            self.stream.run()
+        self.assertIsNone(self.stream.get(2))
+
+
+@patch.object(MemberStatusStream, 'start', Mock())
+class TestMemberStatusCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MemberStatusCache()
+        self.member = Member(0, 'foo', 1, {'api_url': 'http://127.0.0.1:8008/patroni'})
+
+    def test_set_members(self):
+        self.cache.set_members([self.member])
+        stream = self.cache._streams['foo']
+        self.cache.set_members([self.member])
+        self.assertIs(stream, self.cache._streams['foo'])
+        self.cache.set_members([self.member], 2)
+        self.assertTrue(stream._stopped.is_set())
+        self.assertIsNot(stream, self.cache._streams['foo'])
+        self.cache.set_members([], 2)
+        self.assertEqual(self.cache._streams, {})
+
+    def test_get(self):
+        self.assertIsNone(self.cache.get(self.member))
+        self.cache.set_members([self.member])
+        self.cache._streams['foo']._set_status({'state': 'running'})
+        self.assertEqual(self.cache.get(self.member), {'state': 'running'})
+        self.assertIsNone(self.cache.get(Member(0, 'foo', 1, {'api_url': 'http://127.0.0.1:8009/patroni'})))
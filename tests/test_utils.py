@@ -2,6 +2,7 @@ import unittest
 
 from mock import Mock, patch
 from patroni.exceptions import PatroniException
+from patroni.metrics import RETRIES
 from patroni.utils import Retry, RetryFailedError, polling_loop
 
 
@@ -9,6 +10,11 @@ class TestUtils(unittest.TestCase):
 
     def test_polling_loop(self):
         self.assertEqual(list(polling_loop(0.001, interval=0.001)), [0])
+        with patch('time.sleep') as mock_sleep:
+            loop = polling_loop(10, interval=0.01, max_interval=0.05)
+            for _ in range(5):
+                next(loop)
+            self.assertEqual([round(c[0][0], 3) for c in mock_sleep.call_args_list], [0.01, 0.02, 0.04, 0.05])
 
 
 @patch('time.sleep', Mock())
@@ -28,8 +34,10 @@ class TestRetrySleeper(unittest.TestCase):
 
     def test_reset(self):
         retry = Retry(delay=0, max_tries=2)
+        retries = RETRIES.get()
         retry(self._fail())
         self.assertEqual(retry._attempts, 1)
+        self.assertEqual(RETRIES.get(), retries + 1)
         retry.reset()
         self.assertEqual(retry._attempts, 0)
 
@@ -45,6 +45,12 @@ class MockKazooClient(Mock):
             return (b'foo', ZnodeStat(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))
         return (b'', ZnodeStat(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))
 
+    def get_async(self, path, watch=None):
+        try:
+            return Mock(get=Mock(return_value=self.get(path, watch)))
+        except Exception as e:
+            return Mock(get=Mock(side_effect=e))
+
     @staticmethod
     def get_children(path, watch=None, include_data=False):
         if not isinstance(path, six.string_types):
@@ -148,6 +154,35 @@ class TestZooKeeper(unittest.TestCase):
         self.zk._base_path = self.zk._base_path = '/no_node'
         self.zk._inner_load_cluster()
 
+    def test_load_members(self):
+        with patch.object(MockKazooClient, 'get_async', Mock(wraps=self.zk._client.get_async)) as mock_get_async:
+            self.assertEqual([m.name for m in self.zk.load_members('bar')], ['foo', 'bar', 'buzz'])
+            self.assertEqual(mock_get_async.call_count, 3)
+            self.zk.member_watcher(Mock(path='/service/test/members/bar'))
+            self.assertTrue(self.zk.event.is_set())
+            self.zk.member_watcher(Mock(path='/service/test/members/foo'))
+            self.assertEqual(len(self.zk.load_members(None)), 3)
+            self.assertEqual(mock_get_async.call_count, 5)
+            self.assertEqual(len(self.zk.load_members(None)), 3)
+            self.assertEqual(mock_get_async.call_count, 5)
+
+        # member was removed while we were reading it
+        with patch.object(MockKazooClient, 'get_children', Mock(return_value=['foo', 'removed'])), \
+                patch.object(MockKazooClient, 'get_async', Mock(side_effect=[Mock(get=Mock(side_effect=NoNodeError))])):
+            self.assertEqual([m.name for m in self.zk.load_members(None)], ['foo'])
+        self.assertEqual(list(self.zk._members_cache), ['foo'])
+
+        # member was changed while we were reading it
+        def get_async(path, watch):
+            watch(Mock(path=path))
+            return Mock(get=Mock(return_value=(b'{}', ZnodeStat(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))))
+
+        with patch.object(MockKazooClient, 'get_async', Mock(side_effect=get_async)):
+            self.assertEqual(len(self.zk.load_members(None)), 3)
+        self.assertEqual(list(self.zk._members_cache), ['foo'])
+        self.zk.session_listener(KazooState.LOST)
+        self.assertEqual(self.zk._members_cache, {})
+
     def test_get_cluster(self):
         self.assertRaises(ZooKeeperError, self.zk.get_cluster)
         cluster = self.zk.get_cluster()